@@ -0,0 +1,1002 @@
+#!/usr/bin/env python3
+"""
+Offline benchmark suite for the Telegram MCP tools
+
+Runs the real tool functions from main.py against a generated Telegram account,
+without a network connection or a live session. The production client class is
+kept; only its MTProto sender is swapped for FakeSender, which answers requests
+from a deterministic FakeWorld (dialogs, messages, participants and media) after
+a configurable latency and, optionally, with injected FloodWaits. Telethon's
+request building and entity cache, the coalescer, the rate limiter and the tools
+themselves all run as they do in production.
+
+Usage:
+    python benchmark.py                          # 10k dialogs, 1M messages
+    python benchmark.py --latency 50 --flood-rate 0.01
+    python benchmark.py --save-baseline          # store these results as the baseline
+    python benchmark.py --check                  # exit 1 on a regression vs the baseline
+    python benchmark.py --replay traffic.rec.gz  # re-run recorded tool calls on recorded data
+    python benchmark.py --scrub traffic.rec.gz scrubbed.rec.gz
+
+With --replay, the tool calls in a TELEGRAM_RECORD_PATH recording are re-run
+against the recorded answers instead, one scenario per tool.
+
+Each scenario reports ops/s and p50/p99 latency. When a baseline exists for the
+same configuration, results more than --tolerance worse, or with more errors,
+are flagged.
+
+Scenarios measure the server rather than the pacing, except member listings and
+batch tools, which always run under the production rate limits so a pacing
+regression shows up in them; --real-limits applies those limits everywhere.
+"""
+
+import argparse
+import asyncio
+import bisect
+import importlib
+import json
+import logging
+import os
+import random
+import statistics
+import sys
+import time
+from collections import deque
+from datetime import datetime, timedelta, timezone
+
+from telethon import errors, functions, types
+from telethon.sessions import StringSession
+
+# The benchmark must never touch the real account's caches or message mirror
+os.environ.setdefault("TELEGRAM_API_ID", "1")
+os.environ.setdefault("TELEGRAM_API_HASH", "0" * 32)
+os.environ["TELEGRAM_ENTITY_CACHE"] = ""
+os.environ["TELEGRAM_MIRROR_PATH"] = ""
+os.environ["TELEGRAM_RECORD_PATH"] = ""
+# Imported only now: main reads the settings above at import time
+main = importlib.import_module("main")
+PRODUCTION_LIMITS = dict(main.rpc_scheduler.limits)
+
+DEFAULT_BASELINE = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), "benchmark_baseline.json"
+)
+
+SELF_ID = 1
+USER_BASE = 1_000_000
+CHAT_BASE = 2_000_000
+CHANNEL_BASE = 3_000_000
+# Prime, so (seed + j * stride) % USER_POOL visits distinct users for j < USER_POOL
+USER_POOL = 50_021
+# Telegram stops paging a channel's member list after this many members
+PARTICIPANTS_CAP = 10_000
+HISTORY_SPAN = 2 * 365 * 86400
+NOW = datetime(2026, 1, 1, tzinfo=timezone.utc)
+
+FIRST_NAMES = (
+    "Alex Maria Ivan Sofia Omar Lena Noah Aiko Lucas Zara "
+    "Mateo Nina Yusuf Emma Ravi Olga Diego Mei Jonas Ana"
+).split()
+LAST_NAMES = (
+    "Smith Ivanova Garcia Kim Novak Rossi Silva Khan Muller "
+    "Tanaka Petrov Costa Nguyen Haddad Berg Lopez Sato Weber"
+).split()
+VOCAB = (
+    "meeting release deploy invoice lunch report photo budget ticket review launch update "
+    "server design draft contract travel demo backup metrics roadmap hotfix coffee weekend "
+    "schedule feedback customer payment sprint question answer thanks"
+).split()
+
+
+class FakeChat:
+    """One dialog of the fake account and the bounds of its message history."""
+
+    def __init__(self, index, kind, first_id, count, members, last_date):
+        self.index = index
+        self.kind = kind  # "user", "group", "megagroup" or "broadcast"
+        self.first_id = first_id
+        self.count = count
+        self.members = members
+        self.last_date = last_date
+        self.seed = index * 2_654_435_761 % 2**32
+        self.step = max(1, HISTORY_SPAN // max(count, 1))
+
+    @property
+    def top_id(self):
+        return self.first_id + self.count - 1
+
+    @property
+    def is_channel(self):
+        return self.kind in ("megagroup", "broadcast")
+
+    @property
+    def peer(self):
+        if self.kind == "user":
+            return types.PeerUser(USER_BASE + self.index)
+        if self.kind == "group":
+            return types.PeerChat(CHAT_BASE + self.index)
+        return types.PeerChannel(CHANNEL_BASE + self.index)
+
+    def date_ts(self, message_id):
+        return int(self.last_date.timestamp()) - (self.top_id - message_id) * self.step
+
+    def member(self, j):
+        return USER_BASE + (self.seed + j * 7_919) % USER_POOL
+
+
+class FakeWorld:
+    """
+    Deterministically generated account contents.
+
+    Entities are built up front; messages and participants are generated on
+    demand from their ids, so a million messages cost no memory.
+    """
+
+    def __init__(self, dialogs=10_000, messages=1_000_000, seed=1):
+        rng = random.Random(seed)
+        # Zipf-like sizes: a few huge chats, a long tail of quiet ones
+        ranks = list(range(dialogs))
+        rng.shuffle(ranks)
+        weights = [1 / (rank + 1) ** 0.9 for rank in ranks]
+        scale = messages / sum(weights)
+        self.chats = []
+        self.by_peer = {}
+        self._global_ids = []  # (first_id, chat) for chats whose ids are account-wide
+        next_global = 1
+        for i in range(dialogs):
+            kind = ("user",) * 12 + ("group",) * 5 + ("megagroup",) * 2 + ("broadcast",)
+            kind = kind[i % 20]
+            count = max(1, round(weights[i] * scale))
+            if kind == "user":
+                members = 2
+            elif kind == "group":
+                members = rng.randint(3, 200)
+            else:
+                members = min(USER_POOL - 1, int(20 + rng.paretovariate(0.8) * 30))
+            if kind in ("user", "group"):
+                # Private chats and basic groups share one message id sequence
+                first_id = next_global
+                next_global += count
+            else:
+                first_id = 1
+            chat = FakeChat(i, kind, first_id, count, members, NOW - timedelta(minutes=i))
+            if kind in ("user", "group"):
+                self._global_ids.append((first_id, chat))
+            self.chats.append(chat)
+            self.by_peer[main.utils.get_peer_id(chat.peer)] = chat
+        self.pinned = self.chats[:5]
+        self._users = {}
+        self._searches = {}
+        # Phone book entries synced from the account's devices
+        self.saved_contacts = 37
+
+    # Entities
+
+    def user(self, user_id):
+        user = self._users.get(user_id)
+        if user is None:
+            if user_id == SELF_ID:
+                user = types.User(
+                    SELF_ID, is_self=True, access_hash=1, first_name="Bench", username="bench_self"
+                )
+            else:
+                n = user_id - USER_BASE
+                user = types.User(
+                    user_id,
+                    access_hash=user_id * 31,
+                    first_name=FIRST_NAMES[n % len(FIRST_NAMES)],
+                    last_name=LAST_NAMES[n * 7 % len(LAST_NAMES)],
+                    username=f"user{n}",
+                    contact=n % 5 == 0,
+                )
+            self._users[user_id] = user
+        return user
+
+    def entity(self, chat):
+        if chat.kind == "user":
+            return self.user(USER_BASE + chat.index)
+        if chat.kind == "group":
+            return types.Chat(
+                CHAT_BASE + chat.index,
+                f"Group {chat.index}",
+                types.ChatPhotoEmpty(),
+                chat.members,
+                chat.last_date,
+                1,
+            )
+        return types.Channel(
+            CHANNEL_BASE + chat.index,
+            f"Channel {chat.index}",
+            types.ChatPhotoEmpty(),
+            chat.last_date,
+            megagroup=chat.kind == "megagroup",
+            broadcast=chat.kind == "broadcast",
+            access_hash=chat.index * 17 + 1,
+            participants_count=chat.members,
+        )
+
+    def chat_for(self, peer):
+        chat = None
+        if isinstance(peer, (types.InputPeerUser, types.InputUser)):
+            chat = self.by_peer.get(peer.user_id)
+        elif isinstance(peer, types.InputPeerChat):
+            chat = self.by_peer.get(-peer.chat_id)
+        elif isinstance(peer, (types.InputPeerChannel, types.InputChannel)):
+            chat = self.by_peer.get(-1_000_000_000_000 - peer.channel_id)
+        if chat is None:
+            raise errors.PeerIdInvalidError(None)
+        return chat
+
+    # Messages
+
+    def text(self, chat, message_id):
+        h = (chat.seed + message_id * 2_246_822_519) % 2**32
+        return " ".join(VOCAB[(h >> (3 * j)) % len(VOCAB)] for j in range(3 + h % 7))
+
+    def message(self, chat, message_id):
+        k = message_id - chat.first_id
+        h = (chat.seed + message_id * 2_246_822_519) % 2**32
+        date = datetime.fromtimestamp(chat.date_ts(message_id), timezone.utc)
+        out = chat.kind == "user" and k % 3 == 0
+        if chat.kind == "broadcast":
+            from_id = None
+        elif chat.kind == "user":
+            from_id = types.PeerUser(SELF_ID if out else USER_BASE + chat.index)
+        else:
+            from_id = types.PeerUser(chat.member(h % chat.members))
+        media = None
+        if k % 11 == 5:
+            media = types.MessageMediaPhoto(
+                photo=types.Photo(
+                    message_id,
+                    h,
+                    b"",
+                    date,
+                    [types.PhotoSize("y", 1280, 960, 180_000 + h % 90_000)],
+                    2,
+                )
+            )
+        elif k % 11 == 7:
+            media = types.MessageMediaDocument(
+                document=types.Document(
+                    message_id,
+                    h,
+                    b"",
+                    date,
+                    "application/pdf",
+                    50_000 + h % 5_000_000,
+                    2,
+                    [types.DocumentAttributeFilename(f"file_{message_id}.pdf")],
+                )
+            )
+        return types.Message(
+            message_id,
+            chat.peer,
+            date,
+            "" if media and k % 2 else self.text(chat, message_id),
+            out=out,
+            from_id=from_id,
+            post=chat.kind == "broadcast",
+            media=media,
+        )
+
+    def _messages_result(self, chat, ids, count):
+        messages = [self.message(chat, i) for i in ids]
+        users = {SELF_ID: self.user(SELF_ID)}
+        for m in messages:
+            if isinstance(m.from_id, types.PeerUser):
+                users.setdefault(m.from_id.user_id, self.user(m.from_id.user_id))
+        chats = [] if chat.kind == "user" else [self.entity(chat)]
+        if chat.kind == "user":
+            users[USER_BASE + chat.index] = self.entity(chat)
+        if chat.is_channel:
+            return types.messages.ChannelMessages(
+                1, count, messages, [], chats, list(users.values())
+            )
+        return types.messages.MessagesSlice(count, messages, [], chats, list(users.values()))
+
+    def _top(self, chat, offset_id, offset_date, max_id):
+        """Highest message id allowed by the offset/max filters (exclusive bounds)."""
+        top = chat.top_id
+        if offset_id:
+            top = min(top, offset_id - 1)
+        if max_id:
+            top = min(top, max_id - 1)
+        if offset_date:
+            ids = range(chat.first_id, chat.top_id + 1)
+            limit_ts = int(offset_date.timestamp())
+            top = min(top, chat.first_id + bisect.bisect_left(ids, limit_ts, key=chat.date_ts) - 1)
+        return top
+
+    def history(self, r):
+        chat = self.chat_for(r.peer)
+        top = self._top(chat, r.offset_id, r.offset_date, 0)
+        start = top - r.add_offset
+        ids = [
+            i
+            for i in range(start, start - r.limit, -1)
+            if chat.first_id <= i <= chat.top_id
+            and (not r.max_id or i < r.max_id)
+            and (not r.min_id or i > r.min_id)
+        ]
+        return self._messages_result(chat, ids, chat.count)
+
+    def search(self, r):
+        chat = self.chat_for(r.peer)
+        top = self._top(chat, r.offset_id, r.max_date, r.max_id)
+        bottom = max(chat.first_id, (r.min_id or 0) + 1)
+        q = (r.q or "").casefold()
+        skip = max(r.add_offset, 0)
+        ids = []
+        for i in range(top, bottom - 1, -1):
+            if q in self.text(chat, i):
+                if skip:
+                    skip -= 1
+                    continue
+                ids.append(i)
+                if len(ids) >= r.limit:
+                    break
+        return self._messages_result(chat, ids, len(ids) + max(r.add_offset, 0))
+
+    def messages_by_id(self, r):
+        if isinstance(r, functions.channels.GetMessagesRequest):
+            chat = self.chat_for(r.channel)
+            found = [(chat, i.id) for i in r.id]
+        else:
+            found = []
+            for i in r.id:
+                pos = bisect.bisect_right(self._global_ids, i.id, key=lambda item: item[0]) - 1
+                found.append((self._global_ids[pos][1] if pos >= 0 else None, i.id))
+        messages, chats, users = [], [], {SELF_ID: self.user(SELF_ID)}
+        for chat, message_id in found:
+            if chat is None or not chat.first_id <= message_id <= chat.top_id:
+                messages.append(types.MessageEmpty(message_id))
+                continue
+            m = self.message(chat, message_id)
+            messages.append(m)
+            if isinstance(m.from_id, types.PeerUser):
+                users.setdefault(m.from_id.user_id, self.user(m.from_id.user_id))
+            entity = self.entity(chat)
+            (users.__setitem__(entity.id, entity) if chat.kind == "user" else chats.append(entity))
+        if isinstance(r, functions.channels.GetMessagesRequest):
+            return types.messages.ChannelMessages(
+                1, len(messages), messages, [], chats, list(users.values())
+            )
+        return types.messages.Messages(messages, [], chats, list(users.values()))
+
+    # Dialogs
+
+    def dialogs(self, r):
+        unpinned = [c for c in self.chats if c not in self.pinned]
+        if isinstance(r.offset_peer, types.InputPeerEmpty):
+            order = unpinned if r.exclude_pinned else self.pinned + unpinned
+        else:
+            offset = self.chat_for(r.offset_peer)
+            order = unpinned[unpinned.index(offset) + 1 :] if offset in unpinned else []
+        page = order[: r.limit]
+        result_users, result_chats, messages, dialogs = {SELF_ID: self.user(SELF_ID)}, [], [], []
+        for chat in page:
+            top = self.message(chat, chat.top_id)
+            messages.append(top)
+            if isinstance(top.from_id, types.PeerUser):
+                result_users.setdefault(top.from_id.user_id, self.user(top.from_id.user_id))
+            entity = self.entity(chat)
+            if chat.kind == "user":
+                result_users[entity.id] = entity
+            else:
+                result_chats.append(entity)
+            dialogs.append(
+                types.Dialog(
+                    chat.peer,
+                    chat.top_id,
+                    chat.top_id - chat.index % 4,
+                    chat.top_id,
+                    chat.index % 4,
+                    0,
+                    0,
+                    0,
+                    types.PeerNotifySettings(),
+                    pinned=chat in self.pinned,
+                )
+            )
+        return types.messages.DialogsSlice(
+            len(self.chats), dialogs, messages, result_chats, list(result_users.values())
+        )
+
+    # Participants
+
+    def participants(self, r):
+        chat = self.chat_for(r.channel)
+        q = getattr(r.filter, "q", "").casefold()
+        if q:
+            # Paging re-asks the same search; answer it from the first scan
+            members = self._searches.get((chat.index, q))
+            if members is None:
+                members = self._searches[chat.index, q] = [
+                    chat.member(j)
+                    for j in range(chat.members)
+                    if any(
+                        w.casefold().startswith(q)
+                        for w in (
+                            self.user(chat.member(j)).first_name,
+                            self.user(chat.member(j)).last_name,
+                            self.user(chat.member(j)).username,
+                        )
+                    )
+                ]
+        else:
+            members = [chat.member(j) for j in range(min(chat.members, PARTICIPANTS_CAP))]
+        page = members[r.offset : r.offset + r.limit] if r.offset < PARTICIPANTS_CAP else []
+        return types.channels.ChannelParticipants(
+            min(len(members), PARTICIPANTS_CAP) if q else chat.members,
+            [types.ChannelParticipant(uid, chat.last_date) for uid in page],
+            [],
+            [self.user(uid) for uid in page],
+        )
+
+    def full_chat(self, r):
+        chat = self.chat_for(types.InputPeerChat(r.chat_id))
+        members = [chat.member(j) for j in range(chat.members)]
+        full = types.ChatFull(
+            r.chat_id,
+            "",
+            types.ChatParticipants(
+                r.chat_id,
+                [types.ChatParticipant(uid, members[0], chat.last_date) for uid in members],
+                1,
+            ),
+            types.PeerNotifySettings(),
+        )
+        return types.messages.ChatFull(
+            full, [self.entity(chat)], [self.user(uid) for uid in members]
+        )
+
+    def full_channel(self, r):
+        chat = self.chat_for(r.channel)
+        full = types.ChannelFull(
+            CHANNEL_BASE + chat.index,
+            "",
+            chat.top_id,
+            chat.top_id,
+            0,
+            types.PhotoEmpty(0),
+            types.PeerNotifySettings(),
+            [],
+            1,
+            participants_count=chat.members,
+        )
+        return types.messages.ChatFull(full, [self.entity(chat)], [])
+
+    def users(self, r):
+        result = []
+        for input_user in r.id:
+            if isinstance(input_user, types.InputUserSelf):
+                result.append(self.user(SELF_ID))
+            else:
+                result.append(self.user(input_user.user_id))
+        return result
+
+    def chats_of(self, r):
+        if isinstance(r, functions.channels.GetChannelsRequest):
+            return types.messages.Chats([self.entity(self.chat_for(c)) for c in r.id])
+        return types.messages.Chats(
+            [self.entity(self.chat_for(types.InputPeerChat(c))) for c in r.id]
+        )
+
+    # Contacts
+
+    def contacts(self, r):
+        users = [self.user(USER_BASE + c.index) for c in self.chats if c.kind == "user"]
+        users = [user for user in users if user.contact]
+        # Telegram's vector hash, written out here so the benchmark checks main's copy
+        acc = 0
+        for n in [self.saved_contacts, *sorted(user.id for user in users)]:
+            acc ^= acc >> 21
+            acc ^= (acc << 35) & 0xFFFFFFFFFFFFFFFF
+            acc ^= acc >> 4
+            acc = (acc + n) & 0xFFFFFFFFFFFFFFFF
+        if r.hash == (acc - (1 << 64) if acc >= 1 << 63 else acc):
+            return types.contacts.ContactsNotModified()
+        return types.contacts.Contacts(
+            [types.Contact(user.id, False) for user in users], self.saved_contacts, users
+        )
+
+    # Batch targets: accepted, with nothing to change in the generated data
+
+    def read_history(self, r):
+        if isinstance(r, functions.channels.ReadHistoryRequest):
+            self.chat_for(r.channel)
+            return True
+        self.chat_for(r.peer)
+        return types.messages.AffectedMessages(1, 0)
+
+    def notify_settings(self, r):
+        self.chat_for(r.peer.peer)
+        return True
+
+    def answer(self, request):
+        handler = {
+            functions.messages.GetDialogsRequest: self.dialogs,
+            functions.messages.GetHistoryRequest: self.history,
+            functions.messages.SearchRequest: self.search,
+            functions.messages.GetMessagesRequest: self.messages_by_id,
+            functions.channels.GetMessagesRequest: self.messages_by_id,
+            functions.channels.GetParticipantsRequest: self.participants,
+            functions.messages.GetFullChatRequest: self.full_chat,
+            functions.channels.GetFullChannelRequest: self.full_channel,
+            functions.users.GetUsersRequest: self.users,
+            functions.channels.GetChannelsRequest: self.chats_of,
+            functions.messages.GetChatsRequest: self.chats_of,
+            functions.contacts.GetContactsRequest: self.contacts,
+            functions.messages.ReadHistoryRequest: self.read_history,
+            functions.channels.ReadHistoryRequest: self.read_history,
+            functions.account.UpdateNotifySettingsRequest: self.notify_settings,
+        }.get(type(request))
+        if handler is None:
+            raise errors.RPCError(request, f"{type(request).__name__.upper()}_NOT_FAKED", 400)
+        return handler(request)
+
+
+class FakeSender:
+    """Stands in for Telethon's MTProtoSender, answering from a FakeWorld."""
+
+    def __init__(self, world, latency=0.0, jitter=0.0, flood_rate=0.0, flood_seconds=1, seed=1):
+        self.world = world
+        self.latency = latency
+        self.jitter = jitter
+        self.flood_rate = flood_rate
+        self.flood_seconds = flood_seconds
+        self.rng = random.Random(seed)
+        self.requests = 0
+        self.flood_waits = 0
+
+    def is_connected(self):
+        return True
+
+    def send(self, request, ordered=False):
+        if isinstance(request, list):
+            return [asyncio.ensure_future(self._respond(r)) for r in request]
+        return asyncio.ensure_future(self._respond(request))
+
+    async def _respond(self, request):
+        self.requests += 1
+        if isinstance(request, functions.InvokeWithoutUpdatesRequest):
+            request = request.query
+        delay = self.latency + self.rng.uniform(0, self.jitter)
+        if delay:
+            await asyncio.sleep(delay)
+        if self.flood_rate and self.rng.random() < self.flood_rate:
+            self.flood_waits += 1
+            raise errors.FloodWaitError(request, capture=self.flood_seconds)
+        return self.world.answer(request)
+
+
+class ReplaySender:
+    """
+    Stands in for Telethon's MTProtoSender, answering from a recording made
+    with TELEGRAM_RECORD_PATH.
+
+    A request gets the recorded answer to the byte-identical request, or else
+    to the same kind of request; answers are handed out in recorded order and
+    reused round-robin. Each answer is deserialized afresh, as off the wire.
+    """
+
+    def __init__(self, path, timing=False):
+        self.timing = timing
+        self.exact = {}
+        self.by_type = {}
+        self.tool_calls = []
+        self._entities = []
+        self.requests = 0
+        self.misses = 0
+        for kind, latency, first, second in main.read_recording(path):
+            if kind == main.RECORD_TOOL_CALL:
+                self.tool_calls.append((first, second))
+                continue
+            if kind == main.RECORD_RESULT:
+                self._entities.append(second)
+                second = main.tl_to_bytes(second)
+            entry = (latency, second)
+            self.exact.setdefault(bytes(first), deque()).append(entry)
+            self.by_type.setdefault(first.CONSTRUCTOR_ID, deque()).append(entry)
+
+    def seed_entities(self, client):
+        """Teach the session every recorded entity, as the recording session knew them."""
+        for result in self._entities:
+            client.session.process_entities(result)
+        self._entities = []
+
+    def is_connected(self):
+        return True
+
+    def send(self, request, ordered=False):
+        if isinstance(request, list):
+            return [asyncio.ensure_future(self._respond(r)) for r in request]
+        return asyncio.ensure_future(self._respond(request))
+
+    async def _respond(self, request):
+        self.requests += 1
+        if isinstance(request, functions.InvokeWithoutUpdatesRequest):
+            request = request.query
+        answers = self.exact.get(bytes(request)) or self.by_type.get(request.CONSTRUCTOR_ID)
+        if not answers:
+            self.misses += 1
+            raise errors.RPCError(request, f"{type(request).__name__.upper()}_NOT_RECORDED", 400)
+        latency, outcome = answers[0]
+        answers.rotate(-1)
+        if self.timing:
+            await asyncio.sleep(latency)
+        if isinstance(outcome, Exception):
+            raise outcome
+        return main.tl_from_bytes(outcome)
+
+
+def install_fake_client(sender):
+    """Point main.py at a fresh client whose network is `sender`."""
+    client = main.CoalescingTelegramClient(
+        StringSession(),
+        int(os.environ["TELEGRAM_API_ID"]),
+        os.environ["TELEGRAM_API_HASH"],
+        receive_updates=False,
+    )
+    client._sender = sender
+    main.client = client
+    main.dialog_index.ready = False
+    for kind in ("entity", "dialogs", "full_user", "full_chat"):
+        main.request_coalescer.invalidate(kind)
+    return client
+
+
+def use_limits(real):
+    """Give the next run a fresh scheduler: the production limits, or buckets that never wait."""
+    limits = PRODUCTION_LIMITS if real else {family: (1e9, 10**9) for family in PRODUCTION_LIMITS}
+    main.rpc_scheduler = main.RpcScheduler(limits, main.RPC_DEADLINE)
+
+
+class Scenarios:
+    """The calls each scenario makes, drawn from one FakeWorld with one random stream."""
+
+    def __init__(self, world, rng):
+        self.world = world
+        self.rng = rng
+        self.hot = sorted(world.chats, key=lambda c: c.count, reverse=True)[:100]
+        self.groups = [c for c in world.chats if c.kind != "user"]
+        # The smallest chat past PARTICIPANTS_CAP: sharded, at the least pacing cost
+        oversized = [c for c in self.groups if c.members > PARTICIPANTS_CAP]
+        oversized = oversized or [max(self.groups, key=lambda c: c.members)]
+        self.sharded = min(oversized, key=lambda c: c.members)
+
+    def pick(self):
+        # Most traffic goes to a few busy chats, the rest is spread thin
+        rng = self.rng
+        chat = rng.choice(self.hot) if rng.random() < 0.8 else rng.choice(self.world.chats)
+        return main.utils.get_peer_id(chat.peer), chat
+
+    def pick_many(self, count):
+        return [main.utils.get_peer_id(c.peer) for c in self.rng.sample(self.world.chats, count)]
+
+    def get_chats(self):
+        return main.get_chats(
+            page=self.rng.randint(1, max(1, len(self.world.chats) // 20)), page_size=20
+        )
+
+    def list_messages(self):
+        chat_id, _ = self.pick()
+        return main.list_messages(chat_id, limit=50)
+
+    def list_messages_search(self):
+        chat_id, _ = self.pick()
+        return main.list_messages(chat_id, limit=20, search_query=self.rng.choice(VOCAB))
+
+    def list_messages_window(self):
+        chat_id, chat = self.pick()
+        day = datetime.fromtimestamp(
+            chat.date_ts(self.rng.randint(chat.first_id, chat.top_id)), timezone.utc
+        )
+        return main.list_messages(
+            chat_id,
+            limit=50,
+            from_date=(day - timedelta(days=7)).strftime("%Y-%m-%d"),
+            to_date=day.strftime("%Y-%m-%d"),
+        )
+
+    def get_messages(self):
+        chat_id, chat = self.pick()
+        return main.get_messages(
+            chat_id, page=self.rng.randint(1, max(1, min(chat.count // 20, 50)))
+        )
+
+    def get_message_context(self):
+        chat_id, chat = self.pick()
+        return main.get_message_context(chat_id, self.rng.randint(chat.first_id, chat.top_id), 5)
+
+    def search_messages(self):
+        chat_id, _ = self.pick()
+        return main.search_messages(chat_id, self.rng.choice(VOCAB), limit=20)
+
+    def get_participants(self):
+        chat = self.rng.choice(self.groups)
+        return main.get_participants(main.utils.get_peer_id(chat.peer))
+
+    def get_participants_sharded(self):
+        # Past PARTICIPANTS_CAP only the sharded prefix queries can list everyone
+        return main.get_participants(
+            main.utils.get_peer_id(self.sharded.peer), output_format="ndjson"
+        )
+
+    def list_contacts(self):
+        return main.list_contacts()
+
+    def mark_as_read_batch(self):
+        return main.mark_as_read_batch(self.pick_many(10))
+
+    def mute_chats_batch(self):
+        return main.mute_chats_batch(self.pick_many(10), mute=self.rng.random() < 0.5)
+
+
+def scenarios(world, rng):
+    """
+    (name, ops, concurrency, call factory, paced) for every benchmark, in run
+    order; None means the default, and paced scenarios keep the production limits.
+    """
+    calls = Scenarios(world, rng)
+    return [
+        ("dialog_index.build", 1, 1, main.dialog_index.build, False),
+        ("get_chats", None, None, calls.get_chats, False),
+        ("list_messages", None, None, calls.list_messages, False),
+        ("list_messages(search)", None, None, calls.list_messages_search, False),
+        ("list_messages(date window)", None, None, calls.list_messages_window, False),
+        ("get_messages", None, None, calls.get_messages, False),
+        ("get_message_context", None, None, calls.get_message_context, False),
+        ("search_messages", None, None, calls.search_messages, False),
+        ("get_participants", 10, 1, calls.get_participants, True),
+        ("get_participants(sharded)", 1, 1, calls.get_participants_sharded, True),
+        ("list_contacts", None, None, calls.list_contacts, False),
+        ("mark_as_read_batch", 6, 2, calls.mark_as_read_batch, True),
+        ("mute_chats_batch", 6, 2, calls.mute_chats_batch, True),
+    ]
+
+
+def replay_scenarios(sender):
+    """One scenario per recorded tool, re-issuing its recorded calls in order."""
+    calls = {}
+    for name, arguments in sender.tool_calls:
+        calls.setdefault(name, []).append(arguments)
+    result = []
+    for name, recorded in calls.items():
+        tool = getattr(main, name, None)
+        if tool is None:
+            print(f"Skipping unknown tool {name}")
+            continue
+
+        def make_call(tool=tool, recorded=recorded, position=[0]):
+            arguments = recorded[position[0] % len(recorded)]
+            position[0] += 1
+            return tool(**arguments)
+
+        result.append((f"replay:{name}", len(recorded), None, make_call, False))
+    return result
+
+
+def is_error(result):
+    return isinstance(result, str) and result.startswith(
+        ("An error occurred", "Telegram rate limit")
+    )
+
+
+async def run_scenario(make_call, ops, concurrency):
+    latencies, failures = [], 0
+    remaining = ops
+
+    async def worker():
+        nonlocal remaining, failures
+        while remaining > 0:
+            remaining -= 1
+            started = time.perf_counter()
+            result = await make_call()
+            latencies.append(time.perf_counter() - started)
+            failures += is_error(result)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(min(concurrency, ops))))
+    wall = time.perf_counter() - started
+    if len(latencies) > 1:
+        cuts = statistics.quantiles(latencies, n=100, method="inclusive")
+        p50, p99 = cuts[49], cuts[98]
+    else:
+        p50 = p99 = latencies[0]
+    return {
+        "ops": ops,
+        "ops_per_sec": ops / wall if wall > 0 else 0.0,
+        "p50_ms": p50 * 1000,
+        "p99_ms": p99 * 1000,
+        "errors": failures,
+    }
+
+
+def compare(results, baseline, tolerance):
+    """
+    Names of scenarios that got more than `tolerance` slower than the baseline,
+    or that failed more often: a tool that starts failing fast must not pass as faster.
+    """
+    regressions = []
+    for name, result in results.items():
+        base = baseline.get(name)
+        if base is None:
+            continue
+        # Sub-millisecond latencies are all noise; give them an absolute allowance
+        slower = result["p99_ms"] > base["p99_ms"] * (1 + tolerance) + 1.0
+        weaker = result["ops_per_sec"] < base["ops_per_sec"] * (1 - tolerance)
+        failing = result["errors"] > base["errors"]
+        if slower or weaker or failing:
+            regressions.append(name)
+    return regressions
+
+
+async def run(args):
+    if args.replay:
+        print(f"Loading {args.replay}...")
+        sender = ReplaySender(args.replay, args.replay_timing)
+        client = install_fake_client(sender)
+        sender.seed_entities(client)
+        plan = replay_scenarios(sender)
+    else:
+        print(f"Generating {args.dialogs} dialogs / {args.messages} messages...")
+        world = FakeWorld(args.dialogs, args.messages, args.seed)
+        sender = FakeSender(
+            world,
+            args.latency / 1000,
+            args.jitter / 1000,
+            args.flood_rate,
+            args.flood_seconds,
+            args.seed,
+        )
+        install_fake_client(sender)
+        plan = scenarios(world, random.Random(args.seed))
+        if args.only and "dialog_index.build" not in args.only:
+            # A full run builds the index first; without it every chosen scenario
+            # would also time the paced entity lookups its first calls need
+            use_limits(False)
+            await main.dialog_index.build()
+    results = {}
+    print(f"{'scenario':<28}{'ops':>7}{'ops/s':>11}{'p50 ms':>10}{'p99 ms':>10}{'errors':>8}")
+    for name, ops, concurrency, make_call, paced in plan:
+        if args.only and name not in args.only:
+            continue
+        # Best of several runs, so one scheduling hiccup does not read as a regression;
+        # paced scenarios take as long as the limits say, so one run is enough
+        runs = []
+        for _ in range(1 if paced else args.repeat):
+            use_limits(args.real_limits or paced)
+            runs.append(
+                await run_scenario(make_call, ops or args.ops, concurrency or args.concurrency)
+            )
+        result = {
+            "ops": runs[0]["ops"],
+            "ops_per_sec": max(run["ops_per_sec"] for run in runs),
+            "p50_ms": min(run["p50_ms"] for run in runs),
+            "p99_ms": min(run["p99_ms"] for run in runs),
+            "errors": sum(run["errors"] for run in runs),
+        }
+        results[name] = result
+        print(
+            f"{name:<28}{result['ops']:>7}{result['ops_per_sec']:>11.1f}"
+            f"{result['p50_ms']:>10.2f}{result['p99_ms']:>10.2f}{result['errors']:>8}"
+        )
+    if args.replay:
+        print(f"Replayed RPCs: {sender.requests}, not in the recording: {sender.misses}")
+    else:
+        print(f"Fake RPCs: {sender.requests}, injected FloodWaits: {sender.flood_waits}")
+    return results
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Offline benchmarks for the Telegram MCP tools")
+    parser.add_argument("--dialogs", type=int, default=10_000)
+    parser.add_argument("--messages", type=int, default=1_000_000)
+    parser.add_argument("--ops", type=int, default=300, help="calls per scenario")
+    parser.add_argument("--concurrency", type=int, default=8, help="calls in flight per scenario")
+    parser.add_argument(
+        "--repeat", type=int, default=3, help="runs per scenario; the best one counts"
+    )
+    parser.add_argument("--latency", type=float, default=0.0, help="fake RPC latency in ms")
+    parser.add_argument(
+        "--jitter", type=float, default=0.0, help="extra random latency, up to this many ms"
+    )
+    parser.add_argument(
+        "--flood-rate", type=float, default=0.0, help="share of RPCs answered with a FloodWait"
+    )
+    parser.add_argument(
+        "--flood-seconds", type=int, default=1, help="length of injected FloodWaits"
+    )
+    parser.add_argument(
+        "--real-limits",
+        action="store_true",
+        help="keep the production rate limits in every scenario",
+    )
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument(
+        "--replay",
+        metavar="FILE",
+        help="serve a TELEGRAM_RECORD_PATH recording instead of fake data",
+    )
+    parser.add_argument(
+        "--replay-timing", action="store_true", help="wait each RPC's recorded latency"
+    )
+    parser.add_argument(
+        "--scrub",
+        nargs=2,
+        metavar=("SRC", "DST"),
+        help="write a scrubbed copy of a recording and exit",
+    )
+    parser.add_argument("--only", nargs="*", help="run just these scenarios")
+    parser.add_argument("--baseline", default=DEFAULT_BASELINE, help="baseline JSON file")
+    parser.add_argument(
+        "--save-baseline", action="store_true", help="store the results as the baseline"
+    )
+    parser.add_argument(
+        "--check",
+        action="store_true",
+        help="exit with status 1 on a regression, 2 if there is no comparable baseline",
+    )
+    parser.add_argument(
+        "--tolerance", type=float, default=0.25, help="allowed slowdown vs the baseline"
+    )
+    return parser.parse_args(argv)
+
+
+def main_cli(argv=None):
+    args = parse_args(argv)
+    logging.getLogger("telethon").setLevel(logging.WARNING)
+    if args.scrub:
+        count = main.scrub_recording(*args.scrub)
+        print(f"Wrote {count} scrubbed records to {args.scrub[1]}")
+        return 0
+    results = asyncio.run(run(args))
+    config = {
+        key: getattr(args, key)
+        for key in (
+            "dialogs",
+            "messages",
+            "ops",
+            "concurrency",
+            "repeat",
+            "latency",
+            "jitter",
+            "flood_rate",
+            "flood_seconds",
+            "real_limits",
+            "seed",
+            "replay",
+            "replay_timing",
+        )
+    }
+
+    if args.save_baseline:
+        with open(args.baseline, "w", encoding="utf-8") as f:
+            json.dump({"config": config, "results": results}, f, indent=2)
+        print(f"Baseline saved to {args.baseline}")
+        return 0
+
+    if not os.path.exists(args.baseline):
+        print("No baseline yet; run with --save-baseline to create one.")
+        return 2 if args.check else 0
+    with open(args.baseline, encoding="utf-8") as f:
+        baseline = json.load(f)
+    if baseline.get("config") != config:
+        print("Baseline was recorded with different settings; not comparing.")
+        return 2 if args.check else 0
+    regressions = compare(results, baseline["results"], args.tolerance)
+    for name in regressions:
+        base, now = baseline["results"][name], results[name]
+        print(
+            f"REGRESSION {name}: {now['ops_per_sec']:.1f} ops/s (was {base['ops_per_sec']:.1f}), "
+            f"p99 {now['p99_ms']:.2f} ms (was {base['p99_ms']:.2f}), "
+            f"{now['errors']} errors (was {base['errors']})"
+        )
+    if not regressions:
+        print("No regressions against the baseline.")
+    return 1 if regressions and args.check else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main_cli())
@@ -1,20 +1,46 @@
 import os
 import sys
 import json
+import math
 import time
+import base64
+import bisect
+import copy
+import functools
+import heapq
+import hashlib
 import asyncio
+import atexit
+import secrets
 import sqlite3
+import struct
+import gzip
 import logging
+import queue
+import threading
+import contextlib
+import contextvars
+import itertools
 import mimetypes
-from datetime import datetime, timedelta
+import re
+import weakref
+from array import array
+from collections import OrderedDict, defaultdict
+from datetime import datetime, timedelta, timezone
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
 from typing import List, Dict, Optional, Union, Any
 
 # Third-party libraries
 import nest_asyncio
 from dotenv import load_dotenv
-from mcp.server.fastmcp import FastMCP
-from telethon import TelegramClient, functions, utils
+from mcp.server.fastmcp import Context, FastMCP
+from telethon import TelegramClient, errors, events, functions, helpers, utils
+from telethon.extensions import BinaryReader
+from telethon.network import MTProtoSender
 from telethon.sessions import StringSession
+from telethon.tl.alltlobjects import LAYER
+from telethon.tl.custom import Dialog
+from telethon.tl.tlobject import TLObject
 from telethon.tl.types import (
     User,
     Chat,
@@ -23,13 +49,47 @@ from telethon.tl.types import (
     ChatBannedRights,
     ChannelParticipantsKicked,
     ChannelParticipantsAdmins,
+    ChannelParticipantsSearch,
+    ChannelAdminLogEventsFilter,
+    ChannelAdminLogEventActionParticipantInvite,
+    ChannelAdminLogEventActionParticipantJoin,
+    ChannelAdminLogEventActionParticipantJoinByInvite,
+    ChannelAdminLogEventActionParticipantJoinByRequest,
+    ChannelAdminLogEventActionParticipantLeave,
+    ChannelAdminLogEventActionParticipantToggleBan,
+    ChannelParticipantBanned,
+    ChannelParticipantLeft,
     InputChatPhoto,
     InputChatUploadedPhoto,
     InputChatPhotoEmpty,
     InputPeerUser,
     InputPeerChat,
     InputPeerChannel,
+    InputDocumentFileLocation,
+    InputFileBig,
+    InputFolderPeer,
+    Message,
+    InputNotifyPeer,
+    InputPeerNotifySettings,
+    RpcError,
+    Photo,
+    InputDialogPeer,
+    PeerUser,
+    PeerChat,
+    PeerChannel,
+    DialogPeer,
+    UpdateDialogPinned,
+    UpdatePinnedDialogs,
+    UpdateFolderPeers,
+    UpdateChannel,
+    UpdateChat,
+    ChatForbidden,
+    ChannelForbidden,
+    UpdateContactsReset,
+    UpdateUserName,
+    UpdateUserPhone,
 )
+from telethon.tl.types.contacts import ContactsNotModified
 import telethon.errors.rpcerrorlist
 
 
@@ -54,46 +114,1125 @@ SESSION_STRING = os.getenv("TELEGRAM_SESSION_STRING")
 
 mcp = FastMCP("telegram")
 
-if SESSION_STRING:
-    # Use the string session if available
-    client = TelegramClient(StringSession(SESSION_STRING), TELEGRAM_API_ID, TELEGRAM_API_HASH)
-else:
-    # Use file-based session
-    client = TelegramClient(TELEGRAM_SESSION_NAME, TELEGRAM_API_ID, TELEGRAM_API_HASH)
-
-# Setup robust logging with both file and console output
+# Setup robust logging with both file and console output. Handlers run on a
+# background thread fed by a queue, so a burst of errors never blocks the event
+# loop on disk writes; the file is JSON lines and rotates by size.
 logger = logging.getLogger("telegram_mcp")
-logger.setLevel(logging.ERROR)  # Set to ERROR for production, INFO for debugging
+# WARNING keeps FloodWaits, scheduler backpressure and similar degradations visible;
+# INFO or DEBUG for debugging, ERROR for errors only
+LOG_LEVEL = os.getenv("TELEGRAM_LOG_LEVEL", "WARNING").upper()
+logger.setLevel(LOG_LEVEL)
+
+LOG_MAX_BYTES = int(float(os.getenv("TELEGRAM_LOG_MAX_MB", "10")) * 1024 * 1024)
+LOG_BACKUPS = int(os.getenv("TELEGRAM_LOG_BACKUPS", "5"))
+# Identical errors beyond LOG_SAMPLE_BURST per LOG_SAMPLE_WINDOW seconds are only counted
+LOG_SAMPLE_BURST = int(os.getenv("TELEGRAM_LOG_SAMPLE_BURST", "5"))
+LOG_SAMPLE_WINDOW = float(os.getenv("TELEGRAM_LOG_SAMPLE_WINDOW", "60"))
+
+# (tool name, start time) of the tool call the current task is serving
+_current_tool: contextvars.ContextVar[Optional[tuple]] = contextvars.ContextVar(
+    "current_tool", default=None
+)
+
+
+class ToolContextFilter(logging.Filter):
+    """Tag records with the tool being served and how long it has been running."""
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        current = _current_tool.get()
+        if current is not None and not hasattr(record, "tool"):
+            record.tool = current[0]
+            record.latency_ms = round((time.monotonic() - current[1]) * 1000, 1)
+        return True
+
+
+class ErrorSampler(logging.Filter):
+    """
+    Let through the first `burst` identical records per `window` seconds and count
+    the rest; the next record let through for that key reports how many were dropped.
+
+    Records are identical when they share level, error code and exception type,
+    or, without an error code, level and message.
+    """
+
+    def __init__(self, burst: int, window: float):
+        super().__init__()
+        self.burst = burst
+        self.window = window
+        self._seen: Dict[tuple, list] = {}  # key -> [window start, passed, suppressed]
+        self._lock = threading.Lock()
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        error_code = getattr(record, "error_code", None)
+        exc_type = record.exc_info[0].__name__ if record.exc_info and record.exc_info[0] else None
+        key = (
+            (record.levelno, error_code, exc_type)
+            if error_code
+            else (record.levelno, record.getMessage())
+        )
+        now = time.monotonic()
+        with self._lock:
+            state = self._seen.get(key)
+            if state is None or now - state[0] >= self.window:
+                suppressed = state[2] if state else 0
+                if len(self._seen) > 10_000:
+                    self._seen.clear()
+                state = self._seen[key] = [now, 0, 0]
+                if suppressed:
+                    record.suppressed = suppressed
+            if state[1] >= self.burst:
+                state[2] += 1
+                return False
+            state[1] += 1
+        return True
+
+
+class StructuredQueueHandler(QueueHandler):
+    """QueueHandler that keeps the traceback separate from the message for JSON output."""
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        record = copy.copy(record)
+        record.message = record.getMessage()
+        if record.exc_info and record.exc_info[0] and not record.exc_text:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+        record.msg, record.args, record.exc_info = record.message, None, None
+        return record
+
+
+class JsonLineFormatter(logging.Formatter):
+    """One JSON object per line: time, level, message, location and any tool/error fields."""
+
+    FIELDS = ("tool", "latency_ms", "error_code", "error_type", "context", "suppressed")
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "time": datetime.fromtimestamp(record.created, timezone.utc).isoformat(),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+            "location": f"{record.filename}:{record.lineno}",
+        }
+        for field in self.FIELDS:
+            value = getattr(record, field, None)
+            if value is not None:
+                entry[field] = value
+        if record.exc_text:
+            entry["traceback"] = record.exc_text
+        return json.dumps(entry, default=str)
+
 
 # Create console handler
 console_handler = logging.StreamHandler()
-console_handler.setLevel(logging.ERROR)  # Set to ERROR for production, INFO for debugging
+console_handler.setLevel(LOG_LEVEL)
+console_handler.setFormatter(
+    logging.Formatter(
+        "%(asctime)s [%(levelname)s] %(name)s - %(message)s - %(filename)s:%(lineno)d"
+    )
+)
 
 # Create file handler with absolute path
 script_dir = os.path.dirname(os.path.abspath(__file__))
 log_file_path = os.path.join(script_dir, "mcp_errors.log")
 
+log_handlers: List[logging.Handler] = [console_handler]
 try:
-    file_handler = logging.FileHandler(log_file_path, mode="a")  # Append mode
-    file_handler.setLevel(logging.ERROR)
+    file_handler = RotatingFileHandler(
+        log_file_path, maxBytes=LOG_MAX_BYTES, backupCount=LOG_BACKUPS, encoding="utf-8"
+    )
+    file_handler.setLevel(LOG_LEVEL)
+    file_handler.setFormatter(JsonLineFormatter())
+    log_handlers.append(file_handler)
+except Exception as log_error:
+    # Fallback to console-only logging
+    print(f"WARNING: Error setting up log file: {log_error}")
 
-    # Create formatter and add to handlers
-    formatter = logging.Formatter(
-        "%(asctime)s [%(levelname)s] %(name)s - %(message)s - %(filename)s:%(lineno)d"
+queue_handler = StructuredQueueHandler(queue.SimpleQueue())
+queue_handler.addFilter(ToolContextFilter())
+queue_handler.addFilter(ErrorSampler(LOG_SAMPLE_BURST, LOG_SAMPLE_WINDOW))
+logger.addHandler(queue_handler)
+log_listener = QueueListener(queue_handler.queue, *log_handlers, respect_handler_level=True)
+log_listener.start()
+# Drain what is queued before the interpreter exits
+atexit.register(log_listener.stop)
+logger.info(f"Logging initialized to {log_file_path}")
+
+# Where entities seen by a string session are persisted across restarts (empty disables).
+# Railway's container filesystem is wiped on every deploy, so there the default is the
+# attached volume, and without one the cache stays off rather than silently restarting cold.
+if os.getenv("RAILWAY_VOLUME_MOUNT_PATH"):
+    _default_entity_cache = os.path.join(
+        os.environ["RAILWAY_VOLUME_MOUNT_PATH"], "entity_cache.db"
     )
-    console_handler.setFormatter(formatter)
-    file_handler.setFormatter(formatter)
+elif os.getenv("RAILWAY_ENVIRONMENT"):
+    _default_entity_cache = ""
+else:
+    _default_entity_cache = os.path.join(script_dir, "entity_cache.db")
+ENTITY_CACHE_PATH = os.getenv("TELEGRAM_ENTITY_CACHE", _default_entity_cache)
+if os.getenv("RAILWAY_ENVIRONMENT") and not ENTITY_CACHE_PATH:
+    logger.warning(
+        "Entity cache disabled: mount a Railway volume or point TELEGRAM_ENTITY_CACHE at one"
+    )
+# Rows of other logins that have not been refreshed for this long are dropped on startup
+ENTITY_CACHE_FOREIGN_TTL = 30 * 86400
+
+
+class EntityStore:
+    """
+    On-disk store of peers (marked id -> access_hash/type/username/phone/name).
+
+    Backed by SQLite in WAL mode so writes are cheap appends and readers never block.
+    Any object with the same load()/save()/close() methods can be plugged into
+    CachedStringSession instead.
+
+    Access hashes are only valid for the account that received them, so every row is
+    tagged with its owner (see session_owner) and a store only reads and writes its own.
+    Pool workers logged in with different sessions can share one file this way, and a
+    replaced session string starts from an empty cache instead of the old account's peers.
+    """
+
+    def __init__(self, path: str, owner: str):
+        self._owner = owner
+        self._conn = sqlite3.connect(path)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        columns = [row[1] for row in self._conn.execute("PRAGMA table_info(entities)")]
+        if columns and "owner" not in columns:
+            # Written before rows were tagged: nothing says which account they belong to
+            self._conn.execute("DROP TABLE entities")
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS entities (
+                owner TEXT NOT NULL,
+                id INTEGER NOT NULL,
+                hash INTEGER NOT NULL,
+                type TEXT NOT NULL,
+                username TEXT,
+                phone TEXT,
+                name TEXT,
+                date INTEGER,
+                PRIMARY KEY (owner, id)
+            )
+            """)
+        self._conn.execute(
+            "CREATE INDEX IF NOT EXISTS entities_username ON entities (owner, username)"
+        )
+        self._conn.execute(
+            "DELETE FROM entities WHERE owner != ? AND date < ?",
+            (owner, int(time.time()) - ENTITY_CACHE_FOREIGN_TTL),
+        )
+        self._conn.commit()
+
+    def load(self) -> List[tuple]:
+        """Return every row of this owner as (id, hash, username, phone, name)."""
+        return self._conn.execute(
+            "SELECT id, hash, username, phone, name FROM entities WHERE owner = ?",
+            (self._owner,),
+        ).fetchall()
+
+    def save(self, rows: List[tuple]) -> None:
+        """Insert or update (id, hash, username, phone, name) rows of this owner."""
+        now = int(time.time())
+        self._conn.executemany(
+            "INSERT OR REPLACE INTO entities (owner, id, hash, type, username, phone, name, date) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            [
+                (
+                    self._owner,
+                    id,
+                    hash,
+                    utils.resolve_id(id)[1].__name__[4:].lower(),
+                    username,
+                    phone,
+                    name,
+                    now,
+                )
+                for id, hash, username, phone, name in rows
+            ],
+        )
+        self._conn.commit()
+
+    def close(self) -> None:
+        self._conn.close()
+
+
+def session_owner(session: StringSession) -> str:
+    """Identify the login behind a session: the id of its auth key, which a new login replaces."""
+    return f"{session.auth_key.key_id:016x}"
+
+
+class CachedStringSession(StringSession):
+    """
+    StringSession whose entity cache survives restarts.
+
+    A plain StringSession only keeps entities in memory, so after every redeploy the
+    first get_entity() for each peer has to go back to Telegram. This session reloads
+    everything it has seen from an EntityStore on startup and records new or changed
+    entities as they arrive. Lookups by id, username and phone are dict-based instead
+    of MemorySession's linear scans.
+    """
+
+    def __init__(self, string: str, store: EntityStore):
+        super().__init__(string)
+        self._store = store
+        self._by_id: Dict[int, tuple] = {}
+        self._by_username: Dict[str, int] = {}
+        self._by_phone: Dict[str, int] = {}
+        for row in store.load():
+            self._remember(tuple(row))
+
+    def _remember(self, row: tuple) -> None:
+        id, _, username, phone, _ = row
+        old = self._by_id.get(id)
+        if old is not None:
+            if old[2] and self._by_username.get(old[2]) == id:
+                del self._by_username[old[2]]
+            if old[3] and self._by_phone.get(old[3]) == id:
+                del self._by_phone[old[3]]
+        self._by_id[id] = row
+        if username:
+            self._by_username[username] = id
+        if phone:
+            self._by_phone[phone] = id
+
+    def process_entities(self, tlo):
+        rows = [row for row in self._entities_to_rows(tlo) if self._by_id.get(row[0]) != row]
+        if not rows:
+            return
+        for row in rows:
+            self._remember(row)
+        try:
+            self._store.save(rows)
+        except sqlite3.Error as e:
+            logger.warning(f"Could not persist {len(rows)} entities: {e}")
+
+    def get_entity_rows_by_id(self, id, exact=True):
+        if exact:
+            row = self._by_id.get(id)
+        else:
+            row = next(
+                (
+                    self._by_id[marked]
+                    for marked in (
+                        utils.get_peer_id(PeerUser(id)),
+                        utils.get_peer_id(PeerChat(id)),
+                        utils.get_peer_id(PeerChannel(id)),
+                    )
+                    if marked in self._by_id
+                ),
+                None,
+            )
+        return (row[0], row[1]) if row else None
 
-    # Add handlers to logger
-    logger.addHandler(console_handler)
-    logger.addHandler(file_handler)
+    def get_entity_rows_by_username(self, username):
+        id = self._by_username.get(username)
+        return (id, self._by_id[id][1]) if id is not None else None
 
-    logger.info(f"Logging initialized to {log_file_path}")
-except Exception as log_error:
-    print(f"WARNING: Error setting up log file: {log_error}")
-    # Fallback to console-only logging
-    logger.addHandler(console_handler)
-    logger.error(f"Failed to set up log file handler: {log_error}")
+    def get_entity_rows_by_phone(self, phone):
+        id = self._by_phone.get(phone)
+        return (id, self._by_id[id][1]) if id is not None else None
+
+    def get_entity_rows_by_name(self, name):
+        return next((row[:2] for row in self._by_id.values() if row[4] == name), None)
+
+    def close(self):
+        self._store.close()
+
+
+class RequestCoalescer:
+    """
+    Singleflight layer with a short per-kind TTL cache.
+
+    Concurrent identical lookups (same kind and key) share one in-flight task, so
+    parallel tool calls resolving the same peer cost a single RPC. The task is
+    shielded from its callers: one of them being cancelled does not cancel the
+    lookup the others are waiting on. Successful results are then served from an
+    LRU cache for a few seconds; each kind has its own TTL and size bound, and
+    hit/miss/coalesced counters are kept per kind.
+    """
+
+    def __init__(self, ttls: Dict[str, float], max_entries: int = 1024):
+        self._ttls = ttls
+        self._max_entries = max_entries
+        self._cache: Dict[str, OrderedDict] = {kind: OrderedDict() for kind in ttls}
+        self._inflight: Dict[tuple, asyncio.Task] = {}
+        self.stats = {kind: {"hits": 0, "misses": 0, "coalesced": 0} for kind in ttls}
+
+    async def run(self, kind: str, key: Any, fetch) -> Any:
+        """Return the cached value for (kind, key), or await fetch() exactly once."""
+        cache = self._cache[kind]
+        entry = cache.get(key)
+        if entry is not None and entry[0] > time.monotonic():
+            cache.move_to_end(key)
+            self.stats[kind]["hits"] += 1
+            return entry[1]
+
+        task = self._inflight.get((kind, key))
+        if task is not None:
+            self.stats[kind]["coalesced"] += 1
+        else:
+            self.stats[kind]["misses"] += 1
+            task = asyncio.ensure_future(self._fetch(kind, key, fetch))
+            # Mark a failure as retrieved when every caller has been cancelled
+            task.add_done_callback(lambda t: t.cancelled() or t.exception())
+            self._inflight[(kind, key)] = task
+        return await asyncio.shield(task)
+
+    async def _fetch(self, kind: str, key: Any, fetch) -> Any:
+        try:
+            value = await fetch()
+        finally:
+            del self._inflight[(kind, key)]
+        cache = self._cache[kind]
+        cache[key] = (time.monotonic() + self._ttls[kind], value)
+        cache.move_to_end(key)
+        while len(cache) > self._max_entries:
+            cache.popitem(last=False)
+        return value
+
+    def invalidate(self, kind: str, key: Any = None) -> None:
+        """Drop one cached key, or the whole kind when key is None."""
+        if key is None:
+            self._cache[kind].clear()
+        else:
+            self._cache[kind].pop(key, None)
+
+    def invalidate_values(self, kind: str, stale) -> None:
+        """Drop every cached entry of a kind whose value stale(value) flags."""
+        cache = self._cache[kind]
+        for key in [key for key, (_, value) in cache.items() if stale(value)]:
+            del cache[key]
+
+
+request_coalescer = RequestCoalescer(
+    {"entity": 30.0, "dialogs": 5.0, "full_user": 60.0, "full_chat": 60.0}
+)
+
+
+# Requests named like this never change a peer's entity or full info, so they
+# leave the coalescer's caches alone; every other request invalidates its peers
+_CACHE_NEUTRAL_PREFIXES = (
+    "Get",
+    "Search",
+    "Check",
+    "Resolve",
+    "Read",
+    "Send",
+    "Forward",
+    "SetTyping",
+    "Save",
+    "Upload",
+    "Ping",
+    "Invoke",
+    "Init",
+)
+# Request fields that name the peers a mutating request acts on
+_PEER_FIELDS = (
+    "peer",
+    "channel",
+    "chat_id",
+    "user_id",
+    "id",
+    "users",
+    "participant",
+    "bot",
+    "folder_peers",
+)
+
+
+def _request_peer_ids(request) -> set:
+    """Marked peer ids a request refers to through _PEER_FIELDS."""
+    peer_ids = set()
+    for field in _PEER_FIELDS:
+        value = getattr(request, field, None)
+        for item in value if isinstance(value, list) else [value]:
+            if field == "chat_id" and isinstance(item, int):
+                item = PeerChat(item)
+            # InputNotifyPeer, InputFolderPeer and InputDialogPeer wrap the peer
+            while isinstance(getattr(item, "peer", None), TLObject):
+                item = item.peer
+            if not isinstance(item, TLObject):
+                continue  # Message ids and other plain values
+            try:
+                peer_ids.add(utils.get_peer_id(item))
+            except (TypeError, ValueError, AttributeError):
+                pass
+    return peer_ids
+
+
+def invalidate_request_peers(request) -> None:
+    """Forget cached entities, full info and dialogs a mutating request may have changed."""
+    requests = request if isinstance(request, list) else [request]
+    for item in requests:
+        if type(item).__name__.startswith(_CACHE_NEUTRAL_PREFIXES):
+            continue
+        peer_ids = _request_peer_ids(item)
+        if not peer_ids:
+            continue
+        request_coalescer.invalidate_values(
+            "entity", lambda entity: _entity_peer_id(entity) in peer_ids
+        )
+        for peer_id in peer_ids:
+            request_coalescer.invalidate("full_user", peer_id)
+            request_coalescer.invalidate("full_chat", peer_id)
+        request_coalescer.invalidate("dialogs")
+
+
+def _entity_peer_id(entity) -> Optional[int]:
+    try:
+        return utils.get_peer_id(entity)
+    except (TypeError, ValueError):
+        return None
+
+
+def _full_info_key(request) -> Optional[tuple]:
+    """Coalescing key for GetFull* requests, or None if the request is not cacheable."""
+    try:
+        if isinstance(request, functions.users.GetFullUserRequest):
+            return "full_user", utils.get_peer_id(request.id)
+        if isinstance(request, functions.channels.GetFullChannelRequest):
+            return "full_chat", utils.get_peer_id(request.channel)
+        if isinstance(request, functions.messages.GetFullChatRequest):
+            return "full_chat", utils.get_peer_id(PeerChat(request.chat_id))
+    except (TypeError, ValueError):
+        pass
+    return None
+
+
+# Upper bounds (seconds) of the latency histogram buckets
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+class _Histogram:
+    def __init__(self, buckets: tuple):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, q: float) -> float:
+        """Estimate a quantile by interpolating inside its bucket, as Prometheus does."""
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for i, n in enumerate(self.counts):
+            if seen + n >= rank and n:
+                if i == len(self.buckets):
+                    return self.buckets[-1]
+                lower = self.buckets[i - 1] if i else 0.0
+                return lower + (self.buckets[i] - lower) * (rank - seen) / n
+            seen += n
+        return self.buckets[-1]
+
+
+class MetricsRegistry:
+    """
+    Process-wide counters and latency histograms, keyed by metric name and labels.
+
+    Rendered as JSON or in the Prometheus text format by get_server_stats.
+    """
+
+    def __init__(self, buckets: tuple = LATENCY_BUCKETS):
+        self._buckets = buckets
+        self._help: Dict[str, str] = {}
+        self._counters: Dict[str, Dict[tuple, float]] = defaultdict(lambda: defaultdict(float))
+        self._histograms: Dict[str, Dict[tuple, _Histogram]] = defaultdict(dict)
+
+    def describe(self, name: str, help_text: str) -> None:
+        self._help[name] = help_text
+
+    def inc(self, name: str, value: float = 1, **labels) -> None:
+        self._counters[name][tuple(sorted(labels.items()))] += value
+
+    def observe(self, name: str, value: float, **labels) -> None:
+        series = self._histograms[name]
+        key = tuple(sorted(labels.items()))
+        if key not in series:
+            series[key] = _Histogram(self._buckets)
+        series[key].observe(value)
+
+    def snapshot(self) -> Dict[str, Any]:
+        def label_text(key):
+            return ",".join(f"{k}={v}" for k, v in key) or "total"
+
+        result: Dict[str, Any] = {}
+        for name, series in self._counters.items():
+            result[name] = {label_text(key): value for key, value in series.items()}
+        for name, series in self._histograms.items():
+            result[name] = {
+                label_text(key): {
+                    "count": h.count,
+                    "mean": h.sum / h.count if h.count else 0.0,
+                    "p50": h.quantile(0.5),
+                    "p99": h.quantile(0.99),
+                }
+                for key, h in series.items()
+            }
+        return result
+
+    def render_prometheus(self) -> str:
+        def labels_text(key, extra=()):
+            pairs = [f'{k}="{str(v)}"' for k, v in (*key, *extra)]
+            return "{" + ",".join(pairs) + "}" if pairs else ""
+
+        lines = []
+        for name, series in self._counters.items():
+            lines.append(f"# HELP {name} {self._help.get(name, name)}")
+            lines.append(f"# TYPE {name} counter")
+            lines += [f"{name}{labels_text(key)} {value}" for key, value in series.items()]
+        for name, series in self._histograms.items():
+            lines.append(f"# HELP {name} {self._help.get(name, name)}")
+            lines.append(f"# TYPE {name} histogram")
+            for key, h in series.items():
+                cumulative = 0
+                for bound, n in zip((*h.buckets, "+Inf"), h.counts):
+                    cumulative += n
+                    lines.append(f"{name}_bucket{labels_text(key, (('le', bound),))} {cumulative}")
+                lines.append(f"{name}_sum{labels_text(key)} {h.sum}")
+                lines.append(f"{name}_count{labels_text(key)} {h.count}")
+        return "".join(line + "\n" for line in lines)
+
+
+metrics = MetricsRegistry()
+metrics.describe("telegram_mcp_tool_calls_total", "MCP tool calls")
+metrics.describe(
+    "telegram_mcp_tool_errors_total", "MCP tool calls that failed, by exception class"
+)
+metrics.describe("telegram_mcp_tool_latency_seconds", "MCP tool call latency")
+metrics.describe("telegram_rpc_requests_total", "Telegram RPCs sent, by request type")
+metrics.describe("telegram_rpc_errors_total", "Telegram RPCs that failed, by exception class")
+metrics.describe(
+    "telegram_rpc_latency_seconds", "Telegram RPC latency, including rate-limit queueing"
+)
+metrics.describe("telegram_flood_waits_total", "FloodWait errors received")
+metrics.describe(
+    "telegram_flood_wait_seconds_total", "Seconds Telegram asked us to wait in FloodWaits"
+)
+
+
+# Default time budget for one RPC, including queueing and sleeping off FloodWaits
+RPC_DEADLINE = float(os.getenv("TELEGRAM_RPC_DEADLINE", "60"))
+
+# When requests queue up for the same RPC family, lower priorities are sent first
+PRIORITY_INTERACTIVE = 0
+PRIORITY_BULK = 10
+PRIORITY_BACKGROUND = 20
+
+_rpc_deadline: contextvars.ContextVar[Optional[float]] = contextvars.ContextVar(
+    "rpc_deadline", default=None
+)
+_rpc_priority: contextvars.ContextVar[int] = contextvars.ContextVar(
+    "rpc_priority", default=PRIORITY_INTERACTIVE
+)
+
+
+@contextlib.contextmanager
+def rpc_context(deadline: Optional[float] = None, priority: Optional[int] = None):
+    """
+    Run the enclosed RPCs under a shared deadline and/or queue priority.
+
+    Args:
+        deadline: Seconds from now that every RPC in the block must finish within.
+        priority: Queue priority for the block, e.g. PRIORITY_BULK for loops.
+    """
+    tokens = []
+    if deadline is not None:
+        tokens.append((_rpc_deadline, _rpc_deadline.set(time.monotonic() + deadline)))
+    if priority is not None:
+        tokens.append((_rpc_priority, _rpc_priority.set(priority)))
+    try:
+        yield
+    finally:
+        for var, token in reversed(tokens):
+            var.reset(token)
+
+
+class RateLimitExceeded(Exception):
+    """An RPC could not be sent within its deadline because of rate limiting."""
+
+    def __init__(self, family: str, seconds: float):
+        super().__init__(f"{family} requests are rate limited for another {seconds:.0f}s")
+        self.family = family
+        self.seconds = seconds
+
+
+class _TokenBucket:
+    """Token bucket for one RPC family, plus the heap of callers waiting on it."""
+
+    def __init__(self, rate: float, burst: int):
+        self.base_rate = rate
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+        self.waiters: List[tuple] = []
+        self.cond = asyncio.Condition()
+
+    def delay(self, cost: int, now: float) -> float:
+        """Seconds until `cost` tokens are available and no FloodWait is pending."""
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        missing = max(0.0, cost - self.tokens)
+        return max(self.blocked_until - now, missing / self.rate, 0.0)
+
+    def flood_wait(self, seconds: int) -> None:
+        # Telegram told us exactly how long to back off; also slow down afterwards
+        self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+        self.rate = max(self.base_rate / 16, self.rate / 2)
+        self.tokens = 0.0
+
+    def success(self) -> None:
+        self.rate = min(self.base_rate, self.rate + self.base_rate / 20)
+
+
+# Lookups that Telegram rate-limits far more aggressively than ordinary requests
+_RESOLVE_REQUESTS = (
+    functions.contacts.ResolveUsernameRequest,
+    functions.contacts.ResolvePhoneRequest,
+    functions.contacts.SearchRequest,
+    functions.users.GetUsersRequest,
+    functions.users.GetFullUserRequest,
+    functions.channels.GetChannelsRequest,
+    functions.channels.GetFullChannelRequest,
+    functions.messages.GetChatsRequest,
+    functions.messages.GetFullChatRequest,
+)
+
+
+class RpcScheduler:
+    """
+    Central pacing for every RPC the client sends.
+
+    Requests are grouped into families (resolve, messages, contacts, participants,
+    channels and default), each with its own token bucket. Callers waiting on a family are served
+    by priority, then in arrival order. A FloodWait pauses the whole family for as
+    long as Telegram asks and halves its rate, which then recovers with each
+    successful call. The failed call is retried transparently if the wait still fits
+    in its deadline; otherwise the FloodWaitError reaches the caller.
+    """
+
+    def __init__(self, limits: Dict[str, tuple], default_deadline: float):
+        self.limits = dict(limits)
+        self._buckets = {family: _TokenBucket(*limit) for family, limit in limits.items()}
+        self._default_deadline = default_deadline
+        self._seq = itertools.count()
+        self.stats = {
+            family: {"calls": 0, "queued": 0, "flood_waits": 0, "flood_wait_seconds": 0}
+            for family in limits
+        }
+
+    @staticmethod
+    def family(request) -> str:
+        if isinstance(request, _RESOLVE_REQUESTS):
+            return "resolve"
+        if isinstance(request, functions.channels.GetParticipantsRequest):
+            # Member listings page quickly; sharded listings send several at once
+            return "participants"
+        family = type(request).__module__.rsplit(".", 1)[-1]
+        return family if family in ("messages", "contacts", "channels") else "default"
+
+    async def _acquire(self, family: str, cost: int, priority: int, deadline: float) -> None:
+        bucket = self._buckets[family]
+        cost = min(cost, bucket.burst)
+        entry = (priority, next(self._seq))
+        async with bucket.cond:
+            heapq.heappush(bucket.waiters, entry)
+            try:
+                while True:
+                    now = time.monotonic()
+                    wait = bucket.delay(cost, now)
+                    if bucket.waiters[0] == entry:
+                        if wait <= 0:
+                            heapq.heappop(bucket.waiters)
+                            bucket.tokens -= cost
+                            bucket.cond.notify_all()
+                            return
+                        if now + wait > deadline:
+                            raise RateLimitExceeded(family, wait)
+                        self.stats[family]["queued"] += 1
+                    else:
+                        # Not our turn; the head wakes us when it is done
+                        wait = None
+                    try:
+                        await asyncio.wait_for(bucket.cond.wait(), wait)
+                    except asyncio.TimeoutError:
+                        pass
+            except BaseException:
+                if entry in bucket.waiters:
+                    bucket.waiters.remove(entry)
+                    heapq.heapify(bucket.waiters)
+                    bucket.cond.notify_all()
+                raise
+
+    async def run(self, request, send) -> Any:
+        """Send `request` through `send()` once its family has capacity."""
+        batch = isinstance(request, list)
+        first = request[0] if batch and request else request
+        family = self.family(first)
+        cost = len(request) if batch else 1
+        deadline = _rpc_deadline.get() or time.monotonic() + self._default_deadline
+        priority = _rpc_priority.get()
+        bucket = self._buckets[family]
+        while True:
+            await self._acquire(family, cost, priority, deadline)
+            self.stats[family]["calls"] += 1
+            try:
+                result = await send()
+            except (errors.FloodWaitError, errors.FloodPremiumWaitError) as e:
+                bucket.flood_wait(e.seconds)
+                self.stats[family]["flood_waits"] += 1
+                self.stats[family]["flood_wait_seconds"] += e.seconds
+                metrics.inc("telegram_flood_waits_total", request=type(first).__name__)
+                metrics.inc(
+                    "telegram_flood_wait_seconds_total", e.seconds, request=type(first).__name__
+                )
+                logger.warning(
+                    f"FloodWait of {e.seconds}s on {type(first).__name__}; "
+                    f"pausing {family} requests"
+                )
+                if time.monotonic() + e.seconds > deadline:
+                    raise
+                continue
+            bucket.success()
+            return result
+
+
+# (rate per second, burst) for each RPC family
+rpc_scheduler = RpcScheduler(
+    {
+        "resolve": (0.5, 5),
+        "messages": (5.0, 20),
+        "contacts": (1.0, 5),
+        "participants": (10.0, 20),
+        "channels": (1.0, 5),
+        "default": (10.0, 30),
+    },
+    RPC_DEADLINE,
+)
+
+
+# Record every RPC (and tool call) to this gzip file for offline replay (empty disables)
+RECORD_PATH = os.getenv("TELEGRAM_RECORD_PATH", "")
+
+RECORDING_MAGIC = b"TGREC1"
+RECORD_RESULT, RECORD_RPC_ERROR, RECORD_TOOL_CALL = 0, 1, 2
+_RECORD_HEADER = struct.Struct("<BfII")  # kind, latency, first and second payload lengths
+_TL_VECTOR, _TL_TRUE, _TL_FALSE = 0x1CB5C415, 0x997275B5, 0xBC799737
+# File contents are never recorded: they would dwarf everything else
+_UNRECORDED_REQUESTS = (
+    functions.upload.GetFileRequest,
+    functions.upload.SaveFilePartRequest,
+    functions.upload.SaveBigFilePartRequest,
+)
+
+
+def tl_to_bytes(value) -> bytes:
+    """Serialize an RPC result the way Telegram sends it (objects, vectors and bools)."""
+    if isinstance(value, TLObject):
+        return bytes(value)
+    if value is True or value is False:
+        return struct.pack("<I", _TL_TRUE if value else _TL_FALSE)
+    if isinstance(value, list):
+        return struct.pack("<Ii", _TL_VECTOR, len(value)) + b"".join(map(tl_to_bytes, value))
+    raise TypeError(f"Cannot serialize {type(value).__name__}")
+
+
+def tl_from_bytes(data: bytes):
+    with BinaryReader(data) as reader:
+        return reader.tgread_object()
+
+
+class TrafficRecorder:
+    """
+    Appends TL requests with their results or errors, and tool calls, to a gzip file.
+
+    Each record is a (kind, latency, length, length) header followed by two
+    payloads: serialized request and result for RPCs, request and JSON error for
+    RPC errors, JSON tool name and arguments for tool calls. read_recording()
+    reads the file back; scrub_recording() rewrites it without personal data.
+    """
+
+    def __init__(self, path: str):
+        new = not os.path.exists(path) or os.path.getsize(path) == 0
+        # Appending starts a new gzip member, which readers treat as one stream
+        self._file = gzip.open(path, "ab")
+        if new:
+            self._file.write(RECORDING_MAGIC + struct.pack("<I", LAYER))
+        self._unflushed = 0
+        self.records = 0
+
+    def _write(self, kind: int, latency: float, first: bytes, second: bytes) -> None:
+        self._file.write(
+            _RECORD_HEADER.pack(kind, latency, len(first), len(second)) + first + second
+        )
+        self.records += 1
+        self._unflushed += 1
+        if self._unflushed >= 100:
+            self.flush()
+
+    def record(self, request, outcome, latency: float) -> None:
+        """Record one request with its result, or with the RPCError it raised."""
+        if isinstance(request, _UNRECORDED_REQUESTS):
+            return
+        try:
+            if isinstance(outcome, errors.RPCError):
+                error = {"code": outcome.code, "message": outcome.message}
+                self._write(RECORD_RPC_ERROR, latency, bytes(request), json.dumps(error).encode())
+            else:
+                self._write(RECORD_RESULT, latency, bytes(request), tl_to_bytes(outcome))
+        except Exception as e:
+            logger.debug(f"Not recording {type(request).__name__}: {e}")
+
+    def record_tool(self, name: str, arguments: Dict[str, Any]) -> None:
+        arguments = {
+            key: value for key, value in arguments.items() if not isinstance(value, Context)
+        }
+        try:
+            payload = json.dumps({"tool": name, "arguments": arguments}).encode()
+        except (TypeError, ValueError):
+            return
+        self._write(RECORD_TOOL_CALL, 0.0, payload, b"")
+
+    def flush(self) -> None:
+        self._file.flush()
+        self._unflushed = 0
+
+    def close(self) -> None:
+        self._file.close()
+
+
+def read_recording(path: str):
+    """
+    Yield (kind, latency, first, second) for every record in a recording.
+
+    RPC records come back as (request, result-or-RPCError) objects and tool calls
+    as (name, arguments).
+    """
+    with gzip.open(path, "rb") as f:
+        if f.read(len(RECORDING_MAGIC)) != RECORDING_MAGIC:
+            raise ValueError(f"{path} is not a traffic recording")
+        (layer,) = struct.unpack("<I", f.read(4))
+        if layer != LAYER:
+            logger.warning(
+                f"{path} was recorded with TL layer {layer}; this Telethon uses {LAYER}"
+            )
+        while True:
+            header = f.read(_RECORD_HEADER.size)
+            if len(header) < _RECORD_HEADER.size:
+                return
+            kind, latency, first_len, second_len = _RECORD_HEADER.unpack(header)
+            first, second = f.read(first_len), f.read(second_len)
+            if kind == RECORD_TOOL_CALL:
+                call = json.loads(first)
+                yield kind, latency, call["tool"], call["arguments"]
+            elif kind == RECORD_RPC_ERROR:
+                error = json.loads(second)
+                request = tl_from_bytes(first)
+                yield kind, latency, request, errors.rpc_message_to_error(
+                    RpcError(error["code"], error["message"]), request
+                )
+            else:
+                yield kind, latency, tl_from_bytes(first), tl_from_bytes(second)
+
+
+# TL string fields that hold names, text or contact details
+_SCRUBBED_FIELDS = {
+    "message",
+    "first_name",
+    "last_name",
+    "username",
+    "phone",
+    "title",
+    "about",
+    "q",
+    "caption",
+    "text",
+    "address",
+    "email",
+    "rank",
+    "post_author",
+    "vcard",
+}
+
+
+def _scrub_text(value: str) -> str:
+    """Replace letters and digits, keeping length, spacing and punctuation (so entity offsets hold)."""
+    digest = hashlib.sha256(value.encode()).digest()
+    return "".join(
+        chr(ord("a") + digest[i % len(digest)] % 26) if c.isalnum() else c
+        for i, c in enumerate(value)
+    )
+
+
+# Tool arguments (also inside lists/dicts, e.g. import_contacts) holding message
+# text, names or phone numbers. Everything else steers the tool (ids, dates,
+# formats, cursors, usernames, tokens) and is kept so a replay sends the same call.
+_SCRUBBED_ARGUMENTS = {
+    "message",
+    "text",
+    "new_text",
+    "caption",
+    "query",
+    "search_query",
+    "contact_query",
+    "first_name",
+    "last_name",
+    "phone",
+    "title",
+    "about",
+}
+
+
+def _scrub_arguments(value, key: str = None):
+    if isinstance(value, dict):
+        return {k: _scrub_arguments(v, k) for k, v in value.items()}
+    if isinstance(value, list):
+        return [_scrub_arguments(item, key) for item in value]
+    if isinstance(value, str) and key in _SCRUBBED_ARGUMENTS:
+        return _scrub_text(value)
+    return value
+
+
+def _scrub(value):
+    if isinstance(value, list):
+        return [_scrub(item) for item in value]
+    if isinstance(value, TLObject):
+        for key, field in vars(value).items():
+            if isinstance(field, str) and key in _SCRUBBED_FIELDS:
+                setattr(value, key, _scrub_text(field))
+            elif isinstance(field, (list, TLObject)):
+                _scrub(field)
+        return value
+    return value
+
+
+def scrub_recording(src: str, dst: str) -> int:
+    """
+    Copy a recording with names, usernames, phone numbers and message text replaced.
+
+    Replacements are deterministic, so equal values stay equal. Tool call
+    arguments only lose their text and personal fields; control arguments are
+    kept so the scrubbed recording replays the same calls. Returns the number
+    of records written.
+    """
+    recorder = TrafficRecorder(dst)
+    for kind, latency, first, second in read_recording(src):
+        if kind == RECORD_TOOL_CALL:
+            recorder.record_tool(first, _scrub_arguments(second))
+        else:
+            recorder.record(
+                _scrub(first), second if kind == RECORD_RPC_ERROR else _scrub(second), latency
+            )
+    recorder.close()
+    return recorder.records
+
+
+traffic_recorder = TrafficRecorder(RECORD_PATH) if RECORD_PATH else None
+if traffic_recorder is not None:
+    atexit.register(traffic_recorder.close)
+
+
+class CoalescingTelegramClient(TelegramClient):
+    """
+    TelegramClient that routes its hottest lookups through request_coalescer and
+    paces every RPC through rpc_scheduler.
+    """
+
+    def __init__(self, *args, **kwargs):
+        # rpc_scheduler sleeps off FloodWaits itself, within each call's deadline
+        kwargs.setdefault("flood_sleep_threshold", 0)
+        super().__init__(*args, **kwargs)
+
+    async def get_entity(self, entity):
+        # Only scalar ids/usernames are coalesced; lists and TL objects go straight through
+        if not isinstance(entity, (int, str)):
+            return await super().get_entity(entity)
+        fetch = super().get_entity
+        return await request_coalescer.run("entity", entity, lambda: fetch(entity))
+
+    async def get_dialogs(self, *args, **kwargs):
+        fetch = super().get_dialogs
+        try:
+            key = (args, tuple(sorted(kwargs.items())))
+            hash(key)
+        except TypeError:
+            return await fetch(*args, **kwargs)
+        return await request_coalescer.run("dialogs", key, lambda: fetch(*args, **kwargs))
+
+    async def __call__(self, request, ordered=False, flood_sleep_threshold=None):
+        call = super().__call__
+
+        async def send():
+            batch = isinstance(request, list)
+            name = type(request[0] if batch and request else request).__name__
+            metrics.inc("telegram_rpc_requests_total", len(request) if batch else 1, request=name)
+            started = time.monotonic()
+            try:
+                return await rpc_scheduler.run(
+                    request, lambda: call(request, ordered, flood_sleep_threshold)
+                )
+            except Exception as e:
+                metrics.inc("telegram_rpc_errors_total", request=name, error=type(e).__name__)
+                raise
+            finally:
+                metrics.observe(
+                    "telegram_rpc_latency_seconds", time.monotonic() - started, request=name
+                )
+
+        key = _full_info_key(request)
+        if key is None:
+            try:
+                result = await send()
+            except errors.MultiError as e:
+                # Part of the container went through, and may have changed its peers
+                invalidate_request_peers(
+                    [item for item, error in zip(request, e.exceptions) if error is None]
+                )
+                raise
+            invalidate_request_peers(request)
+            return result
+        kind, peer_id = key
+        return await request_coalescer.run(kind, peer_id, send)
+
+    async def _call(self, sender, request, ordered=False, flood_sleep_threshold=None):
+        if traffic_recorder is None:
+            return await super()._call(sender, request, ordered, flood_sleep_threshold)
+        started = time.monotonic()
+        try:
+            result = await super()._call(sender, request, ordered, flood_sleep_threshold)
+        except errors.MultiError as e:
+            latency = time.monotonic() - started
+            for item, result, error in zip(e.requests, e.results, e.exceptions):
+                traffic_recorder.record(item, error or result, latency)
+            raise
+        except errors.RPCError as e:
+            traffic_recorder.record(request, e, time.monotonic() - started)
+            raise
+        latency = time.monotonic() - started
+        if isinstance(request, list):
+            for item, item_result in zip(request, result):
+                traffic_recorder.record(item, item_result, latency)
+        else:
+            traffic_recorder.record(request, result, latency)
+        return result
+
+
+if SESSION_STRING:
+    # Use the string session if available, persisting seen entities when configured
+    if ENTITY_CACHE_PATH:
+        owner = session_owner(StringSession(SESSION_STRING))
+        session = CachedStringSession(SESSION_STRING, EntityStore(ENTITY_CACHE_PATH, owner))
+    else:
+        session = StringSession(SESSION_STRING)
+    client = CoalescingTelegramClient(session, TELEGRAM_API_ID, TELEGRAM_API_HASH)
+else:
+    # Use file-based session (entities are already persisted in the .session file)
+    client = CoalescingTelegramClient(TELEGRAM_SESSION_NAME, TELEGRAM_API_ID, TELEGRAM_API_HASH)
 
 # Error code prefix mapping for better error tracing
 ERROR_PREFIXES = {
@@ -137,9 +1276,27 @@ def log_and_format_error(
 
     # Format the additional context parameters
     context = ", ".join(f"{k}={v}" for k, v in kwargs.items())
+    metrics.inc("telegram_mcp_tool_errors_total", tool=function_name, error=type(error).__name__)
+    extra = {
+        "tool": function_name,
+        "error_code": error_code,
+        "error_type": type(error).__name__,
+        "context": {k: str(v) for k, v in kwargs.items()},
+    }
+    current = _current_tool.get()
+    if current is not None:
+        extra["latency_ms"] = round((time.monotonic() - current[1]) * 1000, 1)
+
+    if isinstance(error, (errors.FloodWaitError, errors.FloodPremiumWaitError, RateLimitExceeded)):
+        # Expected under load; no traceback, and tell the caller how long to wait
+        logger.warning(f"{function_name} rate limited ({context}): {error}", extra=extra)
+        return (
+            f"Telegram rate limit reached; retry in {math.ceil(error.seconds)} seconds "
+            f"(code: {error_code})."
+        )
 
     # Log the full technical error
-    logger.exception(f"{function_name} failed ({context}): {error}")
+    logger.exception(f"{function_name} failed ({context}): {error}", extra=extra)
 
     # Return a user-friendly message
     return f"An error occurred (code: {error_code}). Check mcp_errors.log for details."
@@ -186,54 +1343,1450 @@ def format_message(message) -> Dict[str, Any]:
     return result
 
 
+OUTPUT_FORMAT = os.getenv("TELEGRAM_OUTPUT_FORMAT", "text").lower()
+OUTPUT_FORMATS = ("text", "json", "ndjson")
+# Default character budget of list responses; 0 means unlimited
+MAX_CHARS = int(os.getenv("TELEGRAM_MAX_CHARS", "0"))
+# Seconds the unsent rest of a budgeted response stays available to get_continuation
+CONTINUATION_TTL = float(os.getenv("TELEGRAM_CONTINUATION_TTL", "600"))
+# Set by the HTTP wrappers so continuation tokens can be routed back to this worker
+WORKER_INDEX = os.getenv("MCP_WORKER_INDEX", "0")
+
+
+def truncate_text(text: str, limit: int) -> str:
+    """Shorten `text` to about `limit` characters, at a word boundary, noting how much was cut."""
+    if len(text) <= limit:
+        return text
+    cut = text.rfind(" ", int(limit * 0.8), limit)
+    if cut == -1:
+        cut = limit
+    return f"{text[:cut].rstrip()}… [+{len(text) - cut} chars]"
+
+
+def media_placeholder(media) -> str:
+    """A short stand-in for a media object or its to_dict(), e.g. '[photo]'."""
+    kind = media.get("_", "") if isinstance(media, dict) else type(media).__name__
+    return f"[{kind.removeprefix('MessageMedia').lower() or 'media'}]"
+
+
+def shorten(value, limit: int):
+    """Truncate long strings and replace media and raw bytes with placeholders, recursively."""
+    if isinstance(value, str):
+        return truncate_text(value, limit)
+    if isinstance(value, bytes):
+        return f"[{len(value)} bytes]"
+    if isinstance(value, dict):
+        if str(value.get("_", "")).startswith("MessageMedia"):
+            return media_placeholder(value)
+        return {key: shorten(item, limit) for key, item in value.items()}
+    if isinstance(value, list):
+        return [shorten(item, limit) for item in value]
+    return value
+
+
+def shorten_item(item, limit: int):
+    """A copy of a message with long text truncated and media-only text replaced by a placeholder."""
+    if not isinstance(item, Message):
+        return item
+    text = item.message or ""
+    if len(text) <= limit and (text or not item.media):
+        return item
+    item = copy.copy(item)
+    item.message = truncate_text(text, limit) if text else media_placeholder(item.media)
+    return item
+
+
+class ContinuationStore:
+    """
+    The unsent rest of budgeted responses, kept in memory so a continuation is
+    rendered from results already fetched instead of repeating the request.
+
+    Tokens start with the worker index, which the HTTP wrappers use to send
+    get_continuation back to the worker holding the rest.
+    """
+
+    def __init__(self, ttl: float, max_entries: int = 256):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._entries: OrderedDict = OrderedDict()  # token -> (stored at, render kwargs)
+
+    def new_token(self) -> str:
+        return f"{WORKER_INDEX}.{secrets.token_urlsafe(12)}"
+
+    def put(self, token: str, state: Dict[str, Any]) -> None:
+        self._expire()
+        self._entries[token] = (time.monotonic(), state)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def get(self, token: str) -> Optional[Dict[str, Any]]:
+        """The render arguments for the rest of a response, or None if unknown or expired."""
+        self._expire()
+        entry = self._entries.get(token)
+        return dict(entry[1]) if entry else None
+
+    def discard(self, token: str) -> None:
+        self._entries.pop(token, None)
+
+    def _expire(self) -> None:
+        now = time.monotonic()
+        while self._entries and now - next(iter(self._entries.values()))[0] > self.ttl:
+            self._entries.popitem(last=False)
+
+
+continuation_store = ContinuationStore(CONTINUATION_TTL)
+
+
+def project(record: Dict[str, Any], fields: Union[list, str, None]) -> Dict[str, Any]:
+    """Keep only `fields` (a list or comma-separated string) of a record, in that order."""
+    if not fields:
+        return record
+    if isinstance(fields, str):
+        fields = [f.strip() for f in fields.split(",") if f.strip()]
+    return {name: record[name] for name in fields if name in record}
+
+
+def render(
+    items: list,
+    to_record,
+    text=None,
+    output_format: str = None,
+    fields: Union[list, str, None] = None,
+    empty: str = None,
+    max_chars: int = None,
+    max_items: int = None,
+    source=None,
+    **meta,
+) -> str:
+    """
+    Render a tool's results in the requested output format, within a size budget.
+
+    'text' is the tool's own human-readable output; 'json' is one compact object,
+    {"items": [...], **meta}; 'ndjson' is one compact record per line followed by
+    a line holding the meta values, if any. With `fields`, records are projected
+    and the text format lists the remaining keys of each record.
+
+    With max_chars, long text is shortened and media-only messages show a
+    placeholder. When not every item fits, the output ends with a `continuation`
+    token instead of the meta values; get_continuation renders the rest from the
+    results already fetched, and the last part carries the meta values.
+
+    Args:
+        items: The objects to render (messages, entities, ...).
+        to_record: Turns one item into a dict, e.g. format_message.
+        text: Turns all items into the text output; defaults to the records as indented JSON.
+        output_format: 'text', 'json' or 'ndjson'; defaults to TELEGRAM_OUTPUT_FORMAT.
+        fields: Only include these record keys.
+        empty: Text output when there are no items.
+        max_chars: Character budget for the output; defaults to TELEGRAM_MAX_CHARS (0 is unlimited).
+        max_items: Most items to include.
+        source: Async iterator of further pages of items still being fetched (see take_pages);
+            the response then always ends with a continuation that resumes it.
+        **meta: Values such as next_cursor that describe the whole result; None is left out.
+    """
+    output_format = (output_format or OUTPUT_FORMAT).lower()
+    if output_format not in OUTPUT_FORMATS:
+        return f"Unknown output_format '{output_format}'. Use one of: {', '.join(OUTPUT_FORMATS)}."
+    meta = {key: value for key, value in meta.items() if value is not None}
+    if max_chars is None:
+        max_chars = MAX_CHARS
+    if not max_chars and not max_items and source is None:
+        return _render_page(items, to_record, text, output_format, fields, empty, meta)
+
+    return _render_budgeted(
+        list(items),
+        to_record,
+        text,
+        output_format,
+        fields,
+        empty,
+        meta,
+        max_chars,
+        max_items,
+        source,
+    )
+
+
+def _render_budgeted(
+    items, to_record, text, output_format, fields, empty, meta, max_chars, max_items, source
+) -> str:
+    """
+    The first part of a budgeted response; the items that did not fit are kept
+    under the continuation token it ends with.
+    """
+    if max_chars:
+        # Leave room for several items rather than letting one long message take it all
+        limit = max(80, max_chars // 10)
+        shown = [shorten_item(item, limit) for item in items]
+
+        def record(item):
+            return shorten(to_record(item), limit)
+
+    else:
+        shown, record = items, to_record
+    token = continuation_store.new_token()
+
+    def page(count):
+        if count >= len(shown) and source is None:
+            return _render_page(shown, record, text, output_format, fields, empty, meta)
+        return _render_page(
+            shown[:count], record, text, output_format, fields, empty, {"continuation": token}
+        )
+
+    count = _fitting_count(page, min(len(shown), max_items or len(shown)), max_chars)
+    if count < len(shown) or source is not None:
+        continuation_store.put(
+            token,
+            dict(
+                items=items[count:],
+                to_record=to_record,
+                text=text,
+                output_format=output_format,
+                fields=fields,
+                max_chars=max_chars,
+                max_items=max_items,
+                source=source,
+                **meta,
+            ),
+        )
+    return page(count)
+
+
+def _fitting_count(page, count: int, max_chars: int) -> int:
+    """
+    The most items, up to `count`, whose page(n) fits in max_chars; always at
+    least one so every part of a response makes progress.
+    """
+    if not max_chars or len(page(count)) <= max_chars:
+        return count
+    low, high, count = 1, count - 1, 1
+    while low <= high:
+        middle = (low + high) // 2
+        if len(page(middle)) <= max_chars:
+            count, low = middle, middle + 1
+        else:
+            high = middle - 1
+    return count
+
+
+async def take_pages(source, items: list, max_chars: int = None, max_items: int = None, ctx=None):
+    """
+    Pull pages from the async iterator `source` into `items` until a response
+    with this budget is full or the source runs out.
+
+    Returns:
+        The source if it may have more pages, or None once it is exhausted.
+    """
+    if max_chars is None:
+        max_chars = MAX_CHARS
+    size = sum(len(str(item)) for item in items) if max_chars else 0
+    while not (max_items and len(items) > max_items) and not (max_chars and size > max_chars):
+        try:
+            page = await source.__anext__()
+        except StopAsyncIteration:
+            return None
+        items.extend(page)
+        if max_chars:
+            size += sum(len(str(item)) for item in page)
+        if ctx is not None:
+            await ctx.report_progress(len(items))
+    return source
+
+
+def _render_page(items, to_record, text, output_format, fields, empty, meta) -> str:
+    """Render `items` and `meta` in one output format, without any budget."""
+    if output_format == "text":
+        if not items and empty is not None:
+            return empty
+        if fields:
+            records = [project(to_record(item), fields) for item in items]
+            lines = [", ".join(f"{k}: {v}" for k, v in record.items()) for record in records]
+        elif text is not None:
+            lines = [text(items)]
+        else:
+            lines = [
+                json.dumps([to_record(item) for item in items], indent=2, default=json_serializer)
+            ]
+        lines.extend(f"{key}: {value}" for key, value in meta.items())
+        return "\n".join(lines)
+
+    records = [project(to_record(item), fields) for item in items]
+    if output_format == "json":
+        return json.dumps(
+            {"items": records, **meta}, separators=(",", ":"), default=json_serializer
+        )
+    lines = [json.dumps(r, separators=(",", ":"), default=json_serializer) for r in records]
+    if meta:
+        lines.append(json.dumps(meta, separators=(",", ":"), default=json_serializer))
+    return "\n".join(lines)
+
+
+def render_one(
+    record: Dict[str, Any],
+    text: str = None,
+    output_format: str = None,
+    fields: Union[list, str, None] = None,
+) -> str:
+    """
+    Render a single-object result (a user, a chat) like render does a list; the
+    text format is `text`, or the record as indented JSON without it.
+    """
+    output_format = (output_format or OUTPUT_FORMAT).lower()
+    if output_format not in OUTPUT_FORMATS:
+        return f"Unknown output_format '{output_format}'. Use one of: {', '.join(OUTPUT_FORMATS)}."
+    record = project(record, fields)
+    if output_format == "text":
+        if fields:
+            return "\n".join(f"{k}: {v}" for k, v in record.items())
+        return text if text is not None else json.dumps(record, indent=2, default=json_serializer)
+    return json.dumps(record, separators=(",", ":"), default=json_serializer)
+
+
+def encode_cursor(chat_id: int, offset_id: int) -> str:
+    """Encode an opaque pagination cursor that resumes below message `offset_id`."""
+    raw = json.dumps({"c": chat_id, "o": offset_id}, separators=(",", ":")).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+
+def decode_cursor(cursor: str, chat_id: int) -> int:
+    """
+    Decode a cursor produced by encode_cursor and return its offset_id.
+
+    Raises:
+        ValueError: If the cursor is malformed or was issued for a different chat.
+    """
+    try:
+        data = json.loads(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))
+        cursor_chat_id, offset_id = data["c"], int(data["o"])
+    except (ValueError, KeyError, TypeError):
+        raise ValueError("Invalid cursor.")
+    if cursor_chat_id != chat_id:
+        raise ValueError(f"Cursor was issued for chat {cursor_chat_id}, not {chat_id}.")
+    return offset_id
+
+
+def get_entity_type(entity) -> str:
+    """Classify an entity as 'user', 'group' or 'channel' (supergroups count as groups)."""
+    if isinstance(entity, User):
+        return "user"
+    if isinstance(entity, Channel) and getattr(entity, "broadcast", False):
+        return "channel"
+    return "group"
+
+
+class DialogIndex:
+    """
+    Process-wide, in-memory index of the account's dialogs.
+
+    The index is built with a single get_dialogs() sweep at startup and then kept
+    current from Telethon update events (new messages, reads, pins, archiving and
+    leaving chats), so tools can look a dialog up by peer id in O(1) or read a page
+    of the dialog list without a full MTProto round trip per call.
+
+    Dialog order mirrors Telegram's: pinned dialogs first (the main list's pins,
+    then the archive's, each in their pinned order), then everything else by most
+    recent activity.
+    """
+
+    def __init__(self):
+        self._dialogs: Dict[int, Dialog] = {}  # marked peer id -> Dialog
+        self._by_type: Dict[str, Dict[int, Dialog]] = {"user": {}, "group": {}, "channel": {}}
+        self._pinned: List[int] = []
+        self._recent: "OrderedDict[int, None]" = OrderedDict()  # unpinned, newest first
+        self._lock = asyncio.Lock()
+        self.ready = False
+
+    def __len__(self) -> int:
+        return len(self._dialogs)
+
+    async def build(self) -> None:
+        """(Re)build the index from a full get_dialogs() sweep."""
+        async with self._lock:
+            dialogs = await client.get_dialogs()
+            self._dialogs.clear()
+            for by_id in self._by_type.values():
+                by_id.clear()
+            self._pinned.clear()
+            self._recent.clear()
+            for dialog in dialogs:
+                self._add(dialog, newest=False)
+            self.ready = True
+
+    async def ensure_ready(self) -> None:
+        """Build the index on first use if startup did not build it already."""
+        if not self.ready:
+            await self.build()
+
+    def get(self, peer_id: int) -> Optional[Dialog]:
+        """Look up a dialog by marked peer id (as returned by utils.get_peer_id)."""
+        return self._dialogs.get(peer_id)
+
+    def get_by_type(self, entity_type: str, entity_id: int) -> Optional[Dialog]:
+        """Look up a dialog by entity type ('user', 'group', 'channel') and bare entity id."""
+        return self._by_type.get(entity_type, {}).get(entity_id)
+
+    def page(self, start: int, size: int) -> List[Dialog]:
+        """Return `size` dialogs starting at `start`, in Telegram's dialog order."""
+        order = itertools.chain(self._pinned, self._recent)
+        return [self._dialogs[peer_id] for peer_id in itertools.islice(order, start, start + size)]
+
+    def _add(self, dialog: Dialog, newest: bool = True) -> None:
+        self._remove(dialog.id)
+        self._dialogs[dialog.id] = dialog
+        self._by_type[get_entity_type(dialog.entity)][dialog.entity.id] = dialog
+        if dialog.pinned:
+            self._pinned.append(dialog.id)
+        else:
+            self._recent[dialog.id] = None
+            if newest:
+                self._recent.move_to_end(dialog.id, last=False)
+
+    def _remove(self, peer_id: int) -> None:
+        dialog = self._dialogs.pop(peer_id, None)
+        if dialog is None:
+            return
+        self._by_type[get_entity_type(dialog.entity)].pop(dialog.entity.id, None)
+        self._recent.pop(peer_id, None)
+        if peer_id in self._pinned:
+            self._pinned.remove(peer_id)
+
+    def _folder(self, peer_id: int) -> int:
+        return self._dialogs[peer_id].folder_id or 0
+
+    def _set_pinned(self, dialog: Dialog, pinned: bool) -> None:
+        if dialog.pinned == pinned:
+            return
+        dialog.pinned = pinned
+        if pinned:
+            self._recent.pop(dialog.id, None)
+            # New pins go first within their folder; main-list pins stay ahead of the archive's
+            folder = dialog.folder_id or 0
+            at = next(
+                (i for i, p in enumerate(self._pinned) if self._folder(p) >= folder),
+                len(self._pinned),
+            )
+            self._pinned.insert(at, dialog.id)
+        else:
+            self._pinned.remove(dialog.id)
+            self._recent[dialog.id] = None
+            self._recent.move_to_end(dialog.id, last=False)
+
+    async def _fetch_dialog(self, peer) -> Optional[Dialog]:
+        """Fetch a single dialog we have not seen yet (e.g. a brand new chat)."""
+        input_peer = await client.get_input_entity(peer)
+        result = await client(
+            functions.messages.GetPeerDialogsRequest(peers=[InputDialogPeer(peer=input_peer)])
+        )
+        entities = {utils.get_peer_id(x): x for x in itertools.chain(result.users, result.chats)}
+        messages = {}
+        for m in result.messages:
+            m._finish_init(client, entities, None)
+            messages[utils.get_peer_id(m.peer_id)] = m
+        for d in result.dialogs:
+            if utils.get_peer_id(d.peer) in entities:
+                dialog = Dialog(client, d, entities, messages.get(utils.get_peer_id(d.peer)))
+                self._add(dialog)
+                return dialog
+        return None
+
+    async def on_new_message(self, message) -> None:
+        if not self.ready:
+            return
+        dialog = self._dialogs.get(message.chat_id)
+        if dialog is None:
+            await self._fetch_dialog(message.peer_id)
+            return
+        dialog.message = message
+        dialog.date = message.date
+        if not message.out:
+            dialog.unread_count += 1
+        if not dialog.pinned:
+            self._recent.move_to_end(dialog.id, last=False)
+
+    def on_read(self, peer_id: int, max_id: int) -> None:
+        dialog = self._dialogs.get(peer_id)
+        # Telegram only tells us the read horizon; if it covers the last message the
+        # dialog is fully read, otherwise keep the current (approximate) count.
+        if dialog is not None and dialog.message is not None and max_id >= dialog.message.id:
+            dialog.unread_count = 0
+
+    def on_pinned(self, peer, pinned: bool) -> None:
+        dialog = self._dialogs.get(utils.get_peer_id(peer))
+        if dialog is not None:
+            self._set_pinned(dialog, pinned)
+
+    def on_pinned_order(self, peers: List[Any], folder_id: Optional[int] = None) -> None:
+        """Apply a folder's new pinned order; pins in other folders are left alone."""
+        folder = folder_id or 0
+        order = [utils.get_peer_id(p) for p in peers]
+        for peer_id in list(self._pinned):
+            if peer_id not in order and self._folder(peer_id) == folder:
+                self._set_pinned(self._dialogs[peer_id], False)
+        for peer_id in order:
+            dialog = self._dialogs.get(peer_id)
+            if dialog is not None:
+                self._set_pinned(dialog, True)
+        pinned = [peer_id for peer_id in order if peer_id in self._dialogs]
+        others = [peer_id for peer_id in self._pinned if peer_id not in pinned]
+        self._pinned = sorted(
+            others + pinned, key=self._folder
+        )  # Stable: keeps each folder's order
+
+    def on_folder(self, peer, folder_id: int) -> None:
+        dialog = self._dialogs.get(utils.get_peer_id(peer))
+        if dialog is not None:
+            dialog.folder_id = folder_id or None
+            dialog.archived = dialog.folder_id is not None
+            if dialog.pinned:
+                self._pinned.sort(key=self._folder)
+
+    def on_chat_changed(self, peer_id: int, entity) -> None:
+        """Drop a group or channel the account left, was removed from, or that was deleted."""
+        if (
+            isinstance(entity, (ChatForbidden, ChannelForbidden))
+            or getattr(entity, "left", False)
+            or (getattr(entity, "deactivated", False))
+        ):
+            self._remove(peer_id)
+
+
+dialog_index = DialogIndex()
+
+
+@client.on(events.NewMessage())
+async def _index_new_message(event):
+    try:
+        await dialog_index.on_new_message(event.message)
+    except Exception as e:
+        logger.warning(f"Dialog index update failed for chat {event.chat_id}: {e}")
+
+
+@client.on(events.ChatAction())
+async def _index_chat_action(event):
+    # Service messages (group created, user joined, ...) also bump the dialog.
+    if event.action_message is None:
+        return
+    try:
+        await dialog_index.on_new_message(event.action_message)
+    except Exception as e:
+        logger.warning(f"Dialog index update failed for chat {event.chat_id}: {e}")
+
+
+@client.on(events.MessageRead(inbox=True))
+async def _index_message_read(event):
+    dialog_index.on_read(event.chat_id, event.max_id)
+
+
+@client.on(
+    events.Raw(
+        types=(
+            UpdateDialogPinned,
+            UpdatePinnedDialogs,
+            UpdateFolderPeers,
+            UpdateChannel,
+            UpdateChat,
+        )
+    )
+)
+async def _index_dialog_update(update):
+    if isinstance(update, UpdateDialogPinned):
+        if isinstance(update.peer, DialogPeer):
+            dialog_index.on_pinned(update.peer.peer, bool(update.pinned))
+    elif isinstance(update, UpdatePinnedDialogs):
+        if update.order is not None:
+            dialog_index.on_pinned_order(
+                [p.peer for p in update.order if isinstance(p, DialogPeer)], update.folder_id
+            )
+    elif isinstance(update, (UpdateChannel, UpdateChat)):
+        # The changed chat rides along in the update's entities; without it there is nothing to judge
+        if isinstance(update, UpdateChannel):
+            peer_id = utils.get_peer_id(PeerChannel(update.channel_id))
+        else:
+            peer_id = utils.get_peer_id(PeerChat(update.chat_id))
+        entity = getattr(update, "_entities", {}).get(peer_id)
+        if entity is not None:
+            dialog_index.on_chat_changed(peer_id, entity)
+    else:
+        for folder_peer in update.folder_peers:
+            dialog_index.on_folder(folder_peer.peer, folder_peer.folder_id)
+
+
+# Role assigned by the HTTP wrapper's worker pool. Replicas only serve reads, so
+# they leave writing the shared message mirror to the primary.
+WORKER_ROLE = os.getenv("MCP_WORKER_ROLE", "primary")
+# Optional local message mirror with full-text search (empty path disables it)
+MIRROR_PATH = os.getenv("TELEGRAM_MIRROR_PATH", "")
+# How many messages per chat one background backfill pass pulls; passes repeat
+# (newest gaps first) until every chat's history is mirrored
+MIRROR_BACKFILL_LIMIT = int(os.getenv("TELEGRAM_MIRROR_BACKFILL", "1000"))
+
+
+class MessageMirror:
+    """
+    Local copy of message text in SQLite (WAL mode) with an FTS5 index.
+
+    The mirror is backfilled in the background with iter_messages for every dialog
+    in the dialog index and kept live from NewMessage/MessageEdited/MessageDeleted
+    events, so search_mirror can query all mirrored chats locally in milliseconds
+    instead of one server round trip per chat.
+
+    Backfill progress is persisted per chat: `backfill` holds the newest message
+    id the backfill has accounted for, and `backfill_gaps` the id ranges below it
+    that are not mirrored yet. Each pass pulls up to MIRROR_BACKFILL_LIMIT
+    messages per chat from its newest gaps, so long histories fill in over
+    several passes and a restart resumes where the last one stopped.
+    """
+
+    def __init__(self, path: str):
+        self._conn = sqlite3.connect(path)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.executescript("""
+            CREATE TABLE IF NOT EXISTS messages (
+                chat_id INTEGER NOT NULL,
+                id INTEGER NOT NULL,
+                date INTEGER NOT NULL,
+                sender_id INTEGER,
+                text TEXT NOT NULL,
+                PRIMARY KEY (chat_id, id)
+            );
+            CREATE TABLE IF NOT EXISTS chats (
+                chat_id INTEGER PRIMARY KEY,
+                title TEXT
+            );
+            CREATE TABLE IF NOT EXISTS backfill (
+                chat_id INTEGER PRIMARY KEY,
+                newest_id INTEGER NOT NULL
+            );
+            -- Messages with min_id < id < max_id still to be backfilled
+            CREATE TABLE IF NOT EXISTS backfill_gaps (
+                chat_id INTEGER NOT NULL,
+                min_id INTEGER NOT NULL,
+                max_id INTEGER NOT NULL,
+                PRIMARY KEY (chat_id, max_id)
+            );
+            CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts
+                USING fts5(text, content='messages', content_rowid='rowid');
+            CREATE TRIGGER IF NOT EXISTS messages_ai AFTER INSERT ON messages BEGIN
+                INSERT INTO messages_fts (rowid, text) VALUES (new.rowid, new.text);
+            END;
+            CREATE TRIGGER IF NOT EXISTS messages_ad AFTER DELETE ON messages BEGIN
+                INSERT INTO messages_fts (messages_fts, rowid, text)
+                    VALUES ('delete', old.rowid, old.text);
+            END;
+            CREATE TRIGGER IF NOT EXISTS messages_au AFTER UPDATE ON messages BEGIN
+                INSERT INTO messages_fts (messages_fts, rowid, text)
+                    VALUES ('delete', old.rowid, old.text);
+                INSERT INTO messages_fts (rowid, text) VALUES (new.rowid, new.text);
+            END;
+            """)
+        self._conn.commit()
+        self._backfill_task: Optional[asyncio.Task] = None
+
+    @staticmethod
+    def _row(message) -> Optional[tuple]:
+        if not message.message:
+            return None  # Nothing to index (media without caption, service messages)
+        sender_id = utils.get_peer_id(message.from_id) if message.from_id else None
+        return (
+            message.chat_id,
+            message.id,
+            int(message.date.timestamp()),
+            sender_id,
+            message.message,
+        )
+
+    def store(self, messages: List[Any]) -> int:
+        """Insert or update messages; returns how many had text to index."""
+        rows, emptied = [], []
+        for message in messages:
+            row = self._row(message)
+            if row:
+                rows.append(row)
+            else:
+                emptied.append((message.chat_id, message.id))
+        if rows:
+            self._conn.executemany(
+                "INSERT INTO messages (chat_id, id, date, sender_id, text) VALUES (?, ?, ?, ?, ?) "
+                "ON CONFLICT (chat_id, id) DO UPDATE SET "
+                "date = excluded.date, sender_id = excluded.sender_id, text = excluded.text",
+                rows,
+            )
+        if emptied:
+            # An edit that removed the text (caption cleared) must not stay searchable
+            self._conn.executemany("DELETE FROM messages WHERE chat_id = ? AND id = ?", emptied)
+        if rows or emptied:
+            self._conn.commit()
+        return len(rows)
+
+    def set_titles(self, titles: List[tuple], replace: bool = True) -> None:
+        """Record (chat_id, title) pairs shown in search results; replace=False keeps known ones."""
+        self._conn.executemany(
+            "INSERT INTO chats (chat_id, title) VALUES (?, ?) ON CONFLICT (chat_id) "
+            + ("DO UPDATE SET title = excluded.title" if replace else "DO NOTHING"),
+            titles,
+        )
+        self._conn.commit()
+
+    def delete(self, chat_id: Optional[int], message_ids: List[int]) -> None:
+        """Delete messages; without a chat_id (private chats and basic groups) ids are account-wide."""
+        if chat_id is not None:
+            self._conn.executemany(
+                "DELETE FROM messages WHERE chat_id = ? AND id = ?",
+                [(chat_id, message_id) for message_id in message_ids],
+            )
+        else:
+            # Only channel message ids are per-chat; everything else shares one id space
+            self._conn.executemany(
+                "DELETE FROM messages WHERE id = ? AND chat_id > -1000000000000",
+                [(message_id,) for message_id in message_ids],
+            )
+        self._conn.commit()
+
+    def search(self, query: str, chat_id: Optional[int] = None, limit: int = 20) -> List[tuple]:
+        """Run an FTS5 query; returns (chat_id, id, date, title, snippet) ranked by bm25."""
+        sql = (
+            "SELECT m.chat_id, m.id, m.date, c.title, "
+            "snippet(messages_fts, 0, '[', ']', '...', 12) "
+            "FROM messages_fts JOIN messages m ON m.rowid = messages_fts.rowid "
+            "LEFT JOIN chats c ON c.chat_id = m.chat_id "
+            "WHERE messages_fts MATCH ?"
+        )
+        params: List[Any] = [query]
+        if chat_id is not None:
+            sql += " AND m.chat_id = ?"
+            params.append(chat_id)
+        sql += " ORDER BY bm25(messages_fts) LIMIT ?"
+        params.append(limit)
+        return self._conn.execute(sql, params).fetchall()
+
+    def start_backfill(self) -> None:
+        if self._backfill_task is None or self._backfill_task.done():
+            self._backfill_task = asyncio.create_task(self.backfill())
+
+    async def backfill(self) -> None:
+        """Mirror every indexed dialog's history, newest first, in passes until no gaps remain."""
+        # Lowest queue priority, so tool calls never wait behind the backfill
+        _rpc_priority.set(PRIORITY_BACKGROUND)
+        await dialog_index.ensure_ready()
+        pending = dialog_index.page(0, len(dialog_index))
+        self.set_titles([(dialog.id, dialog.name) for dialog in pending])
+        for dialog in pending:
+            self._open_gap(dialog)
+        self._conn.commit()
+        while pending:
+            remaining = []
+            for dialog in pending:
+                try:
+                    if await self._backfill_chat(dialog, MIRROR_BACKFILL_LIMIT):
+                        remaining.append(dialog)
+                except Exception as e:
+                    logger.warning(f"Mirror backfill failed for chat {dialog.id}: {e}")
+            pending = remaining
+
+    def _open_gap(self, dialog) -> None:
+        """Record the messages newer than the chat's backfill watermark as a gap."""
+        top_id = dialog.message.id if dialog.message is not None else 0
+        row = self._conn.execute(
+            "SELECT newest_id FROM backfill WHERE chat_id = ?", (dialog.id,)
+        ).fetchone()
+        newest_id = row[0] if row else 0
+        if top_id > newest_id:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO backfill_gaps (chat_id, min_id, max_id) VALUES (?, ?, ?)",
+                (dialog.id, newest_id, top_id + 1),
+            )
+            self._conn.execute(
+                "INSERT OR REPLACE INTO backfill (chat_id, newest_id) VALUES (?, ?)",
+                (dialog.id, top_id),
+            )
+
+    async def _backfill_chat(self, dialog, budget: int) -> bool:
+        """Fill up to `budget` messages of a chat's newest gaps; True if gaps remain."""
+        gaps = self._conn.execute(
+            "SELECT min_id, max_id FROM backfill_gaps WHERE chat_id = ? ORDER BY max_id DESC",
+            (dialog.id,),
+        ).fetchall()
+        for min_id, max_id in gaps:
+            if budget <= 0:
+                return True
+            batch, fetched, oldest_id = [], 0, max_id
+            async for message in client.iter_messages(
+                dialog.input_entity, limit=budget, offset_id=max_id, min_id=min_id
+            ):
+                fetched += 1
+                oldest_id = message.id
+                batch.append(message)
+                if len(batch) >= 100:
+                    self.store(batch)
+                    batch = []
+            self.store(batch)
+            self._conn.execute(
+                "DELETE FROM backfill_gaps WHERE chat_id = ? AND max_id = ?", (dialog.id, max_id)
+            )
+            if fetched >= budget:
+                # Stopped by the budget: what lies below the oldest message is still missing
+                self._conn.execute(
+                    "INSERT OR REPLACE INTO backfill_gaps (chat_id, min_id, max_id) VALUES (?, ?, ?)",
+                    (dialog.id, min_id, oldest_id),
+                )
+            self._conn.commit()
+            budget -= fetched
+        return bool(
+            self._conn.execute(
+                "SELECT 1 FROM backfill_gaps WHERE chat_id = ? LIMIT 1", (dialog.id,)
+            ).fetchone()
+        )
+
+
+message_mirror = MessageMirror(MIRROR_PATH) if MIRROR_PATH else None
+
+
+@client.on(events.NewMessage())
+@client.on(events.MessageEdited())
+async def _mirror_message(event):
+    if message_mirror is not None and WORKER_ROLE == "primary":
+        message_mirror.store([event.message])
+        if event.chat is not None:
+            # Chats first seen after the backfill would otherwise stay untitled in results
+            message_mirror.set_titles(
+                [(event.chat_id, utils.get_display_name(event.chat))], replace=False
+            )
+
+
+@client.on(events.ChatAction())
+async def _mirror_chat_action(event):
+    if message_mirror is not None and WORKER_ROLE == "primary" and event.new_title:
+        message_mirror.set_titles([(event.chat_id, event.new_title)])
+
+
+@client.on(events.MessageDeleted())
+async def _mirror_message_deleted(event):
+    if message_mirror is not None and WORKER_ROLE == "primary":
+        message_mirror.delete(event.chat_id, event.deleted_ids)
+
+
+# Live updates are pushed to MCP clients as log notifications from this logger
+UPDATES_LOGGER = "telegram.updates"
+
+
+class UpdateSubscription:
+    """One subscriber's chat filter and backlog of undelivered updates."""
+
+    def __init__(self, chat_ids: Optional[List[int]], queue_size: int):
+        self.id = secrets.token_hex(8)
+        # Bare ids, so both get_chats' ids and marked (-100...) peer ids match
+        self.chat_ids = {utils.resolve_id(int(c))[0] for c in chat_ids} if chat_ids else None
+        self.queue: asyncio.Queue = asyncio.Queue(queue_size)
+        self.dropped = 0
+        self.task: Optional[asyncio.Task] = None
+
+    def wants(self, chat_id: Optional[int]) -> bool:
+        # Updates Telegram sends without a chat (some deletions) only reach unfiltered subscribers
+        if self.chat_ids is None:
+            return True
+        return chat_id is not None and utils.resolve_id(chat_id)[0] in self.chat_ids
+
+
+class UpdateBroker:
+    """
+    Fans Telegram events out to live subscribers, so clients stop polling.
+
+    Every subscription has an optional chat filter and a bounded queue. A
+    subscriber that falls behind loses its oldest updates instead of holding
+    up delivery to everyone else.
+    """
+
+    def __init__(self, queue_size: int = 1000):
+        self._queue_size = queue_size
+        self.subscriptions: Dict[str, UpdateSubscription] = {}
+
+    def subscribe(self, chat_ids: Optional[List[int]] = None) -> UpdateSubscription:
+        subscription = UpdateSubscription(chat_ids, self._queue_size)
+        self.subscriptions[subscription.id] = subscription
+        return subscription
+
+    def unsubscribe(self, subscription_id: str) -> bool:
+        subscription = self.subscriptions.pop(subscription_id, None)
+        if subscription is None:
+            return False
+        if subscription.task is not None:
+            subscription.task.cancel()
+        return True
+
+    def publish(self, update: Dict[str, Any]) -> None:
+        for subscription in list(self.subscriptions.values()):
+            if not subscription.wants(update.get("chat_id")):
+                continue
+            if subscription.queue.full():
+                subscription.queue.get_nowait()
+                subscription.dropped += 1
+            subscription.queue.put_nowait(update)
+
+
+update_broker = UpdateBroker()
+
+
+@client.on(events.NewMessage())
+@client.on(events.MessageEdited())
+async def _publish_message(event):
+    if not update_broker.subscriptions:
+        return
+    kind = "message_edited" if isinstance(event, events.MessageEdited.Event) else "new_message"
+    update_broker.publish(
+        {"type": kind, "chat_id": event.chat_id, **format_message(event.message)}
+    )
+
+
+@client.on(events.MessageDeleted())
+async def _publish_message_deleted(event):
+    if update_broker.subscriptions:
+        update_broker.publish(
+            {"type": "message_deleted", "chat_id": event.chat_id, "message_ids": event.deleted_ids}
+        )
+
+
+@client.on(events.UserUpdate())
+async def _publish_user_update(event):
+    if not update_broker.subscriptions:
+        return
+    update = {"type": "user_update", "chat_id": event.chat_id, "user_id": event.user_id}
+    if event.status is not None:
+        update["status"] = type(event.status).__name__
+    if event.action is not None:
+        update["action"] = type(event.action).__name__
+    update_broker.publish(update)
+
+
+@client.on(events.ChatAction())
+async def _publish_chat_action(event):
+    if not update_broker.subscriptions:
+        return
+    if event.new_pin:
+        # Telethon sets `unpin` for every non-pin action, so only trust it here
+        action = "unpin" if event.unpin else "new_pin"
+    else:
+        action = next(
+            (
+                name
+                for name in (
+                    "user_joined",
+                    "user_left",
+                    "user_added",
+                    "user_kicked",
+                    "created",
+                    "new_title",
+                    "new_photo",
+                )
+                if getattr(event, name)
+            ),
+            "other",
+        )
+    update = {"type": "chat_action", "chat_id": event.chat_id, "action": action}
+    if event.user_ids:
+        update["user_ids"] = list(event.user_ids)
+    if event.new_title:
+        update["title"] = event.new_title
+    update_broker.publish(update)
+
+
+# Parallel downloads: documents at least this big are fetched over several connections
+DOWNLOAD_CONNECTIONS = int(os.getenv("TELEGRAM_DOWNLOAD_CONNECTIONS", "4"))
+PARALLEL_DOWNLOAD_MIN_SIZE = (
+    int(os.getenv("TELEGRAM_PARALLEL_DOWNLOAD_MIN_MB", "10")) * 1024 * 1024
+)
+DOWNLOAD_PART_SIZE = 1024 * 1024  # The largest part upload.getFile serves
+
+
+async def _connect_media_sender(dc_id: int) -> MTProtoSender:
+    """Open an extra authorised connection to `dc_id` for bulk file transfer."""
+    home = dc_id == client.session.dc_id
+    dc = await client._get_dc(dc_id)
+    sender = MTProtoSender(client.session.auth_key if home else None, loggers=client._log)
+    await sender.connect(
+        client._connection(
+            dc.ip_address,
+            dc.port,
+            dc.id,
+            loggers=client._log,
+            proxy=client._proxy,
+            local_addr=client._local_addr,
+        )
+    )
+    # Every new connection has to introduce itself; off the home DC it also
+    # has to import an authorisation exported from the main connection
+    init = copy.copy(client._init_request)
+    try:
+        if home:
+            init.query = functions.help.GetConfigRequest()
+        else:
+            auth = await client(functions.auth.ExportAuthorizationRequest(dc_id))
+            init.query = functions.auth.ImportAuthorizationRequest(id=auth.id, bytes=auth.bytes)
+        await sender.send(functions.InvokeWithLayerRequest(LAYER, init))
+    except BaseException:
+        await sender.disconnect()
+        raise
+    return sender
+
+
+async def _connect_media_senders(dc_id: int, count: int) -> List[MTProtoSender]:
+    """Open `count` media connections at once; if any fails, close the ones that opened."""
+    results = await asyncio.gather(
+        *(_connect_media_sender(dc_id) for _ in range(count)), return_exceptions=True
+    )
+    senders = [result for result in results if isinstance(result, MTProtoSender)]
+    failure = next((result for result in results if isinstance(result, BaseException)), None)
+    if failure is not None:
+        for sender in senders:
+            await sender.disconnect()
+        raise failure
+    return senders
+
+
+async def _send_part(sender: MTProtoSender, request):
+    """Send one file-part request on a media connection, waiting out FloodWaits and reconnects."""
+    for attempt in itertools.count():
+        try:
+            return await sender.send(request)
+        except errors.FloodWaitError as e:
+            await asyncio.sleep(e.seconds)
+        except (ConnectionError, asyncio.IncompleteReadError):
+            if attempt >= 3:
+                raise
+            await asyncio.sleep(1 + attempt)
+
+
+async def _run_part_workers(workers) -> None:
+    """Run part-transfer coroutines side by side; if one fails, stop the others before raising."""
+    tasks = [asyncio.create_task(worker) for worker in workers]
+    try:
+        await asyncio.gather(*tasks)
+    except BaseException:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        raise
+
+
+class DownloadProgress:
+    """Live progress of one download, as reported by get_download_progress."""
+
+    def __init__(self, file_path: str, size: int, connections: int):
+        self.file_path = file_path
+        self.size = size
+        self.connections = connections
+        self.done_bytes = 0
+        self.resumed_bytes = 0
+        self.started = time.monotonic()
+        self.finished: Optional[float] = None
+        self.status = "downloading"
+
+    @property
+    def throughput(self) -> float:
+        """Bytes per second fetched in this run (resumed bytes excluded)."""
+        elapsed = (self.finished or time.monotonic()) - self.started
+        return (self.done_bytes - self.resumed_bytes) / elapsed if elapsed > 0 else 0.0
+
+    def describe(self) -> str:
+        mb = 1024 * 1024
+        line = (
+            f"{self.file_path}: {self.status}, {self.done_bytes / mb:.1f}/{self.size / mb:.1f} MB "
+            f"({100 * self.done_bytes / max(self.size, 1):.0f}%), {self.throughput / mb:.2f} MB/s "
+            f"over {self.connections} connection(s)"
+        )
+        if self.status == "downloading" and self.throughput > 0:
+            line += f", ETA {(self.size - self.done_bytes) / self.throughput:.0f}s"
+        return line
+
+
+class ParallelDownloader:
+    """
+    Fetches large documents in 1 MiB parts over several connections at once.
+
+    Each connection is its own MTProtoSender to the document's DC (authorised by
+    exporting the login when that is not the home DC), the same approach
+    Telethon uses for its single borrowed sender. Parts are written at their
+    offsets into a preallocated `<file>.part`; finished part indexes are kept in a
+    `<file>.part.json` sidecar so an interrupted download resumes where it
+    stopped. The file is renamed into place once every part has arrived.
+    """
+
+    def __init__(self, connections: int, part_size: int = DOWNLOAD_PART_SIZE):
+        self._connections = max(1, connections)
+        self._part_size = part_size
+        # file path -> progress; finished downloads are kept for a while
+        self.downloads: "OrderedDict[str, DownloadProgress]" = OrderedDict()
+
+    def _track(self, progress: DownloadProgress) -> None:
+        self.downloads[progress.file_path] = progress
+        self.downloads.move_to_end(progress.file_path)
+        while len(self.downloads) > 20:
+            oldest = next(iter(self.downloads.values()))
+            if oldest.status == "downloading":
+                break
+            self.downloads.popitem(last=False)
+
+    async def download_document(self, document, file_path: str) -> DownloadProgress:
+        """Download `document` to `file_path`, resuming a previous partial attempt."""
+        size = document.size
+        parts = (size + self._part_size - 1) // self._part_size
+        data_path = file_path + ".part"
+        state_path = file_path + ".part.json"
+        done = self._load_done(document, data_path, state_path)
+        pending = [index for index in range(parts) if index not in done]
+
+        progress = DownloadProgress(file_path, size, min(self._connections, max(1, len(pending))))
+        progress.done_bytes = progress.resumed_bytes = sum(
+            min(self._part_size, size - index * self._part_size) for index in done
+        )
+        self._track(progress)
+        # An earlier attempt may have fetched every part and stopped before the rename
+        if pending:
+            await self._fetch_parts(document, data_path, state_path, pending, done, progress)
+
+        os.replace(data_path, file_path)
+        with contextlib.suppress(OSError):
+            os.remove(state_path)
+        progress.status = "done"
+        progress.finished = time.monotonic()
+        return progress
+
+    def _load_done(self, document, data_path: str, state_path: str) -> set:
+        """Part indexes an earlier attempt finished; without any, start a fresh `.part` file."""
+        done = set()
+        try:
+            with open(state_path) as f:
+                state = json.load(f)
+            if (
+                state.get("document_id") == document.id
+                and state.get("part_size") == self._part_size
+                and os.path.getsize(data_path) == document.size
+            ):
+                done = set(state["done"])
+        except (OSError, ValueError, KeyError):
+            pass
+        if not done:
+            with open(data_path, "wb") as f:
+                f.truncate(document.size)
+        return done
+
+    def _save_done(self, state_path: str, document_id: int, done: set) -> None:
+        with open(state_path + ".tmp", "w") as f:
+            json.dump(
+                {"document_id": document_id, "part_size": self._part_size, "done": sorted(done)}, f
+            )
+        os.replace(state_path + ".tmp", state_path)
+
+    async def _fetch_parts(
+        self, document, data_path: str, state_path: str, pending: list, done: set, progress
+    ) -> None:
+        """Fetch the `pending` parts into `data_path`, recording each finished one in `done`."""
+        location = InputDocumentFileLocation(
+            id=document.id,
+            access_hash=document.access_hash,
+            file_reference=document.file_reference,
+            thumb_size="",
+        )
+        queue: asyncio.Queue = asyncio.Queue()
+        for index in pending:
+            queue.put_nowait(index)
+        last_saved = time.monotonic()
+
+        def checkpoint(out) -> None:
+            nonlocal last_saved
+            if time.monotonic() - last_saved > 1:
+                out.flush()
+                self._save_done(state_path, document.id, done)
+                last_saved = time.monotonic()
+
+        senders = []
+        try:
+            with open(data_path, "r+b") as out:
+                senders = await _connect_media_senders(document.dc_id, progress.connections)
+                await _run_part_workers(
+                    self._part_worker(sender, location, queue, out, done, progress, checkpoint)
+                    for sender in senders
+                )
+        except BaseException as e:
+            progress.status = f"interrupted ({type(e).__name__}), resumable"
+            progress.finished = time.monotonic()
+            self._save_done(state_path, document.id, done)
+            raise
+        finally:
+            for sender in senders:
+                await sender.disconnect()
+
+    async def _part_worker(self, sender, location, queue, out, done, progress, checkpoint) -> None:
+        part_size = self._part_size
+        while not queue.empty():
+            index = queue.get_nowait()
+            request = functions.upload.GetFileRequest(location, index * part_size, part_size)
+            result = await _send_part(sender, request)
+            # No await between seek and write, so parts never interleave
+            out.seek(index * part_size)
+            out.write(result.bytes)
+            done.add(index)
+            progress.done_bytes += len(result.bytes)
+            checkpoint(out)
+
+
+parallel_downloader = ParallelDownloader(DOWNLOAD_CONNECTIONS)
+
+
+# Parallel uploads: files at least this big are sent as big-file parts over several connections
+UPLOAD_CONNECTIONS = int(os.getenv("TELEGRAM_UPLOAD_CONNECTIONS", "4"))
+PARALLEL_UPLOAD_MIN_SIZE = 10 * 1024 * 1024  # Telegram's threshold for SaveBigFilePart
+UPLOAD_PART_SIZE = 512 * 1024  # The largest part Telegram accepts
+# How long an uploaded-but-unsent file handle is trusted before uploading again
+UPLOAD_CACHE_TTL = float(os.getenv("TELEGRAM_UPLOAD_CACHE_TTL", "3600"))
+
+# Errors meaning a cached handle is no longer valid server-side
+_STALE_UPLOAD_ERRORS = (
+    errors.FileReferenceExpiredError,
+    errors.FileReferenceInvalidError,
+    errors.FilePartMissingError,
+    errors.FilePart0MissingError,
+    errors.MediaEmptyError,
+)
+
+
+class MediaUploader:
+    """
+    Uploads each distinct file once and reuses it afterwards.
+
+    Files are addressed by SHA-256 (rehashed only when size or mtime change).
+    The raw upload (InputFile/InputFileBig) is kept for UPLOAD_CACHE_TTL; once a
+    send has created a document or photo, later sends of the same content and
+    kind reference that InputDocument/InputPhoto and upload nothing at all. A
+    stale handle is dropped and the file uploaded again.
+
+    Files of 10 MiB and more are uploaded as big-file parts spread over several
+    connections to the home DC; smaller ones go through client.upload_file.
+    """
+
+    def __init__(self, connections: int, file_ttl: float, max_entries: int = 256):
+        self._connections = max(1, connections)
+        self._file_ttl = file_ttl
+        self._max_entries = max_entries
+        self._hashes: Dict[str, tuple] = {}  # path -> (size, mtime_ns, sha256)
+        self._files: OrderedDict = OrderedDict()  # sha256 -> (expires, InputFile)
+        self._media: OrderedDict = OrderedDict()  # (sha256, kind) -> InputDocument/InputPhoto
+        # Only live while an upload holds or waits on them, so the map never outgrows the work
+        self._locks: "weakref.WeakValueDictionary[str, asyncio.Lock]" = (
+            weakref.WeakValueDictionary()
+        )
+        self.stats = {"uploads": 0, "file_hits": 0, "media_hits": 0, "bytes_uploaded": 0}
+
+    async def _sha256(self, file_path: str) -> str:
+        stat = os.stat(file_path)
+        known = self._hashes.get(file_path)
+        if known and known[:2] == (stat.st_size, stat.st_mtime_ns):
+            return known[2]
+
+        def digest() -> str:
+            h = hashlib.sha256()
+            with open(file_path, "rb") as f:
+                for chunk in iter(lambda: f.read(1024 * 1024), b""):
+                    h.update(chunk)
+            return h.hexdigest()
+
+        sha = await asyncio.to_thread(digest)
+        self._hashes[file_path] = (stat.st_size, stat.st_mtime_ns, sha)
+        return sha
+
+    @staticmethod
+    def _remember(cache: OrderedDict, key, value, max_entries: int) -> None:
+        cache[key] = value
+        cache.move_to_end(key)
+        while len(cache) > max_entries:
+            cache.popitem(last=False)
+
+    async def _upload_parallel(self, file_path: str, size: int):
+        parts = (size + UPLOAD_PART_SIZE - 1) // UPLOAD_PART_SIZE
+        file_id = helpers.generate_random_long()
+        queue: asyncio.Queue = asyncio.Queue()
+        for index in range(parts):
+            queue.put_nowait(index)
+
+        connections = min(self._connections, parts)
+        senders = await _connect_media_senders(client.session.dc_id, connections)
+        try:
+            await _run_part_workers(
+                self._part_worker(sender, file_path, file_id, parts, queue) for sender in senders
+            )
+        finally:
+            for sender in senders:
+                await sender.disconnect()
+        return InputFileBig(id=file_id, parts=parts, name=os.path.basename(file_path))
+
+    @staticmethod
+    async def _part_worker(sender, file_path: str, file_id: int, parts: int, queue) -> None:
+        with open(file_path, "rb") as f:
+            while not queue.empty():
+                index = queue.get_nowait()
+                f.seek(index * UPLOAD_PART_SIZE)
+                request = functions.upload.SaveBigFilePartRequest(
+                    file_id, index, parts, f.read(UPLOAD_PART_SIZE)
+                )
+                await _send_part(sender, request)
+
+    async def upload(self, file_path: str, sha: Optional[str] = None):
+        """Return an uploaded InputFile/InputFileBig for `file_path`, uploading only if needed."""
+        sha = sha or await self._sha256(file_path)
+        # Concurrent sends of the same file wait for one upload instead of racing
+        async with self._locks.setdefault(sha, asyncio.Lock()):
+            cached = self._files.get(sha)
+            if cached and cached[0] > time.monotonic():
+                self.stats["file_hits"] += 1
+                return cached[1]
+            size = os.path.getsize(file_path)
+            if size >= PARALLEL_UPLOAD_MIN_SIZE:
+                uploaded = await self._upload_parallel(file_path, size)
+            else:
+                uploaded = await client.upload_file(file_path)
+            self.stats["uploads"] += 1
+            self.stats["bytes_uploaded"] += size
+            self._remember(
+                self._files, sha, (time.monotonic() + self._file_ttl, uploaded), self._max_entries
+            )
+            return uploaded
+
+    def forget(self, sha: str) -> None:
+        self._files.pop(sha, None)
+        for key in [key for key in self._media if key[0] == sha]:
+            del self._media[key]
+
+    async def send_file(self, entity, file_path: str, kind: str, **kwargs):
+        """
+        client.send_file() for a local path, reusing earlier uploads of the same content.
+
+        Args:
+            entity: Destination chat.
+            file_path: Local file to send.
+            kind: How the file is sent (e.g. "document", "voice"); media created one
+                way is only reused for sends of the same kind.
+            **kwargs: Passed through to client.send_file().
+        """
+        sha = await self._sha256(file_path)
+        media = self._media.get((sha, kind))
+        if media is not None:
+            try:
+                message = await client.send_file(entity, media, **kwargs)
+                self.stats["media_hits"] += 1
+                return message
+            except _STALE_UPLOAD_ERRORS:
+                self.forget(sha)
+        try:
+            message = await client.send_file(entity, await self.upload(file_path, sha), **kwargs)
+        except _STALE_UPLOAD_ERRORS:
+            # The cached upload expired server-side; upload once more
+            self.forget(sha)
+            message = await client.send_file(entity, await self.upload(file_path, sha), **kwargs)
+        sent = getattr(message, "document", None) or getattr(message, "photo", None)
+        if sent is not None:
+            media = (
+                utils.get_input_photo(sent)
+                if isinstance(sent, Photo)
+                else utils.get_input_document(sent)
+            )
+            self._remember(self._media, (sha, kind), media, self._max_entries)
+        return message
+
+
+media_uploader = MediaUploader(UPLOAD_CONNECTIONS, UPLOAD_CACHE_TTL)
+
+
 @mcp.tool()
-async def get_chats(page: int = 1, page_size: int = 20) -> str:
+async def get_chats(
+    page: int = 1, page_size: int = 20, output_format: str = None, fields: list = None
+) -> str:
     """
     Get a paginated list of chats.
     Args:
         page: Page number (1-indexed).
         page_size: Number of chats per page.
+        output_format: 'text', 'json' (compact) or 'ndjson'; defaults to TELEGRAM_OUTPUT_FORMAT.
+        fields: Only return these keys of each result, e.g. ["id", "text"].
     """
     try:
-        dialogs = await client.get_dialogs()
+        await dialog_index.ensure_ready()
         start = (page - 1) * page_size
-        end = start + page_size
-        if start >= len(dialogs):
-            return "Page out of range."
-        chats = dialogs[start:end]
-        lines = []
-        for dialog in chats:
-            entity = dialog.entity
-            chat_id = entity.id
-            title = getattr(entity, "title", None) or getattr(entity, "first_name", "Unknown")
-            lines.append(f"Chat ID: {chat_id}, Title: {title}")
-        return "\n".join(lines)
+        chats = dialog_index.page(start, page_size) if start < len(dialog_index) else []
+
+        def as_text(chats):
+            lines = []
+            for dialog in chats:
+                entity = dialog.entity
+                chat_id = entity.id
+                title = getattr(entity, "title", None) or getattr(entity, "first_name", "Unknown")
+                lines.append(f"Chat ID: {chat_id}, Title: {title}")
+            return "\n".join(lines)
+
+        return render(
+            chats,
+            lambda dialog: format_entity(dialog.entity),
+            as_text,
+            output_format,
+            fields,
+            empty="Page out of range.",
+        )
     except Exception as e:
         return log_and_format_error("get_chats", e)
 
 
 @mcp.tool()
-async def get_messages(chat_id: int, page: int = 1, page_size: int = 20) -> str:
+async def get_messages(
+    chat_id: int,
+    page: int = 1,
+    page_size: int = 20,
+    cursor: str = None,
+    output_format: str = None,
+    fields: list = None,
+    max_chars: int = None,
+    max_items: int = None,
+) -> str:
     """
     Get paginated messages from a specific chat.
     Args:
         chat_id: The ID of the chat.
-        page: Page number (1-indexed).
+        page: Page number (1-indexed). Ignored when cursor is given.
         page_size: Number of messages per page.
+        cursor: Opaque next_cursor from a previous response; deep pages cost the same as page 1.
+        output_format: 'text', 'json' (compact) or 'ndjson'; defaults to TELEGRAM_OUTPUT_FORMAT.
+        fields: Only return these keys of each result, e.g. ["id", "text"].
+        max_chars: Stop at about this many characters, shortening long texts; get_continuation gives the rest.
+        max_items: Stop after this many items; get_continuation gives the rest.
     """
     try:
         entity = await client.get_entity(chat_id)
-        offset = (page - 1) * page_size
-        messages = await client.get_messages(entity, limit=page_size, add_offset=offset)
-        if not messages:
-            return "No messages found for this page."
-        lines = []
-        for msg in messages:
-            lines.append(f"ID: {msg.id} | Date: {msg.date} | Message: {msg.message}")
-        return "\n".join(lines)
+        if cursor:
+            try:
+                offset_id = decode_cursor(cursor, chat_id)
+            except ValueError as cursor_err:
+                return str(cursor_err)
+            messages = await client.get_messages(entity, limit=page_size, offset_id=offset_id)
+        else:
+            offset = (page - 1) * page_size
+            messages = await client.get_messages(entity, limit=page_size, add_offset=offset)
+        next_cursor = None
+        if messages and len(messages) == page_size:
+            next_cursor = encode_cursor(chat_id, messages[-1].id)
+        return render(
+            messages,
+            format_message,
+            lambda messages: "\n".join(
+                f"ID: {msg.id} | Date: {msg.date} | Message: {msg.message}" for msg in messages
+            ),
+            output_format,
+            fields,
+            max_chars=max_chars,
+            max_items=max_items,
+            empty="No messages found for this page.",
+            next_cursor=next_cursor,
+        )
     except Exception as e:
         return log_and_format_error(
-            "get_messages", e, chat_id=chat_id, page=page, page_size=page_size
+            "get_messages", e, chat_id=chat_id, page=page, page_size=page_size, cursor=cursor
         )
 
 
@@ -253,70 +2806,183 @@ async def send_message(chat_id: int, message: str) -> str:
         return log_and_format_error("send_message", e, chat_id=chat_id)
 
 
+# Seconds a cached contact list is trusted before it is revalidated by hash
+CONTACTS_REFRESH = int(os.getenv("TELEGRAM_CONTACTS_REFRESH", "300"))
+
+
+def contacts_hash(ids, saved_count: int = 0) -> int:
+    """
+    Telegram's 64-bit vector hash of a contact list, as GetContactsRequest expects:
+    saved_count first, then the contact user ids in ascending order.
+    """
+    acc = 0
+    for user_id in [saved_count, *sorted(ids)]:
+        acc ^= acc >> 21
+        acc ^= (acc << 35) & 0xFFFFFFFFFFFFFFFF
+        acc ^= acc >> 4
+        acc = (acc + user_id) & 0xFFFFFFFFFFFFFFFF
+    return acc - (1 << 64) if acc >= 1 << 63 else acc
+
+
+class ContactsCache:
+    """
+    The account's contact list, kept in memory with its hash.
+
+    Refreshes send the hash of the cached list, so an unchanged contact book
+    comes back as ContactsNotModified instead of in full. Between refreshes
+    name and phone changes are patched in from updates; adding, deleting or
+    importing contacts (and UpdateContactsReset) only mark the list stale,
+    since the next hashed refresh is cheap either way.
+    """
+
+    def __init__(self):
+        self._users: Optional[List[User]] = None
+        self._hash = 0
+        self._saved_count = 0
+        self._checked_at = 0.0
+        self._stale = True
+        self._lock = asyncio.Lock()
+
+    async def users(self) -> List[User]:
+        """The contacts as User objects, refreshed first if stale or older than CONTACTS_REFRESH."""
+        async with self._lock:
+            if self._stale or time.monotonic() - self._checked_at >= CONTACTS_REFRESH:
+                result = await client(functions.contacts.GetContactsRequest(hash=self._hash))
+                if not isinstance(result, ContactsNotModified):
+                    self._users = [user for user in result.users if isinstance(user, User)]
+                    self._saved_count = result.saved_count
+                    self._hash = contacts_hash(
+                        (contact.user_id for contact in result.contacts), self._saved_count
+                    )
+                self._checked_at = time.monotonic()
+                self._stale = False
+            return self._users
+
+    def invalidate(self) -> None:
+        self._stale = True
+
+    def _user(self, user_id: int) -> Optional[User]:
+        return next((user for user in self._users or () if user.id == user_id), None)
+
+    def on_update(self, update) -> None:
+        if isinstance(update, UpdateContactsReset):
+            self.invalidate()
+            return
+        user = self._user(update.user_id)
+        if user is None:
+            return
+        if isinstance(update, UpdateUserPhone):
+            user.phone = update.phone
+        else:
+            user.first_name = update.first_name
+            user.last_name = update.last_name
+            user.usernames = update.usernames or None
+            user.username = next((u.username for u in update.usernames if u.editable), None)
+
+
+contacts_cache = ContactsCache()
+
+
+@client.on(events.Raw(types=(UpdateUserName, UpdateUserPhone, UpdateContactsReset)))
+async def _contacts_update(update):
+    contacts_cache.on_update(update)
+
+
 @mcp.tool()
-async def list_contacts() -> str:
+async def list_contacts(output_format: str = None, fields: list = None) -> str:
     """
     List all contacts in your Telegram account.
+
+    Args:
+        output_format: 'text', 'json' (compact) or 'ndjson'; defaults to TELEGRAM_OUTPUT_FORMAT.
+        fields: Only return these keys of each result, e.g. ["id", "text"].
     """
     try:
-        result = await client(functions.contacts.GetContactsRequest(hash=0))
-        users = result.users
-        if not users:
-            return "No contacts found."
-        lines = []
-        for user in users:
-            name = f"{getattr(user, 'first_name', '')} {getattr(user, 'last_name', '')}".strip()
-            username = getattr(user, "username", "")
-            phone = getattr(user, "phone", "")
-            contact_info = f"ID: {user.id}, Name: {name}"
-            if username:
-                contact_info += f", Username: @{username}"
-            if phone:
-                contact_info += f", Phone: {phone}"
-            lines.append(contact_info)
-        return "\n".join(lines)
+        users = await contacts_cache.users()
+
+        def as_text(users):
+            lines = []
+            for user in users:
+                name = (
+                    f"{getattr(user, 'first_name', '')} {getattr(user, 'last_name', '')}".strip()
+                )
+                username = getattr(user, "username", "")
+                phone = getattr(user, "phone", "")
+                contact_info = f"ID: {user.id}, Name: {name}"
+                if username:
+                    contact_info += f", Username: @{username}"
+                if phone:
+                    contact_info += f", Phone: {phone}"
+                lines.append(contact_info)
+            return "\n".join(lines)
+
+        return render(
+            users, format_entity, as_text, output_format, fields, empty="No contacts found."
+        )
     except Exception as e:
         return log_and_format_error("list_contacts", e)
 
 
 @mcp.tool()
-async def search_contacts(query: str) -> str:
+async def search_contacts(query: str, output_format: str = None, fields: list = None) -> str:
     """
     Search for contacts by name, username, or phone number using Telethon's SearchRequest.
     Args:
         query: The search term to look for in contact names, usernames, or phone numbers.
+        output_format: 'text', 'json' (compact) or 'ndjson'; defaults to TELEGRAM_OUTPUT_FORMAT.
+        fields: Only return these keys of each result, e.g. ["id", "text"].
     """
     try:
         result = await client(functions.contacts.SearchRequest(q=query, limit=50))
         users = result.users
-        if not users:
-            return f"No contacts found matching '{query}'."
-        lines = []
-        for user in users:
-            name = f"{getattr(user, 'first_name', '')} {getattr(user, 'last_name', '')}".strip()
-            username = getattr(user, "username", "")
-            phone = getattr(user, "phone", "")
-            contact_info = f"ID: {user.id}, Name: {name}"
-            if username:
-                contact_info += f", Username: @{username}"
-            if phone:
-                contact_info += f", Phone: {phone}"
-            lines.append(contact_info)
-        return "\n".join(lines)
+
+        def as_text(users):
+            lines = []
+            for user in users:
+                name = (
+                    f"{getattr(user, 'first_name', '')} {getattr(user, 'last_name', '')}".strip()
+                )
+                username = getattr(user, "username", "")
+                phone = getattr(user, "phone", "")
+                contact_info = f"ID: {user.id}, Name: {name}"
+                if username:
+                    contact_info += f", Username: @{username}"
+                if phone:
+                    contact_info += f", Phone: {phone}"
+                lines.append(contact_info)
+            return "\n".join(lines)
+
+        return render(
+            users,
+            format_entity,
+            as_text,
+            output_format,
+            fields,
+            empty=f"No contacts found matching '{query}'.",
+        )
     except Exception as e:
         return log_and_format_error("search_contacts", e, query=query)
 
 
 @mcp.tool()
-async def get_contact_ids() -> str:
+async def get_contact_ids(output_format: str = None, fields: list = None) -> str:
     """
     Get all contact IDs in your Telegram account.
+
+    Args:
+        output_format: 'text', 'json' (compact) or 'ndjson'; defaults to TELEGRAM_OUTPUT_FORMAT.
+        fields: Only return these keys of each result, e.g. ["id", "text"].
     """
     try:
-        result = await client(functions.contacts.GetContactIDsRequest(hash=0))
-        if not result:
-            return "No contact IDs found."
-        return "Contact IDs: " + ", ".join(str(cid) for cid in result)
+        users = await contacts_cache.users()
+        return render(
+            [user.id for user in users],
+            lambda cid: {"id": cid},
+            lambda ids: "Contact IDs: " + ", ".join(str(cid) for cid in ids),
+            output_format,
+            fields,
+            empty="No contact IDs found.",
+        )
     except Exception as e:
         return log_and_format_error("get_contact_ids", e)
 
@@ -328,6 +2994,11 @@ async def list_messages(
     search_query: str = None,
     from_date: str = None,
     to_date: str = None,
+    cursor: str = None,
+    output_format: str = None,
+    fields: list = None,
+    max_chars: int = None,
+    max_items: int = None,
 ) -> str:
     """
     Retrieve messages with optional filters.
@@ -338,10 +3009,22 @@ async def list_messages(
         search_query: Filter messages containing this text.
         from_date: Filter messages starting from this date (format: YYYY-MM-DD).
         to_date: Filter messages until this date (format: YYYY-MM-DD).
+        cursor: Opaque next_cursor from a previous response (use the same filters).
+        output_format: 'text', 'json' (compact) or 'ndjson'; defaults to TELEGRAM_OUTPUT_FORMAT.
+        fields: Only return these keys of each result, e.g. ["id", "text"].
+        max_chars: Stop at about this many characters, shortening long texts; get_continuation gives the rest.
+        max_items: Stop after this many items; get_continuation gives the rest.
     """
     try:
         entity = await client.get_entity(chat_id)
 
+        offset_id = 0
+        if cursor:
+            try:
+                offset_id = decode_cursor(cursor, chat_id)
+            except ValueError as cursor_err:
+                return str(cursor_err)
+
         # Parse date filters if provided
         from_date_obj = None
         to_date_obj = None
@@ -382,114 +3065,141 @@ async def list_messages(
         if search_query:
             params["search"] = search_query
 
-        messages = await client.get_messages(entity, limit=limit, **params)
+        # Push the date window down to Telegram: offset_date starts the newest-first
+        # scan just past the end of to_date, and iteration stops as soon as it crosses
+        # from_date. Only messages inside the window are transferred and `limit`
+        # counts matching messages.
+        if to_date_obj:
+            params["offset_date"] = to_date_obj + timedelta(microseconds=1)
+
+        messages = []
+        reached_lower_bound = False
+        async for msg in client.iter_messages(entity, limit=limit, offset_id=offset_id, **params):
+            if from_date_obj and msg.date < from_date_obj:
+                reached_lower_bound = True
+                break
+            messages.append(msg)
 
-        # Apply date filters (Telethon doesn't support date filtering in get_messages directly)
-        if from_date_obj or to_date_obj:
-            filtered_messages = []
-            for msg in messages:
-                if from_date_obj and msg.date < from_date_obj:
-                    continue
-                if to_date_obj and msg.date > to_date_obj:
-                    continue
-                filtered_messages.append(msg)
-            messages = filtered_messages
+        next_cursor = None
+        if messages and len(messages) == limit and not reached_lower_bound:
+            next_cursor = encode_cursor(chat_id, messages[-1].id)
 
-        if not messages:
-            return "No messages found matching the criteria."
+        def sender_name(msg):
+            if not msg.sender:
+                return None
+            return getattr(msg.sender, "first_name", "") or getattr(msg.sender, "title", "Unknown")
 
-        lines = []
-        for msg in messages:
-            sender = ""
-            if msg.sender:
-                sender_name = getattr(msg.sender, "first_name", "") or getattr(
-                    msg.sender, "title", "Unknown"
+        def as_text(messages):
+            lines = []
+            for msg in messages:
+                sender = f"{sender_name(msg)} | " if msg.sender else ""
+                lines.append(
+                    f"ID: {msg.id} | {sender}Date: {msg.date} | Message: {msg.message or '[Media/No text]'}"
                 )
-                sender = f"{sender_name} | "
-
-            lines.append(
-                f"ID: {msg.id} | {sender}Date: {msg.date} | Message: {msg.message or '[Media/No text]'}"
-            )
-
-        return "\n".join(lines)
+            return "\n".join(lines)
+
+        return render(
+            messages,
+            lambda msg: {**format_message(msg), "sender": sender_name(msg)},
+            as_text,
+            output_format,
+            fields,
+            max_chars=max_chars,
+            max_items=max_items,
+            empty="No messages found matching the criteria.",
+            next_cursor=next_cursor,
+        )
     except Exception as e:
-        return log_and_format_error("list_messages", e, chat_id=chat_id)
+        return log_and_format_error("list_messages", e, chat_id=chat_id, cursor=cursor)
 
 
 @mcp.tool()
-async def list_chats(chat_type: str = None, limit: int = 20) -> str:
+async def list_chats(
+    chat_type: str = None, limit: int = 20, output_format: str = None, fields: list = None
+) -> str:
     """
     List available chats with metadata.
 
     Args:
         chat_type: Filter by chat type ('user', 'group', 'channel', or None for all)
         limit: Maximum number of chats to retrieve.
+        output_format: 'text', 'json' (compact) or 'ndjson'; defaults to TELEGRAM_OUTPUT_FORMAT.
+        fields: Only return these keys of each result, e.g. ["id", "text"].
     """
     try:
-        dialogs = await client.get_dialogs(limit=limit)
-
-        results = []
-        for dialog in dialogs:
-            entity = dialog.entity
-
+        await dialog_index.ensure_ready()
+        dialogs = [
+            dialog
+            for dialog in dialog_index.page(0, limit)
             # Filter by type if requested
-            current_type = None
-            if isinstance(entity, User):
-                current_type = "user"
-            elif isinstance(entity, Chat):
-                current_type = "group"
-            elif isinstance(entity, Channel):
-                if getattr(entity, "broadcast", False):
-                    current_type = "channel"
-                else:
-                    current_type = "group"  # Supergroup
-
-            if chat_type and current_type != chat_type.lower():
-                continue
+            if not chat_type or get_entity_type(dialog.entity) == chat_type.lower()
+        ]
 
-            # Format chat info
-            chat_info = f"Chat ID: {entity.id}"
+        def to_record(dialog):
+            record = {**format_entity(dialog.entity), "type": get_entity_type(dialog.entity)}
+            if getattr(dialog.entity, "username", None):
+                record["username"] = dialog.entity.username
+            if getattr(dialog, "unread_count", 0):
+                record["unread"] = dialog.unread_count
+            return record
 
-            if hasattr(entity, "title"):
-                chat_info += f", Title: {entity.title}"
-            elif hasattr(entity, "first_name"):
-                name = f"{entity.first_name}"
-                if hasattr(entity, "last_name") and entity.last_name:
-                    name += f" {entity.last_name}"
-                chat_info += f", Name: {name}"
+        def as_text(dialogs):
+            results = []
+            for dialog in dialogs:
+                entity = dialog.entity
+                current_type = get_entity_type(entity)
 
-            chat_info += f", Type: {current_type}"
+                # Format chat info
+                chat_info = f"Chat ID: {entity.id}"
 
-            if hasattr(entity, "username") and entity.username:
-                chat_info += f", Username: @{entity.username}"
+                if hasattr(entity, "title"):
+                    chat_info += f", Title: {entity.title}"
+                elif hasattr(entity, "first_name"):
+                    name = f"{entity.first_name}"
+                    if hasattr(entity, "last_name") and entity.last_name:
+                        name += f" {entity.last_name}"
+                    chat_info += f", Name: {name}"
 
-            # Add unread count if available
-            if hasattr(dialog, "unread_count") and dialog.unread_count > 0:
-                chat_info += f", Unread: {dialog.unread_count}"
+                chat_info += f", Type: {current_type}"
 
-            results.append(chat_info)
+                if hasattr(entity, "username") and entity.username:
+                    chat_info += f", Username: @{entity.username}"
 
-        if not results:
-            return f"No chats found matching the criteria."
+                # Add unread count if available
+                if hasattr(dialog, "unread_count") and dialog.unread_count > 0:
+                    chat_info += f", Unread: {dialog.unread_count}"
 
-        return "\n".join(results)
+                results.append(chat_info)
+            return "\n".join(results)
+
+        return render(
+            dialogs,
+            to_record,
+            as_text,
+            output_format,
+            fields,
+            empty="No chats found matching the criteria.",
+        )
     except Exception as e:
         return log_and_format_error("list_chats", e, chat_type=chat_type, limit=limit)
 
 
 @mcp.tool()
-async def get_chat(chat_id: int) -> str:
+async def get_chat(chat_id: int, output_format: str = None, fields: list = None) -> str:
     """
     Get detailed information about a specific chat.
 
     Args:
         chat_id: The ID of the chat.
+        output_format: 'text', 'json' (compact) or 'ndjson'; defaults to TELEGRAM_OUTPUT_FORMAT.
+        fields: Only return these keys of each result, e.g. ["id", "text"].
     """
     try:
         entity = await client.get_entity(chat_id)
 
         result = []
         result.append(f"ID: {entity.id}")
+        record = format_entity(entity)
 
         is_channel = isinstance(entity, Channel)
         is_chat = isinstance(entity, Chat)
@@ -505,13 +3215,16 @@ async def get_chat(chat_id: int) -> str:
             elif is_chat:
                 chat_type = "Group (Basic)"
             result.append(f"Type: {chat_type}")
+            record["type"] = chat_type.split(" ")[0].lower()
             if hasattr(entity, "username") and entity.username:
                 result.append(f"Username: @{entity.username}")
+                record["username"] = entity.username
 
             # Fetch participants count reliably
             try:
                 participants_count = (await client.get_participants(entity, limit=0)).total
                 result.append(f"Participants: {participants_count}")
+                record["participants"] = participants_count
             except Exception as pe:
                 result.append(f"Participants: Error fetching ({pe})")
 
@@ -527,15 +3240,15 @@ async def get_chat(chat_id: int) -> str:
                 result.append(f"Phone: {entity.phone}")
             result.append(f"Bot: {'Yes' if entity.bot else 'No'}")
             result.append(f"Verified: {'Yes' if entity.verified else 'No'}")
+            record.update(bot=bool(entity.bot), verified=bool(entity.verified))
 
         # Get last activity if it's a dialog
         try:
-            # Using get_dialogs might be slow if there are many dialogs
-            # Alternative: Get entity again via get_dialogs if needed for unread count
-            dialog = await client.get_dialogs(limit=1, offset_id=0, offset_peer=entity)
+            await dialog_index.ensure_ready()
+            dialog = dialog_index.get(utils.get_peer_id(entity))
             if dialog:
-                dialog = dialog[0]
                 result.append(f"Unread Messages: {dialog.unread_count}")
+                record["unread"] = dialog.unread_count
                 if dialog.message:
                     last_msg = dialog.message
                     sender_name = "Unknown"
@@ -548,27 +3261,31 @@ async def get_chat(chat_id: int) -> str:
                     sender_name = sender_name.strip() or "Unknown"
                     result.append(f"Last Message: From {sender_name} at {last_msg.date}")
                     result.append(f"Message: {last_msg.message or '[Media/No text]'}")
+                    record["last_message"] = {**format_message(last_msg), "sender": sender_name}
         except Exception as diag_ex:
             logger.warning(f"Could not get dialog info for {chat_id}: {diag_ex}")
             pass
 
-        return "\n".join(result)
+        return render_one(record, "\n".join(result), output_format, fields)
     except Exception as e:
         return log_and_format_error("get_chat", e, chat_id=chat_id)
 
 
 @mcp.tool()
-async def get_direct_chat_by_contact(contact_query: str) -> str:
+async def get_direct_chat_by_contact(
+    contact_query: str, output_format: str = None, fields: list = None
+) -> str:
     """
     Find a direct chat with a specific contact by name, username, or phone.
 
     Args:
         contact_query: Name, username, or phone number to search for.
+        output_format: 'text', 'json' (compact) or 'ndjson'; defaults to TELEGRAM_OUTPUT_FORMAT.
+        fields: Only return these keys of each result, e.g. ["id", "text"].
     """
     try:
         # Fetch all contacts using the correct Telethon method
-        result = await client(functions.contacts.GetContactsRequest(hash=0))
-        contacts = result.users
+        contacts = await contacts_cache.users()
         found_contacts = []
         for contact in contacts:
             if not contact:
@@ -587,38 +3304,51 @@ async def get_direct_chat_by_contact(contact_query: str) -> str:
         if not found_contacts:
             return f"No contacts found matching '{contact_query}'."
         # If we found contacts, look for direct chats with them
+        await dialog_index.ensure_ready()
         results = []
-        dialogs = await client.get_dialogs()
         for contact in found_contacts:
-            contact_name = (
-                f"{getattr(contact, 'first_name', '')} {getattr(contact, 'last_name', '')}".strip()
-            )
-            for dialog in dialogs:
-                if isinstance(dialog.entity, User) and dialog.entity.id == contact.id:
-                    chat_info = f"Chat ID: {dialog.entity.id}, Contact: {contact_name}"
-                    if getattr(contact, "username", ""):
-                        chat_info += f", Username: @{contact.username}"
-                    if dialog.unread_count:
-                        chat_info += f", Unread: {dialog.unread_count}"
-                    results.append(chat_info)
-                    break
-        if not results:
-            found_names = ", ".join(
-                [f"{c.first_name} {c.last_name}".strip() for c in found_contacts]
-            )
-            return f"Found contacts: {found_names}, but no direct chats were found with them."
-        return "\n".join(results)
+            dialog = dialog_index.get_by_type("user", contact.id)
+            if dialog:
+                results.append((contact, dialog))
+
+        def as_text(results):
+            lines = []
+            for contact, dialog in results:
+                contact_name = f"{getattr(contact, 'first_name', '')} {getattr(contact, 'last_name', '')}".strip()
+                chat_info = f"Chat ID: {dialog.entity.id}, Contact: {contact_name}"
+                if getattr(contact, "username", ""):
+                    chat_info += f", Username: @{contact.username}"
+                if dialog.unread_count:
+                    chat_info += f", Unread: {dialog.unread_count}"
+                lines.append(chat_info)
+            return "\n".join(lines)
+
+        found_names = ", ".join(
+            [f"{c.first_name} {c.last_name or ''}".strip() for c in found_contacts]
+        )
+        return render(
+            results,
+            lambda pair: {**format_entity(pair[0]), "unread": pair[1].unread_count},
+            as_text,
+            output_format,
+            fields,
+            empty=f"Found contacts: {found_names}, but no direct chats were found with them.",
+        )
     except Exception as e:
         return log_and_format_error("get_direct_chat_by_contact", e, contact_query=contact_query)
 
 
 @mcp.tool()
-async def get_contact_chats(contact_id: int) -> str:
+async def get_contact_chats(
+    contact_id: int, output_format: str = None, fields: list = None
+) -> str:
     """
     List all chats involving a specific contact.
 
     Args:
         contact_id: The ID of the contact.
+        output_format: 'text', 'json' (compact) or 'ndjson'; defaults to TELEGRAM_OUTPUT_FORMAT.
+        fields: Only return these keys of each result, e.g. ["id", "text"].
     """
     try:
         # Get contact info
@@ -630,47 +3360,64 @@ async def get_contact_chats(contact_id: int) -> str:
             f"{getattr(contact, 'first_name', '')} {getattr(contact, 'last_name', '')}".strip()
         )
 
-        # Find direct chat
-        direct_chat = None
-        dialogs = await client.get_dialogs()
-
         results = []
 
         # Look for direct chat
-        for dialog in dialogs:
-            if isinstance(dialog.entity, User) and dialog.entity.id == contact_id:
-                chat_info = f"Direct Chat ID: {dialog.entity.id}, Type: Private"
-                if dialog.unread_count:
-                    chat_info += f", Unread: {dialog.unread_count}"
-                results.append(chat_info)
-                break
+        await dialog_index.ensure_ready()
+        dialog = dialog_index.get_by_type("user", contact.id)
+        if dialog:
+            results.append(
+                {"id": dialog.entity.id, "type": "private", "unread": dialog.unread_count}
+            )
 
         # Look for common groups/channels
-        common_chats = []
         try:
             common = await client.get_common_chats(contact)
             for chat in common:
-                chat_type = "Channel" if getattr(chat, "broadcast", False) else "Group"
-                chat_info = f"Chat ID: {chat.id}, Title: {chat.title}, Type: {chat_type}"
-                results.append(chat_info)
+                chat_type = "channel" if getattr(chat, "broadcast", False) else "group"
+                results.append({"id": chat.id, "title": chat.title, "type": chat_type})
         except:
-            results.append("Could not retrieve common groups.")
-
-        if not results:
-            return f"No chats found with {contact_name} (ID: {contact_id})."
-
-        return f"Chats with {contact_name} (ID: {contact_id}):\n" + "\n".join(results)
+            results.append({"error": "Could not retrieve common groups."})
+
+        def as_text(results):
+            lines = []
+            for chat in results:
+                if "error" in chat:
+                    lines.append(chat["error"])
+                elif chat["type"] == "private":
+                    chat_info = f"Direct Chat ID: {chat['id']}, Type: Private"
+                    if chat["unread"]:
+                        chat_info += f", Unread: {chat['unread']}"
+                    lines.append(chat_info)
+                else:
+                    lines.append(
+                        f"Chat ID: {chat['id']}, Title: {chat['title']}, Type: {chat['type'].title()}"
+                    )
+            return f"Chats with {contact_name} (ID: {contact_id}):\n" + "\n".join(lines)
+
+        return render(
+            results,
+            dict,
+            as_text,
+            output_format,
+            fields,
+            empty=f"No chats found with {contact_name} (ID: {contact_id}).",
+        )
     except Exception as e:
         return log_and_format_error("get_contact_chats", e, contact_id=contact_id)
 
 
 @mcp.tool()
-async def get_last_interaction(contact_id: int) -> str:
+async def get_last_interaction(
+    contact_id: int, output_format: str = None, fields: list = None
+) -> str:
     """
     Get the most recent message with a contact.
 
     Args:
         contact_id: The ID of the contact.
+        output_format: 'text', 'json' (compact) or 'ndjson'; defaults to TELEGRAM_OUTPUT_FORMAT.
+        fields: Only return these keys of each result, e.g. ["id", "text"].
     """
     try:
         # Get contact info
@@ -685,23 +3432,34 @@ async def get_last_interaction(contact_id: int) -> str:
         # Get the last few messages
         messages = await client.get_messages(contact, limit=5)
 
-        if not messages:
-            return f"No messages found with {contact_name} (ID: {contact_id})."
-
-        results = [f"Last interactions with {contact_name} (ID: {contact_id}):"]
-
-        for msg in messages:
-            sender = "You" if msg.out else contact_name
-            message_text = msg.message or "[Media/No text]"
-            results.append(f"Date: {msg.date}, From: {sender}, Message: {message_text}")
-
-        return "\n".join(results)
+        def as_text(messages):
+            results = [f"Last interactions with {contact_name} (ID: {contact_id}):"]
+            for msg in messages:
+                sender = "You" if msg.out else contact_name
+                message_text = msg.message or "[Media/No text]"
+                results.append(f"Date: {msg.date}, From: {sender}, Message: {message_text}")
+            return "\n".join(results)
+
+        return render(
+            messages,
+            lambda msg: {**format_message(msg), "sender": "You" if msg.out else contact_name},
+            as_text,
+            output_format,
+            fields,
+            empty=f"No messages found with {contact_name} (ID: {contact_id}).",
+        )
     except Exception as e:
         return log_and_format_error("get_last_interaction", e, contact_id=contact_id)
 
 
 @mcp.tool()
-async def get_message_context(chat_id: int, message_id: int, context_size: int = 3) -> str:
+async def get_message_context(
+    chat_id: int,
+    message_id: int,
+    context_size: int = 3,
+    output_format: str = None,
+    fields: list = None,
+) -> str:
     """
     Retrieve context around a specific message.
 
@@ -709,6 +3467,8 @@ async def get_message_context(chat_id: int, message_id: int, context_size: int =
         chat_id: The ID of the chat.
         message_id: The ID of the central message.
         context_size: Number of messages before and after to include.
+        output_format: 'text', 'json' (compact) or 'ndjson'; defaults to TELEGRAM_OUTPUT_FORMAT.
+        fields: Only return these keys of each result, e.g. ["id", "text"].
     """
     try:
         chat = await client.get_entity(chat_id)
@@ -728,18 +3488,32 @@ async def get_message_context(chat_id: int, message_id: int, context_size: int =
         # Combine messages in chronological order
         all_messages = list(messages_before) + list(central_message) + list(messages_after)
         all_messages.sort(key=lambda m: m.id)
-        results = [f"Context for message {message_id} in chat {chat_id}:"]
-        for msg in all_messages:
-            sender_name = "Unknown"
-            if msg.sender:
-                sender_name = getattr(msg.sender, "first_name", "") or getattr(
-                    msg.sender, "title", "Unknown"
+
+        def sender_name(msg):
+            if not msg.sender:
+                return "Unknown"
+            return getattr(msg.sender, "first_name", "") or getattr(msg.sender, "title", "Unknown")
+
+        def as_text(messages):
+            results = [f"Context for message {message_id} in chat {chat_id}:"]
+            for msg in messages:
+                highlight = " [THIS MESSAGE]" if msg.id == message_id else ""
+                results.append(
+                    f"ID: {msg.id} | {sender_name(msg)} | {msg.date}{highlight}\n{msg.message or '[Media/No text]'}\n"
                 )
-            highlight = " [THIS MESSAGE]" if msg.id == message_id else ""
-            results.append(
-                f"ID: {msg.id} | {sender_name} | {msg.date}{highlight}\n{msg.message or '[Media/No text]'}\n"
-            )
-        return "\n".join(results)
+            return "\n".join(results)
+
+        return render(
+            all_messages,
+            lambda msg: {
+                **format_message(msg),
+                "sender": sender_name(msg),
+                "target": msg.id == message_id,
+            },
+            as_text,
+            output_format,
+            fields,
+        )
     except Exception as e:
         return log_and_format_error(
             "get_message_context",
@@ -772,6 +3546,7 @@ async def add_contact(phone: str, first_name: str, last_name: str = "") -> str:
                 ]
             )
         )
+        contacts_cache.invalidate()
         if result.imported:
             return f"Contact {first_name} {last_name} added successfully."
         else:
@@ -791,6 +3566,7 @@ async def add_contact(phone: str, first_name: str, last_name: str = "") -> str:
                     ]
                 )
             )
+            contacts_cache.invalidate()
             if hasattr(result, "imported") and result.imported:
                 return f"Contact {first_name} {last_name} added successfully (alt method)."
             else:
@@ -813,6 +3589,7 @@ async def delete_contact(user_id: int) -> str:
     try:
         user = await client.get_entity(user_id)
         await client(functions.contacts.DeleteContactsRequest(id=[user]))
+        contacts_cache.invalidate()
         return f"Contact with user ID {user_id} deleted."
     except Exception as e:
         return log_and_format_error("delete_contact", e, user_id=user_id)
@@ -849,17 +3626,134 @@ async def unblock_user(user_id: int) -> str:
 
 
 @mcp.tool()
-async def get_me() -> str:
+async def get_me(output_format: str = None, fields: list = None) -> str:
     """
     Get your own user information.
+
+    Args:
+        output_format: 'text', 'json' (compact) or 'ndjson'; defaults to TELEGRAM_OUTPUT_FORMAT.
+        fields: Only return these keys of each result, e.g. ["id", "text"].
     """
     try:
         me = await client.get_me()
-        return json.dumps(format_entity(me), indent=2)
+        return render_one(format_entity(me), None, output_format, fields)
     except Exception as e:
         return log_and_format_error("get_me", e)
 
 
+@mcp.tool()
+async def subscribe_updates(chat_ids: list = None, ctx: Context = None) -> str:
+    """
+    Stream live updates (new, edited and deleted messages, user status and chat
+    actions) to this client instead of polling. Each update arrives as a log
+    notification from the "telegram.updates" logger whose data is a JSON object
+    with a "type" and "chat_id".
+
+    Args:
+        chat_ids: Only send updates for these chats (default: all chats).
+    """
+    try:
+        subscription = update_broker.subscribe(chat_ids)
+        session = ctx.session
+
+        async def forward() -> None:
+            try:
+                while True:
+                    update = await subscription.queue.get()
+                    await session.send_log_message(
+                        level="info", data=update, logger=UPDATES_LOGGER
+                    )
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                # The client went away; stop buffering for it
+                logger.info(f"Update subscription {subscription.id} closed: {e}")
+                update_broker.unsubscribe(subscription.id)
+
+        subscription.task = asyncio.create_task(forward())
+        scope = f"chats {', '.join(map(str, chat_ids))}" if chat_ids else "all chats"
+        return f"Subscribed to updates for {scope}. subscription_id: {subscription.id}"
+    except Exception as e:
+        return log_and_format_error("subscribe_updates", e, chat_ids=chat_ids)
+
+
+@mcp.tool()
+async def unsubscribe_updates(subscription_id: str) -> str:
+    """
+    Stop a live update stream started with subscribe_updates.
+
+    Args:
+        subscription_id: The id returned by subscribe_updates.
+    """
+    try:
+        if not update_broker.unsubscribe(subscription_id):
+            return f"No active subscription with id {subscription_id}."
+        return f"Unsubscribed {subscription_id}."
+    except Exception as e:
+        return log_and_format_error("unsubscribe_updates", e, subscription_id=subscription_id)
+
+
+@mcp.tool()
+async def get_cache_stats() -> str:
+    """
+    Get hit/miss/coalesced counters for the entity, dialog and full-info lookup caches,
+    plus upload reuse counters.
+    """
+    try:
+        return json.dumps({**request_coalescer.stats, "uploads": media_uploader.stats}, indent=2)
+    except Exception as e:
+        return log_and_format_error("get_cache_stats", e)
+
+
+@mcp.tool()
+async def get_server_stats(format: str = "json") -> str:
+    """
+    Get call counts, error counts by exception class, latency percentiles and
+    FloodWait totals for every tool and Telegram request served by this process.
+
+    Args:
+        format: "json" for a summary with p50/p99 latencies, or "prometheus" for
+            the Prometheus text exposition format.
+    """
+    try:
+        if format == "prometheus":
+            return metrics.render_prometheus()
+        return json.dumps(metrics.snapshot(), indent=2)
+    except Exception as e:
+        return log_and_format_error("get_server_stats", e, format=format)
+
+
+@mcp.tool()
+async def get_continuation(token: str, max_chars: int = None, max_items: int = None) -> str:
+    """
+    Get the rest of a response that stopped at its max_chars/max_items budget.
+    Nothing is fetched from Telegram again; tokens expire after TELEGRAM_CONTINUATION_TTL seconds.
+
+    Args:
+        token: The continuation value at the end of the previous response.
+        max_chars: Budget for this part; defaults to the original call's.
+        max_items: Item budget for this part; defaults to the original call's.
+    """
+    try:
+        state = continuation_store.get(token)
+        if state is None:
+            return "Unknown or expired continuation token; repeat the original call."
+        if max_chars is not None:
+            state["max_chars"] = max_chars
+        if max_items is not None:
+            state["max_items"] = max_items
+        if state["source"] is not None:
+            # A listing still being fetched: each token resumes it once
+            continuation_store.discard(token)
+            state["items"] = list(state["items"])
+            state["source"] = await take_pages(
+                state["source"], state["items"], state["max_chars"], state["max_items"]
+            )
+        return render(**state)
+    except Exception as e:
+        return log_and_format_error("get_continuation", e, token=token)
+
+
 @mcp.tool()
 async def create_group(title: str, user_ids: list) -> str:
     """
@@ -872,13 +3766,15 @@ async def create_group(title: str, user_ids: list) -> str:
     try:
         # Convert user IDs to entities
         users = []
-        for user_id in user_ids:
-            try:
-                user = await client.get_entity(user_id)
-                users.append(user)
-            except Exception as e:
-                logger.error(f"Failed to get entity for user ID {user_id}: {e}")
-                return f"Error: Could not find user with ID {user_id}"
+        # One budget for the whole loop, queued behind interactive lookups
+        with rpc_context(deadline=RPC_DEADLINE, priority=PRIORITY_BULK):
+            for user_id in user_ids:
+                try:
+                    user = await client.get_entity(user_id)
+                    users.append(user)
+                except Exception as e:
+                    logger.error(f"Failed to get entity for user ID {user_id}: {e}")
+                    return f"Error: Could not find user with ID {user_id}"
 
         if not users:
             return "Error: No valid users provided"
@@ -898,10 +3794,11 @@ async def create_group(title: str, user_ids: list) -> str:
                 return f"Group created with ID: {result.chat_id}"
             else:
                 # If we can't determine the chat ID directly from the result
-                # Try to find it in recent dialogs
+                # Try to find it in recent dialogs (the index picks the new group up
+                # from its "group created" service message)
                 await asyncio.sleep(1)  # Give Telegram a moment to register the new group
-                dialogs = await client.get_dialogs(limit=5)  # Get recent dialogs
-                for dialog in dialogs:
+                await dialog_index.ensure_ready()
+                for dialog in dialog_index.page(0, 5):
                     if dialog.title == title:
                         return f"Group created with ID: {dialog.id}"
 
@@ -931,12 +3828,13 @@ async def invite_to_group(group_id: int, user_ids: list) -> str:
         entity = await client.get_entity(group_id)
         users_to_add = []
 
-        for user_id in user_ids:
-            try:
-                user = await client.get_entity(user_id)
-                users_to_add.append(user)
-            except ValueError as e:
-                return f"Error: User with ID {user_id} could not be found. {e}"
+        with rpc_context(deadline=RPC_DEADLINE, priority=PRIORITY_BULK):
+            for user_id in user_ids:
+                try:
+                    user = await client.get_entity(user_id)
+                    users_to_add.append(user)
+                except ValueError as e:
+                    return f"Error: User with ID {user_id} could not be found. {e}"
 
         try:
             result = await client(
@@ -1046,20 +3944,450 @@ async def leave_chat(chat_id: int) -> str:
         return log_and_format_error("leave_chat", e, chat_id=chat_id)
 
 
+# Telegram lists at most this many members for any one participants query
+PARTICIPANTS_QUERY_CAP = 10_000
+PARTICIPANTS_PAGE_SIZE = 200
+# Search-prefix queries run at once when a channel is too big for one listing
+PARTICIPANT_SHARDS = int(os.getenv("TELEGRAM_PARTICIPANT_SHARDS", "4"))
+# Characters appended to a prefix whose query still hits the cap
+PARTICIPANT_ALPHABET = os.getenv(
+    "TELEGRAM_PARTICIPANT_ALPHABET", "abcdefghijklmnopqrstuvwxyz0123456789"
+)
+PARTICIPANT_MAX_PREFIX = 12
+
+
+class ParticipantEngine:
+    """
+    Streams a chat's members page by page instead of building one list.
+
+    Telegram stops a member listing after about 10k entries. When a query
+    reports more matches than that, it is sharded into search-prefix queries
+    ('a', 'b', ... then 'aa', 'ab', ... for any prefix still at the cap) that run
+    concurrently; members are deduplicated by user id and handed out as soon as
+    any shard finds them. Members whose names match no prefix can only come from
+    the first 10k of the unfiltered listing.
+    """
+
+    FILTERS = {
+        "members": ChannelParticipantsSearch,
+        "admins": ChannelParticipantsAdmins,
+        "banned": ChannelParticipantsKicked,
+    }
+
+    def __init__(self, shards: int, alphabet: str):
+        self.shards = max(1, shards)
+        self.alphabet = alphabet
+
+    async def stream(self, chat_id: int, kind: str = "members"):
+        """
+        Yield lists of distinct users of a chat.
+
+        Args:
+            chat_id: The group or channel ID.
+            kind: 'members', 'admins' or 'banned'.
+        """
+        # get_entity is served from the entity cache; the session's own lookup scans every row
+        entity = utils.get_input_peer(await client.get_entity(chat_id))
+        if isinstance(entity, InputPeerChannel):
+            pages = self._stream_channel(entity, kind)
+        else:
+            pages = self._stream_group(entity, kind)
+        # Closed at once when the caller stops reading, so the shards are cancelled with it
+        async with contextlib.aclosing(pages):
+            async for page in pages:
+                yield page
+
+    async def _stream_group(self, group, kind: str):
+        """Basic groups return every member in one request; there is nothing to shard."""
+        page = []
+        async for user in client.iter_participants(group, filter=self.FILTERS[kind]):
+            page.append(user)
+            if len(page) == PARTICIPANTS_PAGE_SIZE:
+                yield page
+                page = []
+        if page:
+            yield page
+
+    async def _stream_channel(self, entity, kind: str):
+        """Run the sharded prefix queries and yield each page's users not seen before."""
+        queries: asyncio.Queue = asyncio.Queue()
+        queries.put_nowait("")
+        # Bounded, so shards pause while the consumer is not reading
+        pages: asyncio.Queue = asyncio.Queue(maxsize=self.shards * 2)
+
+        async def finish():
+            await queries.join()
+            await pages.put(None)
+
+        tasks = [
+            asyncio.create_task(self._shard(entity, kind, queries, pages))
+            for _ in range(self.shards)
+        ]
+        tasks.append(asyncio.create_task(finish()))
+        seen = set()
+        try:
+            while True:
+                users = await pages.get()
+                if users is None:
+                    return
+                if isinstance(users, Exception):
+                    raise users
+                fresh = [user for user in users if user.id not in seen]
+                seen.update(user.id for user in fresh)
+                if fresh:
+                    yield fresh
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    async def _shard(self, channel, kind: str, queries: asyncio.Queue, pages: asyncio.Queue):
+        """Take prefixes off the queue until cancelled; a failure is handed to the consumer."""
+        while True:
+            prefix = await queries.get()
+            try:
+                await self._query(channel, kind, prefix, queries, pages)
+            except Exception as e:
+                await pages.put(e)
+            finally:
+                queries.task_done()
+
+    async def _query(
+        self, channel, kind: str, prefix: str, queries: asyncio.Queue, pages: asyncio.Queue
+    ):
+        """Page through one search prefix, queueing longer prefixes if it hits the cap."""
+        offset = 0
+        while True:
+            participant_filter = (
+                self.FILTERS[kind]() if kind == "admins" else self.FILTERS[kind](q=prefix)
+            )
+            result = await client(
+                functions.channels.GetParticipantsRequest(
+                    channel=channel,
+                    filter=participant_filter,
+                    offset=offset,
+                    limit=PARTICIPANTS_PAGE_SIZE,
+                    hash=0,
+                )
+            )
+            if (
+                offset == 0
+                and kind != "admins"
+                and result.count >= PARTICIPANTS_QUERY_CAP
+                and len(prefix) < PARTICIPANT_MAX_PREFIX
+            ):
+                for char in self.alphabet:
+                    queries.put_nowait(prefix + char)
+            if not result.participants:
+                return
+            await pages.put(result.users)
+            offset += len(result.participants)
+            if offset >= result.count:
+                return
+
+
+participant_engine = ParticipantEngine(PARTICIPANT_SHARDS, PARTICIPANT_ALPHABET)
+
+
+async def render_participants(
+    chat_id: int,
+    kind: str,
+    output_format: str = None,
+    fields: list = None,
+    max_chars: int = None,
+    max_items: int = None,
+    empty: str = None,
+    ctx: Context = None,
+) -> str:
+    """
+    Stream a member listing from participant_engine into a budgeted response.
+    Only as many pages are fetched as the budget needs; the rest of the listing
+    is fetched as get_continuation asks for it.
+    """
+
+    async def records():
+        async for users in participant_engine.stream(chat_id, kind):
+            yield [format_entity(user) for user in users]
+
+    items = []
+    source = await take_pages(records(), items, max_chars, max_items, ctx)
+    return render(
+        items,
+        dict,
+        lambda records: "\n".join(f"ID: {r['id']}, Name: {r['name']}" for r in records),
+        output_format,
+        fields,
+        empty=empty,
+        max_chars=max_chars,
+        max_items=max_items,
+        source=source,
+    )
+
+
+SNAPSHOT_DIR = os.getenv(
+    "TELEGRAM_SNAPSHOT_DIR", os.path.join(script_dir, "participant_snapshots")
+)
+# Telegram keeps admin log entries for about 48 hours; a longer gap needs a full listing
+ADMIN_LOG_WINDOW = 47 * 3600
+# Journal lines replayed on load before they are folded into a new id file
+SNAPSHOT_FOLD_AFTER = 1000
+# Journal lines older than this are dropped when folding
+SNAPSHOT_HISTORY = 30 * 86400
+# Admin log actions that add or remove a member
+ADMIN_LOG_JOINS = (
+    ChannelAdminLogEventActionParticipantJoin,
+    ChannelAdminLogEventActionParticipantJoinByInvite,
+    ChannelAdminLogEventActionParticipantJoinByRequest,
+)
+
+
+def diff_sorted(old, new) -> tuple:
+    """(joined, left) between two ascending id sequences, in one merge pass."""
+    joined, left = [], []
+    i = j = 0
+    while i < len(old) and j < len(new):
+        if old[i] == new[j]:
+            i += 1
+            j += 1
+        elif old[i] < new[j]:
+            left.append(old[i])
+            i += 1
+        else:
+            joined.append(new[j])
+            j += 1
+    left.extend(old[i:])
+    joined.extend(new[j:])
+    return joined, left
+
+
+class ParticipantSnapshots:
+    """
+    Per-chat member lists on disk, kept current from join/leave updates.
+
+    Each chat has three files in SNAPSHOT_DIR named after its peer id: `.ids`,
+    the member ids as a sorted array('q'); `.journal`, one JSON line per join or
+    leave; and `.json`, metadata including how many journal lines the id file
+    already reflects. Loading replays the newer lines onto the ids, and once
+    SNAPSHOT_FOLD_AFTER lines are pending they are folded into a new id file.
+    The journal doubles as the history get_participant_changes reports from.
+
+    A snapshot whose metadata says "partial" came from a listing that missed
+    members (Telegram caps each query at 10k). Listings are then never diffed,
+    as they would report members one listing caught and another missed, and
+    every join or leave update is journaled, present in the snapshot or not.
+    """
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        self._chats: Dict[int, dict] = {}  # peer id -> {"ids", "meta", "pending"}
+
+    def _path(self, peer_id: int, suffix: str) -> str:
+        return os.path.join(self.directory, f"{peer_id}{suffix}")
+
+    def _read_journal(self, peer_id: int) -> List[dict]:
+        try:
+            with open(self._path(peer_id, ".journal"), encoding="utf-8") as f:
+                return [json.loads(line) for line in f if line.strip()]
+        except OSError:
+            return []
+
+    @staticmethod
+    def _apply(ids: array, user_id: int, change: str) -> bool:
+        """Apply one join or leave to a sorted id array; False if it changes nothing."""
+        i = bisect.bisect_left(ids, user_id)
+        present = i < len(ids) and ids[i] == user_id
+        if change == "join" and not present:
+            ids.insert(i, user_id)
+            return True
+        if change == "leave" and present:
+            del ids[i]
+            return True
+        return False
+
+    def load(self, peer_id: int) -> Optional[dict]:
+        """The chat's current members and metadata, or None if it has no snapshot."""
+        chat = self._chats.get(peer_id)
+        if chat is not None:
+            return chat
+        try:
+            with open(self._path(peer_id, ".json"), encoding="utf-8") as f:
+                meta = json.load(f)
+            ids = array("q")
+            with open(self._path(peer_id, ".ids"), "rb") as f:
+                ids.frombytes(f.read())
+        except (OSError, ValueError):
+            return None
+        chat = {"ids": ids, "meta": meta, "pending": 0}
+        for entry in self._read_journal(peer_id)[meta["folded"] :]:
+            self._apply(ids, entry["user_id"], entry["change"])
+            chat["pending"] += 1
+        self._chats[peer_id] = chat
+        return chat
+
+    def save_meta(self, peer_id: int, meta: dict) -> None:
+        path = self._path(peer_id, ".json")
+        with open(path + ".tmp", "w", encoding="utf-8") as f:
+            json.dump(meta, f)
+        os.replace(path + ".tmp", path)
+
+    def _fold(self, peer_id: int, ids: array, meta: dict) -> None:
+        """Write `ids` as the new id file and mark every journal line as included."""
+        os.makedirs(self.directory, exist_ok=True)
+        path = self._path(peer_id, ".ids")
+        with open(path + ".tmp", "wb") as f:
+            ids.tofile(f)
+        os.replace(path + ".tmp", path)
+        cutoff = time.time() - SNAPSHOT_HISTORY
+        journal = [entry for entry in self._read_journal(peer_id) if entry["t"] >= cutoff]
+        path = self._path(peer_id, ".journal")
+        with open(path + ".tmp", "w", encoding="utf-8") as f:
+            f.writelines(json.dumps(entry) + "\n" for entry in journal)
+        os.replace(path + ".tmp", path)
+        meta["folded"] = len(journal)
+        self.save_meta(peer_id, meta)
+        self._chats[peer_id] = {"ids": ids, "meta": meta, "pending": 0}
+
+    def _append(self, peer_id: int, entries: List[dict]) -> None:
+        with open(self._path(peer_id, ".journal"), "a", encoding="utf-8") as f:
+            f.writelines(json.dumps(entry) + "\n" for entry in entries)
+
+    def record(
+        self, peer_id: int, changes: List[tuple], source: str, when: float = None
+    ) -> List[dict]:
+        """
+        Apply (user_id, 'join'|'leave') pairs to a chat's snapshot, journaling
+        the ones that change it. Chats without a snapshot are not tracked.
+        """
+        chat = self.load(peer_id)
+        if chat is None:
+            return []
+        when = when or time.time()
+        partial = chat["meta"].get("partial", False)
+        entries = [
+            {"t": when, "user_id": user_id, "change": change, "source": source}
+            for user_id, change in changes
+            if self._apply(chat["ids"], user_id, change) or partial
+        ]
+        if entries:
+            self._append(peer_id, entries)
+            chat["pending"] += len(entries)
+            if chat["pending"] >= SNAPSHOT_FOLD_AFTER:
+                self._fold(peer_id, chat["ids"], chat["meta"])
+        return entries
+
+    def replace(self, peer_id: int, ids: array, meta: dict) -> List[dict]:
+        """
+        Store a member listing (sorted ids), journaling how it differs from the
+        snapshot when both are complete.
+        """
+        chat = self.load(peer_id)
+        entries = []
+        if chat is not None and not meta.get("partial") and not chat["meta"].get("partial"):
+            joined, left = diff_sorted(chat["ids"], ids)
+            now = time.time()
+            entries = [
+                {"t": now, "user_id": u, "change": "join", "source": "listing"} for u in joined
+            ]
+            entries += [
+                {"t": now, "user_id": u, "change": "leave", "source": "listing"} for u in left
+            ]
+            if entries:
+                self._append(peer_id, entries)
+        self._fold(peer_id, ids, meta)
+        return entries
+
+    def history(self, peer_id: int, since: float) -> List[dict]:
+        """Journaled joins and leaves at or after `since`, oldest first."""
+        return [entry for entry in self._read_journal(peer_id) if entry["t"] >= since]
+
+
+participant_snapshots = ParticipantSnapshots(SNAPSHOT_DIR)
+
+
+@client.on(events.ChatAction())
+async def _snapshot_chat_action(event):
+    # Keep stored member snapshots current between get_participant_changes calls
+    if WORKER_ROLE != "primary":
+        return
+    if event.user_joined or event.user_added:
+        change = "join"
+    elif event.user_left or event.user_kicked:
+        change = "leave"
+    else:
+        return
+    try:
+        participant_snapshots.record(
+            event.chat_id, [(uid, change) for uid in event.user_ids], "event"
+        )
+    except Exception as e:
+        logger.exception(f"Could not update the participant snapshot of {event.chat_id}: {e}")
+
+
+async def admin_log_changes(channel, min_id: int) -> tuple:
+    """
+    Joins and leaves in a channel's admin log after event `min_id`, oldest first,
+    as ([(date, user_id, change), ...], newest event id).
+    """
+    events_filter = ChannelAdminLogEventsFilter(join=True, leave=True, invite=True, kick=True)
+    found, max_id = [], 0
+    while True:
+        result = await client(
+            functions.channels.GetAdminLogRequest(
+                channel=channel,
+                q="",
+                events_filter=events_filter,
+                max_id=max_id,
+                min_id=min_id,
+                limit=100,
+            )
+        )
+        found.extend(result.events)
+        if len(result.events) < 100:
+            break
+        max_id = min(event.id for event in result.events)
+    changes = []
+    for event in sorted(found, key=lambda event: event.id):
+        action = event.action
+        if isinstance(action, ADMIN_LOG_JOINS):
+            changes.append((event.date, event.user_id, "join"))
+        elif isinstance(action, ChannelAdminLogEventActionParticipantLeave):
+            changes.append((event.date, event.user_id, "leave"))
+        elif isinstance(action, ChannelAdminLogEventActionParticipantInvite):
+            participant = action.participant
+            user_id = getattr(participant, "user_id", None) or utils.get_peer_id(participant.peer)
+            changes.append((event.date, user_id, "join"))
+        elif isinstance(action, ChannelAdminLogEventActionParticipantToggleBan):
+            participant = action.new_participant
+            if isinstance(participant, ChannelParticipantLeft) or (
+                isinstance(participant, ChannelParticipantBanned)
+                and participant.banned_rights.view_messages
+            ):
+                changes.append((event.date, utils.get_peer_id(participant.peer), "leave"))
+    return changes, max((event.id for event in found), default=min_id)
+
+
 @mcp.tool()
-async def get_participants(chat_id: int) -> str:
+async def get_participants(
+    chat_id: int,
+    output_format: str = None,
+    fields: list = None,
+    max_chars: int = None,
+    max_items: int = None,
+    ctx: Context = None,
+) -> str:
     """
-    List all participants in a group or channel.
+    List all participants in a group or channel. Channels past Telegram's ~10k
+    listing limit are enumerated with concurrent search-prefix queries.
     Args:
         chat_id: The group or channel ID.
+        output_format: 'text', 'json' (compact) or 'ndjson'; defaults to TELEGRAM_OUTPUT_FORMAT.
+        fields: Only return these keys of each result, e.g. ["id", "text"].
+        max_chars: Stop at about this many characters, shortening long texts; get_continuation gives the rest.
+        max_items: Stop after this many items; get_continuation gives the rest.
     """
     try:
-        participants = await client.get_participants(chat_id)
-        lines = [
-            f"ID: {p.id}, Name: {getattr(p, 'first_name', '')} {getattr(p, 'last_name', '')}"
-            for p in participants
-        ]
-        return "\n".join(lines)
+        return await render_participants(
+            chat_id, "members", output_format, fields, max_chars, max_items, ctx=ctx
+        )
     except Exception as e:
         return log_and_format_error("get_participants", e, chat_id=chat_id)
 
@@ -1079,7 +4407,7 @@ async def send_file(chat_id: int, file_path: str, caption: str = None) -> str:
         if not os.access(file_path, os.R_OK):
             return f"File is not readable: {file_path}"
         entity = await client.get_entity(chat_id)
-        await client.send_file(entity, file_path, caption=caption)
+        await media_uploader.send_file(entity, file_path, "file", caption=caption)
         return f"File sent to chat {chat_id}."
     except Exception as e:
         return log_and_format_error(
@@ -1105,16 +4433,39 @@ async def download_media(chat_id: int, message_id: int, file_path: str) -> str:
         dir_path = os.path.dirname(file_path) or "."
         if not os.access(dir_path, os.W_OK):
             return f"Directory not writable: {dir_path}"
-        await client.download_media(msg, file=file_path)
-        if not os.path.isfile(file_path):
-            return f"Download failed: file not created at {file_path}"
-        return f"Media downloaded to {file_path}."
+        document = msg.document
+        if document is None or document.size < PARALLEL_DOWNLOAD_MIN_SIZE:
+            # Photos and small files are not worth the extra connections
+            await client.download_media(msg, file=file_path)
+            if not os.path.isfile(file_path):
+                return f"Download failed: file not created at {file_path}"
+            return f"Media downloaded to {file_path}."
+        try:
+            progress = await parallel_downloader.download_document(document, file_path)
+        except telethon.errors.rpcerrorlist.FileReferenceExpiredError:
+            # The reference in our copy of the message went stale; resume with a fresh one
+            msg = await client.get_messages(entity, ids=message_id)
+            progress = await parallel_downloader.download_document(msg.document, file_path)
+        return f"Media downloaded to {file_path}. {progress.describe()}"
     except Exception as e:
         return log_and_format_error(
             "download_media", e, chat_id=chat_id, message_id=message_id, file_path=file_path
         )
 
 
+@mcp.tool()
+async def get_download_progress() -> str:
+    """
+    Show progress and throughput of current and recent large downloads.
+    """
+    try:
+        if not parallel_downloader.downloads:
+            return "No downloads in progress."
+        return "\n".join(p.describe() for p in reversed(parallel_downloader.downloads.values()))
+    except Exception as e:
+        return log_and_format_error("get_download_progress", e)
+
+
 @mcp.tool()
 async def update_profile(first_name: str = None, last_name: str = None, about: str = None) -> str:
     """
@@ -1140,7 +4491,7 @@ async def set_profile_photo(file_path: str) -> str:
     """
     try:
         await client(
-            functions.photos.UploadProfilePhotoRequest(file=await client.upload_file(file_path))
+            functions.photos.UploadProfilePhotoRequest(file=await media_uploader.upload(file_path))
         )
         return "Profile photo updated."
     except Exception as e:
@@ -1298,32 +4649,40 @@ async def import_contacts(contacts: list) -> str:
             for i, c in enumerate(contacts)
         ]
         result = await client(functions.contacts.ImportContactsRequest(contacts=input_contacts))
+        contacts_cache.invalidate()
         return f"Imported {len(result.imported)} contacts."
     except Exception as e:
         return log_and_format_error("import_contacts", e, contacts=contacts)
 
 
 @mcp.tool()
-async def export_contacts() -> str:
+async def export_contacts(output_format: str = None, fields: list = None) -> str:
     """
     Export all contacts as a JSON string.
+
+    Args:
+        output_format: 'text', 'json' (compact) or 'ndjson'; defaults to TELEGRAM_OUTPUT_FORMAT.
+        fields: Only return these keys of each result, e.g. ["id", "text"].
     """
     try:
-        result = await client(functions.contacts.GetContactsRequest(hash=0))
-        users = result.users
-        return json.dumps([format_entity(u) for u in users], indent=2)
+        users = await contacts_cache.users()
+        return render(users, format_entity, None, output_format, fields)
     except Exception as e:
         return log_and_format_error("export_contacts", e)
 
 
 @mcp.tool()
-async def get_blocked_users() -> str:
+async def get_blocked_users(output_format: str = None, fields: list = None) -> str:
     """
     Get a list of blocked users.
+
+    Args:
+        output_format: 'text', 'json' (compact) or 'ndjson'; defaults to TELEGRAM_OUTPUT_FORMAT.
+        fields: Only return these keys of each result, e.g. ["id", "text"].
     """
     try:
         result = await client(functions.contacts.GetBlockedRequest(offset=0, limit=100))
-        return json.dumps([format_entity(u) for u in result.users], indent=2)
+        return render(result.users, format_entity, None, output_format, fields)
     except Exception as e:
         return log_and_format_error("get_blocked_users", e)
 
@@ -1375,7 +4734,7 @@ async def edit_chat_photo(chat_id: int, file_path: str) -> str:
             return f"Photo file not readable: {file_path}"
 
         entity = await client.get_entity(chat_id)
-        uploaded_file = await client.upload_file(file_path)
+        uploaded_file = await media_uploader.upload(file_path)
 
         if isinstance(entity, Channel):
             # For channels/supergroups, use EditPhotoRequest with InputChatUploadedPhoto
@@ -1628,42 +4987,213 @@ async def unban_user(chat_id: int, user_id: int) -> str:
         return log_and_format_error("unban_user", e, chat_id=chat_id, user_id=user_id)
 
 
-@mcp.tool()
-async def get_admins(chat_id: int) -> str:
+@mcp.tool()
+async def get_admins(
+    chat_id: int,
+    output_format: str = None,
+    fields: list = None,
+    max_chars: int = None,
+    max_items: int = None,
+    ctx: Context = None,
+) -> str:
+    """
+    Get all admins in a group or channel.
+
+    Args:
+        chat_id: The group or channel ID.
+        output_format: 'text', 'json' (compact) or 'ndjson'; defaults to TELEGRAM_OUTPUT_FORMAT.
+        fields: Only return these keys of each result, e.g. ["id", "text"].
+        max_chars: Stop at about this many characters, shortening long texts; get_continuation gives the rest.
+        max_items: Stop after this many items; get_continuation gives the rest.
+    """
+    try:
+        return await render_participants(
+            chat_id, "admins", output_format, fields, max_chars, max_items, "No admins found.", ctx
+        )
+    except Exception as e:
+        logger.exception(f"get_admins failed (chat_id={chat_id})")
+        return log_and_format_error("get_admins", e, chat_id=chat_id)
+
+
+@mcp.tool()
+async def get_banned_users(
+    chat_id: int,
+    output_format: str = None,
+    fields: list = None,
+    max_chars: int = None,
+    max_items: int = None,
+    ctx: Context = None,
+) -> str:
+    """
+    Get all banned users in a group or channel.
+
+    Args:
+        chat_id: The group or channel ID.
+        output_format: 'text', 'json' (compact) or 'ndjson'; defaults to TELEGRAM_OUTPUT_FORMAT.
+        fields: Only return these keys of each result, e.g. ["id", "text"].
+        max_chars: Stop at about this many characters, shortening long texts; get_continuation gives the rest.
+        max_items: Stop after this many items; get_continuation gives the rest.
+    """
+    try:
+        return await render_participants(
+            chat_id,
+            "banned",
+            output_format,
+            fields,
+            max_chars,
+            max_items,
+            "No banned users found.",
+            ctx,
+        )
+    except Exception as e:
+        logger.exception(f"get_banned_users failed (chat_id={chat_id})")
+        return log_and_format_error("get_banned_users", e, chat_id=chat_id)
+
+
+async def _catch_up_members(entity, chat: dict, now: float) -> bool:
     """
-    Get all admins in a group or channel.
+    Bring a channel's snapshot up to date from its admin log; False when the
+    log can't cover the gap and the members have to be listed again.
     """
+    meta = chat["meta"]
+    if not isinstance(entity, Channel) or now - meta["synced_at"] >= ADMIN_LOG_WINDOW:
+        return False
+    peer_id = utils.get_peer_id(entity)
     try:
-        # Fix: Use the correct filter type ChannelParticipantsAdmins
-        participants = await client.get_participants(chat_id, filter=ChannelParticipantsAdmins())
-        lines = [
-            f"ID: {p.id}, Name: {getattr(p, 'first_name', '')} {getattr(p, 'last_name', '')}".strip()
-            for p in participants
-        ]
-        return "\n".join(lines) if lines else "No admins found."
-    except Exception as e:
-        logger.exception(f"get_admins failed (chat_id={chat_id})")
-        return log_and_format_error("get_admins", e, chat_id=chat_id)
+        changes, last_id = await admin_log_changes(entity, meta.get("admin_log_id", 0))
+    except errors.RPCError as e:
+        # No admin rights or a log that can't be read: fall back to a listing
+        logger.info(f"Admin log unavailable for {peer_id}, listing members: {e}")
+        return False
+    for date, user_id, change in changes:
+        participant_snapshots.record(peer_id, [(user_id, change)], "admin_log", date.timestamp())
+    meta.update(admin_log_id=last_id, synced_at=now)
+    return True
+
+
+async def _list_members(entity, chat_id: int, chat: Optional[dict], now: float) -> dict:
+    """
+    List every member into a new snapshot and return its metadata. A channel
+    listing that collected fewer members than the channel reports is partial.
+    """
+    ids = array("q")
+    async for users in participant_engine.stream(chat_id, "members"):
+        ids.extend(user.id for user in users)
+    ids = array("q", sorted(set(ids)))
+    meta = {
+        "chat_id": chat_id,
+        "listed_at": now,
+        "synced_at": now,
+        "admin_log_id": chat["meta"].get("admin_log_id", 0) if chat else 0,
+        "reported_at": now,
+    }
+    if isinstance(entity, Channel):
+        full = await client(functions.channels.GetFullChannelRequest(entity))
+        count = full.full_chat.participants_count
+        if count is None:
+            # Hidden count: only a listing short of the query cap is known to be whole
+            count = len(ids) if len(ids) < PARTICIPANTS_QUERY_CAP else len(ids) + 1
+        if len(ids) < count:
+            meta.update(partial=True, count=count)
+        if not meta["admin_log_id"]:
+            # Start catching up from the newest event, not from the whole log
+            with contextlib.suppress(errors.RPCError):
+                result = await client(
+                    functions.channels.GetAdminLogRequest(
+                        channel=entity, q="", max_id=0, min_id=0, limit=1
+                    )
+                )
+                meta["admin_log_id"] = max((event.id for event in result.events), default=0)
+    participant_snapshots.replace(utils.get_peer_id(entity), ids, meta)
+    return meta
 
 
 @mcp.tool()
-async def get_banned_users(chat_id: int) -> str:
+async def get_participant_changes(
+    chat_id: int,
+    since: str = None,
+    refresh: bool = False,
+    output_format: str = None,
+    fields: list = None,
+) -> str:
     """
-    Get all banned users in a group or channel.
+    Get who joined and left a group or channel, compared with a stored member snapshot.
+    The first call takes the snapshot; later calls catch up from join/leave updates
+    and the admin log, and only list all members again when those can't cover the gap.
+
+    Args:
+        chat_id: The group or channel ID.
+        since: ISO date/time (UTC unless it has an offset) to report changes from; defaults to the previous call.
+        refresh: List all members again instead of catching up incrementally.
+        output_format: 'text', 'json' (compact) or 'ndjson'; defaults to TELEGRAM_OUTPUT_FORMAT.
+        fields: Only return these keys of each result, e.g. ["id", "text"].
     """
     try:
-        # Fix: Use the correct filter type ChannelParticipantsKicked
-        participants = await client.get_participants(
-            chat_id, filter=ChannelParticipantsKicked(q="")
-        )
-        lines = [
-            f"ID: {p.id}, Name: {getattr(p, 'first_name', '')} {getattr(p, 'last_name', '')}".strip()
-            for p in participants
+        entity = await client.get_entity(chat_id)
+        peer_id = utils.get_peer_id(entity)
+        chat = participant_snapshots.load(peer_id)
+        now = time.time()
+        if since:
+            since_dt = datetime.fromisoformat(since)
+            if since_dt.tzinfo is None:
+                since_dt = since_dt.replace(tzinfo=timezone.utc)
+            since_ts = since_dt.timestamp()
+        else:
+            since_ts = chat["meta"]["reported_at"] if chat else now
+
+        if chat is not None and not refresh and await _catch_up_members(entity, chat, now):
+            meta = chat["meta"]
+        else:
+            meta = await _list_members(entity, chat_id, chat, now)
+
+        members = len(participant_snapshots.load(peer_id)["ids"])
+        history = participant_snapshots.history(peer_id, since_ts)
+        meta["reported_at"] = now
+        participant_snapshots.save_meta(peer_id, meta)
+
+        records = [
+            {
+                "date": datetime.fromtimestamp(entry["t"], timezone.utc).isoformat(),
+                "user_id": entry["user_id"],
+                "change": entry["change"],
+                "source": entry["source"],
+            }
+            for entry in history
         ]
-        return "\n".join(lines) if lines else "No banned users found."
+
+        def text(records):
+            joined = sum(1 for r in records if r["change"] == "join")
+            lines = [f"{joined} joined, {len(records) - joined} left:"]
+            lines += [
+                f"{r['date']}: {r['user_id']} {r['change']} ({r['source']})" for r in records
+            ]
+            return "\n".join(lines)
+
+        since_iso = datetime.fromtimestamp(since_ts, timezone.utc).isoformat()
+        listed = f"{members} members"
+        if meta.get("partial"):
+            listed = (
+                f"{members} of {meta['count']} members listed (Telegram lists at most 10k per "
+                "query), so changes come from join/leave updates and the admin log only"
+            )
+        if chat is None:
+            empty = f"Snapshot taken: {listed}. Later calls report changes from now on."
+        else:
+            empty = f"No joins or leaves since {since_iso}; {listed}."
+        return render(
+            records,
+            dict,
+            text,
+            output_format,
+            fields,
+            empty=empty,
+            members=members,
+            member_count=meta.get("count") if meta.get("partial") else None,
+            since=since_iso,
+        )
     except Exception as e:
-        logger.exception(f"get_banned_users failed (chat_id={chat_id})")
-        return log_and_format_error("get_banned_users", e, chat_id=chat_id)
+        logger.exception(f"get_participant_changes failed (chat_id={chat_id})")
+        return log_and_format_error("get_participant_changes", e, chat_id=chat_id)
 
 
 @mcp.tool()
@@ -1882,7 +5412,7 @@ async def send_voice(chat_id: int, file_path: str) -> str:
         ):
             return "Voice file must be .ogg or .opus format."
         entity = await client.get_entity(chat_id)
-        await client.send_file(entity, file_path, voice_note=True)
+        await media_uploader.send_file(entity, file_path, "voice", voice_note=True)
         return f"Voice message sent to chat {chat_id}."
     except Exception as e:
         return log_and_format_error("send_voice", e, chat_id=chat_id, file_path=file_path)
@@ -2002,7 +5532,7 @@ async def upload_file(file_path: str) -> str:
             return f"File not found: {file_path}"
         if not os.access(file_path, os.R_OK):
             return f"File is not readable: {file_path}"
-        file = await client.upload_file(file_path)
+        file = await media_uploader.upload(file_path)
         return str(file)
     except Exception as e:
         return log_and_format_error("upload_file", e, file_path=file_path)
@@ -2027,26 +5557,56 @@ async def get_media_info(chat_id: int, message_id: int) -> str:
 
 
 @mcp.tool()
-async def search_public_chats(query: str) -> str:
+async def search_public_chats(query: str, output_format: str = None, fields: list = None) -> str:
     """
     Search for public chats, channels, or bots by username or title.
+
+    Args:
+        query: Username or title to search for.
+        output_format: 'text', 'json' (compact) or 'ndjson'; defaults to TELEGRAM_OUTPUT_FORMAT.
+        fields: Only return these keys of each result, e.g. ["id", "text"].
     """
     try:
         result = await client(functions.contacts.SearchRequest(q=query, limit=20))
-        return json.dumps([format_entity(u) for u in result.users], indent=2)
+        return render(result.users, format_entity, None, output_format, fields)
     except Exception as e:
         return log_and_format_error("search_public_chats", e, query=query)
 
 
 @mcp.tool()
-async def search_messages(chat_id: int, query: str, limit: int = 20) -> str:
+async def search_messages(
+    chat_id: int,
+    query: str,
+    limit: int = 20,
+    output_format: str = None,
+    fields: list = None,
+    max_chars: int = None,
+    max_items: int = None,
+) -> str:
     """
     Search for messages in a chat by text.
+
+    Args:
+        chat_id: The ID of the chat.
+        query: Text to search for.
+        limit: Maximum number of messages to return.
+        output_format: 'text', 'json' (compact) or 'ndjson'; defaults to TELEGRAM_OUTPUT_FORMAT.
+        fields: Only return these keys of each result, e.g. ["id", "text"].
+        max_chars: Stop at about this many characters, shortening long texts; get_continuation gives the rest.
+        max_items: Stop after this many items; get_continuation gives the rest.
     """
     try:
         entity = await client.get_entity(chat_id)
         messages = await client.get_messages(entity, limit=limit, search=query)
-        return "\n".join([f"ID: {m.id} | {m.date} | {m.message}" for m in messages])
+        return render(
+            messages,
+            format_message,
+            lambda messages: "\n".join([f"ID: {m.id} | {m.date} | {m.message}" for m in messages]),
+            output_format,
+            fields,
+            max_chars=max_chars,
+            max_items=max_items,
+        )
     except Exception as e:
         return log_and_format_error(
             "search_messages", e, chat_id=chat_id, query=query, limit=limit
@@ -2054,13 +5614,83 @@ async def search_messages(chat_id: int, query: str, limit: int = 20) -> str:
 
 
 @mcp.tool()
-async def resolve_username(username: str) -> str:
+async def search_mirror(
+    query: str,
+    chat_id: int = None,
+    limit: int = 20,
+    output_format: str = None,
+    fields: list = None,
+) -> str:
+    """
+    Full-text search across all locally mirrored chats, ranked by relevance.
+    Requires the local message mirror (TELEGRAM_MIRROR_PATH) to be enabled.
+
+    Args:
+        query: FTS5 query, e.g. 'invoice', 'invoice AND march', '"exact phrase"' or 'deploy*'.
+        chat_id: Restrict the search to a single chat (optional).
+        limit: Maximum number of results.
+        output_format: 'text', 'json' (compact) or 'ndjson'; defaults to TELEGRAM_OUTPUT_FORMAT.
+        fields: Only return these keys of each result, e.g. ["id", "text"].
+    """
+    try:
+        if message_mirror is None:
+            return "The local message mirror is disabled. Set TELEGRAM_MIRROR_PATH to enable it."
+        peer_id = None
+        if chat_id is not None:
+            peer_id = utils.get_peer_id(await client.get_entity(chat_id))
+        try:
+            rows = message_mirror.search(query, peer_id, limit)
+        except sqlite3.OperationalError as query_err:
+            return f"Invalid search query: {query_err}"
+
+        def to_record(row):
+            row_chat_id, message_id, date, title, snippet = row
+            return {
+                "chat_id": utils.resolve_id(row_chat_id)[0],
+                "chat_title": title,
+                "id": message_id,
+                "date": datetime.fromtimestamp(date, timezone.utc).isoformat(),
+                "snippet": snippet,
+            }
+
+        def as_text(rows):
+            lines = []
+            for row_chat_id, message_id, date, title, snippet in rows:
+                bare_id = utils.resolve_id(row_chat_id)[0]
+                lines.append(
+                    f"Chat ID: {bare_id} ({title or 'Unknown'}) | ID: {message_id} | "
+                    f"{datetime.fromtimestamp(date, timezone.utc)} | {snippet}"
+                )
+            return "\n".join(lines)
+
+        return render(
+            rows,
+            to_record,
+            as_text,
+            output_format,
+            fields,
+            empty=f"No mirrored messages found matching '{query}'.",
+        )
+    except Exception as e:
+        return log_and_format_error("search_mirror", e, query=query, chat_id=chat_id)
+
+
+@mcp.tool()
+async def resolve_username(username: str, output_format: str = None, fields: list = None) -> str:
     """
     Resolve a username to a user or chat ID.
+
+    Args:
+        username: The username, without the @.
+        output_format: 'text', 'json' (compact) or 'ndjson'; defaults to TELEGRAM_OUTPUT_FORMAT.
+        fields: Only return these keys of each result, e.g. ["id", "text"].
     """
     try:
         result = await client(functions.contacts.ResolveUsernameRequest(username=username))
-        return str(result)
+        peer_id = utils.get_peer_id(result.peer, add_mark=False)
+        entity = next((e for e in [*result.users, *result.chats] if e.id == peer_id), None)
+        record = format_entity(entity) if entity else {"id": peer_id}
+        return render_one(record, str(result), output_format, fields)
     except Exception as e:
         return log_and_format_error("resolve_username", e, username=username)
 
@@ -2173,14 +5803,553 @@ async def unarchive_chat(chat_id: int) -> str:
         return log_and_format_error("unarchive_chat", e, chat_id=chat_id)
 
 
+# Requests per MTProto container in the batch tools (and ids per delete/forward request)
+BATCH_CHUNK_SIZE = 100
+
+
+async def send_batch(requests: list, ordered: bool = False) -> List[tuple]:
+    """
+    Send independent requests packed into MTProto containers, BATCH_CHUNK_SIZE at a time.
+
+    Returns one (result, error) pair per request, in order; a failing request,
+    or a whole container failing, does not stop the others. Each container holds
+    one RPC family, since the scheduler paces a container by its first request.
+    """
+    outcomes = [None] * len(requests)
+    families: Dict[str, List[int]] = {}
+    for i, request in enumerate(requests):
+        families.setdefault(rpc_scheduler.family(request), []).append(i)
+    for indexes in families.values():
+        for start in range(0, len(indexes), BATCH_CHUNK_SIZE):
+            part = indexes[start : start + BATCH_CHUNK_SIZE]
+            results = await _send_chunk([requests[i] for i in part], ordered)
+            for i, outcome in zip(part, results):
+                outcomes[i] = outcome
+    return outcomes
+
+
+async def _send_chunk(chunk: list, ordered: bool) -> List[tuple]:
+    """
+    Send one container. Requests refused with a FloodWait are sent again once
+    it is over, as long as that fits in the RPC deadline.
+    """
+    outcomes = [(None, None)] * len(chunk)
+    pending = list(range(len(chunk)))
+    deadline = _rpc_deadline.get() or time.monotonic() + RPC_DEADLINE
+    while pending:
+        try:
+            results = await client([chunk[i] for i in pending], ordered=ordered)
+            failures = [None] * len(pending)
+        except errors.MultiError as e:
+            results, failures = e.results, e.exceptions
+        except Exception as e:
+            # Telethon raises a lone failure, or its own flood check, directly, and the
+            # scheduler raises RateLimitExceeded; either way the whole container failed
+            results, failures = [None] * len(pending), [e] * len(pending)
+        for i, result, error in zip(pending, results, failures):
+            outcomes[i] = (result, error)
+        waits = {
+            i: error.seconds
+            for i, error in zip(pending, failures)
+            if isinstance(error, (errors.FloodWaitError, errors.FloodPremiumWaitError))
+        }
+        if not waits or time.monotonic() + max(waits.values()) > deadline:
+            break
+        await asyncio.sleep(max(waits.values()))
+        pending = list(waits)
+    return outcomes
+
+
+async def resolve_peers(chat_ids: list) -> tuple:
+    """Resolve chat ids to input peers; returns ([(chat_id, peer)], [(chat_id, error)])."""
+    peers, failures = [], []
+    for chat_id in chat_ids:
+        try:
+            peers.append((chat_id, await client.get_input_entity(chat_id)))
+        except Exception as e:
+            failures.append((chat_id, e))
+    return peers, failures
+
+
+def format_batch_report(action: str, items: list, outcomes: list, failures: list = ()) -> str:
+    """Summarise a batch: one line of totals, then one line per failed item."""
+    failed = [(item, error) for item, (_, error) in zip(items, outcomes) if error is not None]
+    failed += list(failures)
+    total = len(items) + len(failures)
+    lines = [f"{action}: {total - len(failed)}/{total} succeeded."]
+    lines += [f"{item}: failed ({type(error).__name__}: {error})" for item, error in failed]
+    return "\n".join(lines)
+
+
+def _chunks(items: list) -> List[list]:
+    return [items[i : i + BATCH_CHUNK_SIZE] for i in range(0, len(items), BATCH_CHUNK_SIZE)]
+
+
+def _batch_size(items) -> Optional[int]:
+    # For error reports: must not fail again on a missing or malformed argument
+    return len(items) if isinstance(items, (list, tuple, set)) else None
+
+
+def _id_range(ids: list) -> str:
+    return f"messages {ids[0]}" if len(ids) == 1 else f"messages {ids[0]}..{ids[-1]}"
+
+
+@mcp.tool()
+async def delete_messages_batch(chat_id: int, message_ids: list, revoke: bool = True) -> str:
+    """
+    Delete many messages in one chat with as few requests as possible.
+
+    Args:
+        chat_id: The chat ID.
+        message_ids: IDs of the messages to delete.
+        revoke: Also delete them for the other participants (ignored in channels).
+    """
+    try:
+        if not message_ids:
+            return "No message IDs given."
+        peer = await client.get_input_entity(chat_id)
+        chunks = _chunks([int(i) for i in message_ids])
+        if isinstance(peer, InputPeerChannel):
+            requests = [functions.channels.DeleteMessagesRequest(peer, ids) for ids in chunks]
+        else:
+            requests = [
+                functions.messages.DeleteMessagesRequest(ids, revoke=revoke) for ids in chunks
+            ]
+        outcomes = await send_batch(requests)
+        return format_batch_report("Delete", [_id_range(ids) for ids in chunks], outcomes)
+    except Exception as e:
+        return log_and_format_error(
+            "delete_messages_batch", e, chat_id=chat_id, count=_batch_size(message_ids)
+        )
+
+
+@mcp.tool()
+async def forward_messages_batch(from_chat_id: int, message_ids: list, to_chat_id: int) -> str:
+    """
+    Forward many messages from one chat to another, keeping their order.
+
+    Args:
+        from_chat_id: The chat to forward from.
+        message_ids: IDs of the messages to forward.
+        to_chat_id: The chat to forward to.
+    """
+    try:
+        if not message_ids:
+            return "No message IDs given."
+        from_peer = await client.get_input_entity(from_chat_id)
+        to_peer = await client.get_input_entity(to_chat_id)
+        chunks = _chunks([int(i) for i in message_ids])
+        requests = [
+            functions.messages.ForwardMessagesRequest(
+                from_peer, ids, [helpers.generate_random_long() for _ in ids], to_peer
+            )
+            for ids in chunks
+        ]
+        outcomes = await send_batch(requests, ordered=True)
+        return format_batch_report("Forward", [_id_range(ids) for ids in chunks], outcomes)
+    except Exception as e:
+        return log_and_format_error(
+            "forward_messages_batch",
+            e,
+            from_chat_id=from_chat_id,
+            count=_batch_size(message_ids),
+            to_chat_id=to_chat_id,
+        )
+
+
+@mcp.tool()
+async def archive_chats_batch(chat_ids: list, archive: bool = True) -> str:
+    """
+    Move many chats into (or out of) the archive folder.
+
+    Args:
+        chat_ids: The chat IDs.
+        archive: True to archive, False to move them back to the main list.
+    """
+    try:
+        with rpc_context(priority=PRIORITY_BULK):
+            peers, failures = await resolve_peers(chat_ids)
+            chunks = _chunks(peers)
+            requests = [
+                functions.folders.EditPeerFoldersRequest(
+                    [InputFolderPeer(peer, 1 if archive else 0) for _, peer in chunk]
+                )
+                for chunk in chunks
+            ]
+            outcomes = await send_batch(requests)
+        # One request covers a whole chunk, so report per chat
+        items, per_chat = [], []
+        for chunk, outcome in zip(chunks, outcomes):
+            for chat_id, _ in chunk:
+                items.append(f"chat {chat_id}")
+                per_chat.append(outcome)
+        failures = [(f"chat {chat_id}", e) for chat_id, e in failures]
+        return format_batch_report(
+            "Archive" if archive else "Unarchive", items, per_chat, failures
+        )
+    except Exception as e:
+        return log_and_format_error("archive_chats_batch", e, count=_batch_size(chat_ids))
+
+
+@mcp.tool()
+async def mark_as_read_batch(chat_ids: list) -> str:
+    """
+    Mark all messages as read in many chats at once.
+
+    Args:
+        chat_ids: The chat IDs.
+    """
+    try:
+        with rpc_context(priority=PRIORITY_BULK):
+            peers, failures = await resolve_peers(chat_ids)
+            requests = [
+                (
+                    functions.channels.ReadHistoryRequest(peer, max_id=0)
+                    if isinstance(peer, InputPeerChannel)
+                    else functions.messages.ReadHistoryRequest(peer, max_id=0)
+                )
+                for _, peer in peers
+            ]
+            outcomes = await send_batch(requests)
+        failures = [(f"chat {chat_id}", e) for chat_id, e in failures]
+        return format_batch_report(
+            "Mark as read", [f"chat {chat_id}" for chat_id, _ in peers], outcomes, failures
+        )
+    except Exception as e:
+        return log_and_format_error("mark_as_read_batch", e, count=_batch_size(chat_ids))
+
+
+@mcp.tool()
+async def pin_messages_batch(chat_id: int, message_ids: list, notify: bool = False) -> str:
+    """
+    Pin many messages in one chat.
+
+    Args:
+        chat_id: The chat ID.
+        message_ids: IDs of the messages to pin.
+        notify: Notify chat members about each pin.
+    """
+    try:
+        peer = await client.get_input_entity(chat_id)
+        requests = [
+            functions.messages.UpdatePinnedMessageRequest(peer, int(message_id), silent=not notify)
+            for message_id in message_ids
+        ]
+        outcomes = await send_batch(requests)
+        return format_batch_report(
+            "Pin", [f"message {message_id}" for message_id in message_ids], outcomes
+        )
+    except Exception as e:
+        return log_and_format_error(
+            "pin_messages_batch", e, chat_id=chat_id, count=_batch_size(message_ids)
+        )
+
+
+@mcp.tool()
+async def mute_chats_batch(chat_ids: list, mute: bool = True) -> str:
+    """
+    Mute (or unmute) notifications for many chats at once.
+
+    Args:
+        chat_ids: The chat IDs.
+        mute: True to mute forever, False to unmute.
+    """
+    try:
+        with rpc_context(priority=PRIORITY_BULK):
+            peers, failures = await resolve_peers(chat_ids)
+            requests = [
+                functions.account.UpdateNotifySettingsRequest(
+                    peer=InputNotifyPeer(peer),
+                    settings=InputPeerNotifySettings(mute_until=2**31 - 1 if mute else 0),
+                )
+                for _, peer in peers
+            ]
+            outcomes = await send_batch(requests)
+        failures = [(f"chat {chat_id}", e) for chat_id, e in failures]
+        return format_batch_report(
+            "Mute" if mute else "Unmute",
+            [f"chat {chat_id}" for chat_id, _ in peers],
+            outcomes,
+            failures,
+        )
+    except Exception as e:
+        return log_and_format_error("mute_chats_batch", e, count=_batch_size(chat_ids))
+
+
+# Where broadcast jobs are persisted so a restart can resume them
+BROADCAST_DIR = os.getenv("TELEGRAM_BROADCAST_DIR", os.path.join(script_dir, "broadcasts"))
+# Minimum seconds between two broadcast sends; stretched automatically after a FloodWait
+BROADCAST_INTERVAL = float(os.getenv("TELEGRAM_BROADCAST_INTERVAL", "1"))
+# Job ids as issued by BroadcastManager.start (they double as file names)
+BROADCAST_JOB_ID = re.compile(r"[A-Za-z0-9_-]+")
+
+
+class BroadcastManager:
+    """
+    Server-side fan-out of one payload to many chats.
+
+    Each job is a JSON file in BROADCAST_DIR holding the recipients, the payload
+    and how far the send loop got; it is rewritten after every recipient, so a
+    restart resumes at the next one (a send in flight at the moment of the crash
+    may be repeated). Sends are spaced at least BROADCAST_INTERVAL apart; a
+    FloodWait pauses the job for the requested time and doubles the spacing,
+    which then eases back after a run of successful sends. A file payload is
+    uploaded once by media_uploader and reused for every recipient.
+    """
+
+    def __init__(self, directory: str, interval: float):
+        self.directory = directory
+        self.interval = interval
+        self.jobs: Dict[str, dict] = {}
+        self._tasks: Dict[str, asyncio.Task] = {}
+
+    def _path(self, job_id: str) -> str:
+        # Job ids come from callers; only the token format start() issues may name a file
+        if not BROADCAST_JOB_ID.fullmatch(str(job_id)):
+            raise ValueError(f"Invalid broadcast job id: {job_id!r}")
+        return os.path.join(self.directory, f"{job_id}.json")
+
+    def _save(self, job: dict) -> None:
+        path = self._path(job["id"])
+        with open(path + ".tmp", "w", encoding="utf-8") as f:
+            json.dump(job, f)
+        os.replace(path + ".tmp", path)
+
+    def load(self, job_id: str) -> Optional[dict]:
+        """The job as last persisted, preferring the live copy when this process runs it."""
+        if job_id in self.jobs:
+            return self.jobs[job_id]
+        try:
+            with open(self._path(job_id), encoding="utf-8") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def all_jobs(self) -> List[dict]:
+        job_ids = set(self.jobs)
+        if os.path.isdir(self.directory):
+            job_ids.update(
+                name[:-5] for name in os.listdir(self.directory) if name.endswith(".json")
+            )
+        jobs = [job for job in map(self.load, job_ids) if job is not None]
+        return sorted(jobs, key=lambda job: job["created"])
+
+    def start(self, chat_ids: List[int], message: str, file_path: Optional[str]) -> dict:
+        os.makedirs(self.directory, exist_ok=True)
+        job = {
+            "id": secrets.token_hex(6),
+            "chat_ids": [int(chat_id) for chat_id in chat_ids],
+            "message": message,
+            "file_path": file_path,
+            "status": "running",
+            "next": 0,
+            "sent": 0,
+            "failed": {},
+            "error": None,
+            "created": time.time(),
+            "finished": None,
+            "active_seconds": 0.0,
+        }
+        self.jobs[job["id"]] = job
+        self._save(job)
+        self._run(job)
+        return job
+
+    def resume_all(self) -> None:
+        """Restart every job a previous process left running."""
+        for job in self.all_jobs():
+            if job["status"] == "running" and job["id"] not in self._tasks:
+                self.jobs[job["id"]] = job
+                logger.info(f"Resuming broadcast {job['id']} at recipient {job['next']}")
+                self._run(job)
+
+    def cancel(self, job_id: str) -> Optional[dict]:
+        job = self.load(job_id)
+        if job is None or job["status"] != "running":
+            return job
+        task = self._tasks.get(job_id)
+        if task is not None:
+            task.cancel()
+        job["status"] = "cancelled"
+        job["finished"] = time.time()
+        self._save(job)
+        return job
+
+    def _run(self, job: dict) -> None:
+        task = asyncio.create_task(self._send_all(job))
+        self._tasks[job["id"]] = task
+        task.add_done_callback(lambda _: self._tasks.pop(job["id"], None))
+
+    async def _send_one(self, job: dict, chat_id: int) -> None:
+        entity = await client.get_input_entity(chat_id)
+        if job["file_path"]:
+            await media_uploader.send_file(
+                entity, job["file_path"], "file", caption=job["message"]
+            )
+        else:
+            await client.send_message(entity, job["message"])
+
+    async def _send_all(self, job: dict) -> None:
+        _rpc_priority.set(PRIORITY_BULK)
+        interval = self.interval
+        streak = 0
+        last_send = 0.0
+        run_started = time.monotonic()
+        base_seconds = job["active_seconds"]
+        try:
+            while job["next"] < len(job["chat_ids"]):
+                chat_id = job["chat_ids"][job["next"]]
+                await asyncio.sleep(max(0.0, last_send + interval - time.monotonic()))
+                last_send = time.monotonic()
+                try:
+                    await self._send_one(job, chat_id)
+                except (
+                    errors.FloodWaitError,
+                    errors.FloodPremiumWaitError,
+                    RateLimitExceeded,
+                ) as e:
+                    # Not this recipient's fault: wait it out, slow down, and retry it
+                    interval = min(interval * 2, 60.0)
+                    streak = 0
+                    logger.info(f"Broadcast {job['id']} paused {e.seconds}s by rate limiting")
+                    await asyncio.sleep(e.seconds)
+                    continue
+                except errors.PeerFloodError as e:
+                    # The account is spam-limited; carrying on would only make it worse
+                    job["status"] = "failed"
+                    job["error"] = str(e)
+                    break
+                except Exception as e:
+                    job["failed"][str(chat_id)] = f"{type(e).__name__}: {e}"
+                else:
+                    job["sent"] += 1
+                    streak += 1
+                    if streak >= 20 and interval > self.interval:
+                        interval = max(self.interval, interval * 0.75)
+                        streak = 0
+                job["next"] += 1
+                job["active_seconds"] = base_seconds + time.monotonic() - run_started
+                self._save(job)
+            else:
+                job["status"] = "done"
+            job["finished"] = time.time()
+            self._save(job)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.exception(f"Broadcast {job['id']} stopped")
+            job["status"] = "failed"
+            job["error"] = str(e)
+            self._save(job)
+
+    @staticmethod
+    def describe(job: dict) -> str:
+        total = len(job["chat_ids"])
+        done = job["next"]
+        rate = done / job["active_seconds"] if job["active_seconds"] > 0 else 0.0
+        line = (
+            f"Broadcast {job['id']}: {job['status']}, {done}/{total} processed "
+            f"({job['sent']} sent, {len(job['failed'])} failed), {rate * 60:.1f} sends/min"
+        )
+        if job["status"] == "running" and rate > 0:
+            line += f", ETA {(total - done) / rate:.0f}s"
+        if job["error"]:
+            line += f"\nStopped: {job['error']}"
+        return line
+
+
+broadcast_manager = BroadcastManager(BROADCAST_DIR, BROADCAST_INTERVAL)
+
+
+@mcp.tool()
+async def start_broadcast(chat_ids: list, message: str, file_path: str = None) -> str:
+    """
+    Send the same message (and optionally a file) to many chats in the background.
+
+    Sends are paced to stay under Telegram's flood limits and progress is saved
+    to disk, so the job resumes after a restart. Check on it with
+    get_broadcast_status.
+
+    Args:
+        chat_ids: The chats to send to.
+        message: The message text (used as the caption when a file is sent).
+        file_path: Optional absolute path to a file to send with the message.
+    """
+    try:
+        if not chat_ids:
+            return "No chat IDs given."
+        if file_path is not None:
+            if not os.path.isfile(file_path):
+                return f"File not found: {file_path}"
+            if not os.access(file_path, os.R_OK):
+                return f"File is not readable: {file_path}"
+        job = broadcast_manager.start(chat_ids, message, file_path)
+        return f"Broadcast {job['id']} started for {len(job['chat_ids'])} chats."
+    except Exception as e:
+        return log_and_format_error(
+            "start_broadcast", e, count=_batch_size(chat_ids), file_path=file_path
+        )
+
+
+@mcp.tool()
+async def get_broadcast_status(job_id: str = None) -> str:
+    """
+    Report progress, throughput and ETA of broadcast jobs.
+
+    Args:
+        job_id: The job to report on; omit to list all jobs.
+    """
+    try:
+        if job_id is None:
+            jobs = broadcast_manager.all_jobs()
+            if not jobs:
+                return "No broadcasts."
+            return "\n".join(broadcast_manager.describe(job) for job in jobs)
+        job = broadcast_manager.load(job_id)
+        if job is None:
+            return f"Broadcast {job_id} not found."
+        lines = [broadcast_manager.describe(job)]
+        lines += [f"Chat {chat_id}: {error}" for chat_id, error in job["failed"].items()]
+        return "\n".join(lines)
+    except Exception as e:
+        return log_and_format_error("get_broadcast_status", e, job_id=job_id)
+
+
+@mcp.tool()
+async def cancel_broadcast(job_id: str) -> str:
+    """
+    Stop a running broadcast job.
+
+    Args:
+        job_id: The job to cancel.
+    """
+    try:
+        job = broadcast_manager.cancel(job_id)
+        if job is None:
+            return f"Broadcast {job_id} not found."
+        return broadcast_manager.describe(job)
+    except Exception as e:
+        return log_and_format_error("cancel_broadcast", e, job_id=job_id)
+
+
 @mcp.tool()
-async def get_sticker_sets() -> str:
+async def get_sticker_sets(output_format: str = None, fields: list = None) -> str:
     """
     Get all sticker sets.
+
+    Args:
+        output_format: 'text', 'json' (compact) or 'ndjson'; defaults to TELEGRAM_OUTPUT_FORMAT.
+        fields: Only return these keys of each result, e.g. ["id", "text"].
     """
     try:
         result = await client(functions.messages.GetAllStickersRequest(hash=0))
-        return json.dumps([s.title for s in result.sets], indent=2)
+        return render(
+            result.sets,
+            lambda s: {"id": s.id, "title": s.title, "short_name": s.short_name, "count": s.count},
+            lambda sets: json.dumps([s.title for s in sets], indent=2),
+            output_format,
+            fields,
+        )
     except Exception as e:
         return log_and_format_error("get_sticker_sets", e)
 
@@ -2201,7 +6370,7 @@ async def send_sticker(chat_id: int, file_path: str) -> str:
         if not file_path.lower().endswith(".webp"):
             return "Sticker file must be a .webp file."
         entity = await client.get_entity(chat_id)
-        await client.send_file(entity, file_path, force_document=False)
+        await media_uploader.send_file(entity, file_path, "sticker", force_document=False)
         return f"Sticker sent to chat {chat_id}."
     except Exception as e:
         return log_and_format_error("send_sticker", e, chat_id=chat_id, file_path=file_path)
@@ -2365,29 +6534,78 @@ async def set_bot_commands(bot_username: str, commands: list) -> str:
 
 
 @mcp.tool()
-async def get_history(chat_id: int, limit: int = 100) -> str:
+async def get_history(
+    chat_id: int,
+    limit: int = 100,
+    cursor: str = None,
+    output_format: str = None,
+    fields: list = None,
+    max_chars: int = None,
+    max_items: int = None,
+) -> str:
     """
     Get full chat history (up to limit).
+
+    Args:
+        chat_id: The ID of the chat.
+        limit: Maximum number of messages to retrieve.
+        cursor: Opaque next_cursor from a previous response to continue further back.
+        output_format: 'text', 'json' (compact) or 'ndjson'; defaults to TELEGRAM_OUTPUT_FORMAT.
+        fields: Only return these keys of each result, e.g. ["id", "text"].
+        max_chars: Stop at about this many characters, shortening long texts; get_continuation gives the rest.
+        max_items: Stop after this many items; get_continuation gives the rest.
     """
     try:
         entity = await client.get_entity(chat_id)
-        messages = await client.get_messages(entity, limit=limit)
-        return "\n".join([f"ID: {m.id} | {m.date} | {m.message}" for m in messages])
+        offset_id = 0
+        if cursor:
+            try:
+                offset_id = decode_cursor(cursor, chat_id)
+            except ValueError as cursor_err:
+                return str(cursor_err)
+        messages = await client.get_messages(entity, limit=limit, offset_id=offset_id)
+        next_cursor = None
+        if messages and len(messages) == limit:
+            next_cursor = encode_cursor(chat_id, messages[-1].id)
+        return render(
+            messages,
+            format_message,
+            lambda messages: "\n".join(f"ID: {m.id} | {m.date} | {m.message}" for m in messages),
+            output_format,
+            fields,
+            max_chars=max_chars,
+            max_items=max_items,
+            next_cursor=next_cursor,
+        )
     except Exception as e:
-        return log_and_format_error("get_history", e, chat_id=chat_id, limit=limit)
+        return log_and_format_error("get_history", e, chat_id=chat_id, limit=limit, cursor=cursor)
 
 
 @mcp.tool()
-async def get_user_photos(user_id: int, limit: int = 10) -> str:
+async def get_user_photos(
+    user_id: int, limit: int = 10, output_format: str = None, fields: list = None
+) -> str:
     """
     Get profile photos of a user.
+
+    Args:
+        user_id: The user ID.
+        limit: Maximum number of photos.
+        output_format: 'text', 'json' (compact) or 'ndjson'; defaults to TELEGRAM_OUTPUT_FORMAT.
+        fields: Only return these keys of each result, e.g. ["id", "text"].
     """
     try:
         user = await client.get_entity(user_id)
         photos = await client(
             functions.photos.GetUserPhotosRequest(user_id=user, offset=0, max_id=0, limit=limit)
         )
-        return json.dumps([p.id for p in photos.photos], indent=2)
+        return render(
+            photos.photos,
+            lambda p: {"id": p.id, "date": p.date},
+            lambda photos: json.dumps([p.id for p in photos], indent=2),
+            output_format,
+            fields,
+        )
     except Exception as e:
         return log_and_format_error("get_user_photos", e, user_id=user_id, limit=limit)
 
@@ -2405,9 +6623,22 @@ async def get_user_status(user_id: int) -> str:
 
 
 @mcp.tool()
-async def get_recent_actions(chat_id: int) -> str:
+async def get_recent_actions(
+    chat_id: int,
+    output_format: str = None,
+    fields: list = None,
+    max_chars: int = None,
+    max_items: int = None,
+) -> str:
     """
     Get recent admin actions (admin log) in a group or channel.
+
+    Args:
+        chat_id: The group or channel ID.
+        output_format: 'text', 'json' (compact) or 'ndjson'; defaults to TELEGRAM_OUTPUT_FORMAT.
+        fields: Only return these keys of each result, e.g. ["id", "text"].
+        max_chars: Stop at about this many characters, shortening long texts; get_continuation gives the rest.
+        max_items: Stop after this many items; get_continuation gives the rest.
     """
     try:
         result = await client(
@@ -2416,20 +6647,30 @@ async def get_recent_actions(chat_id: int) -> str:
             )
         )
 
-        if not result or not result.events:
-            return "No recent admin actions found."
-
-        # Use the custom serializer to handle datetime objects
-        return json.dumps([e.to_dict() for e in result.events], indent=2, default=json_serializer)
+        return render(
+            result.events if result else [],
+            lambda event: event.to_dict(),
+            None,
+            output_format,
+            fields,
+            max_chars=max_chars,
+            max_items=max_items,
+            empty="No recent admin actions found.",
+        )
     except Exception as e:
         logger.exception(f"get_recent_actions failed (chat_id={chat_id})")
         return log_and_format_error("get_recent_actions", e, chat_id=chat_id)
 
 
 @mcp.tool()
-async def get_pinned_messages(chat_id: int) -> str:
+async def get_pinned_messages(chat_id: int, output_format: str = None, fields: list = None) -> str:
     """
     Get all pinned messages in a chat.
+
+    Args:
+        chat_id: The ID of the chat.
+        output_format: 'text', 'json' (compact) or 'ndjson'; defaults to TELEGRAM_OUTPUT_FORMAT.
+        fields: Only return these keys of each result, e.g. ["id", "text"].
     """
     try:
         entity = await client.get_entity(chat_id)
@@ -2444,17 +6685,64 @@ async def get_pinned_messages(chat_id: int) -> str:
             all_messages = await client.get_messages(entity, limit=50)
             messages = [m for m in all_messages if getattr(m, "pinned", False)]
 
-        if not messages:
-            return "No pinned messages found in this chat."
-
-        return "\n".join(
-            [f"ID: {m.id} | {m.date} | {m.message or '[Media/No text]'}" for m in messages]
+        return render(
+            messages,
+            format_message,
+            lambda messages: "\n".join(
+                [f"ID: {m.id} | {m.date} | {m.message or '[Media/No text]'}" for m in messages]
+            ),
+            output_format,
+            fields,
+            empty="No pinned messages found in this chat.",
         )
     except Exception as e:
         logger.exception(f"get_pinned_messages failed (chat_id={chat_id})")
         return log_and_format_error("get_pinned_messages", e, chat_id=chat_id)
 
 
+def instrument_tools() -> None:
+    """Wrap every registered tool so its calls, failures and latency are recorded."""
+    for tool in mcp._tool_manager.list_tools():
+
+        def wrap(fn, name):
+            @functools.wraps(fn)
+            async def timed(*args, **kwargs):
+                metrics.inc("telegram_mcp_tool_calls_total", tool=name)
+                if traffic_recorder is not None:
+                    traffic_recorder.record_tool(name, kwargs)
+                started = time.monotonic()
+                token = _current_tool.set((name, started))
+                try:
+                    return await fn(*args, **kwargs)
+                except Exception as e:
+                    metrics.inc(
+                        "telegram_mcp_tool_errors_total", tool=name, error=type(e).__name__
+                    )
+                    raise
+                finally:
+                    _current_tool.reset(token)
+                    metrics.observe(
+                        "telegram_mcp_tool_latency_seconds", time.monotonic() - started, tool=name
+                    )
+
+            return timed
+
+        tool.fn = wrap(tool.fn, tool.name)
+
+
+instrument_tools()
+
+
+async def startup() -> None:
+    """Start the Telethon client and warm up the process-wide caches."""
+    await client.start()
+    await dialog_index.build()
+    if message_mirror is not None and WORKER_ROLE == "primary":
+        message_mirror.start_backfill()
+    if WORKER_ROLE == "primary":
+        broadcast_manager.resume_all()
+
+
 if __name__ == "__main__":
     nest_asyncio.apply()
 
@@ -2462,7 +6750,7 @@ if __name__ == "__main__":
         try:
             # Start the Telethon client non-interactively
             print("Starting Telegram client...")
-            await client.start()
+            await startup()
 
             print("Telegram client started. Running MCP server...")
             # Use the asynchronous entrypoint instead of mcp.run()
@@ -1,5 +1,5 @@
 #!/usr/bin/env python3
-"""
+r"""
 HTTP Wrapper for existing MCP servers
 This runs alongside your existing telegram-mcp and exposes it via HTTP/SSE
 Place this in: C:\Users\99893\Downloads\mycode\telegram-mcp\
@@ -10,15 +10,16 @@ import json
 import logging
 import subprocess
 import sys
-from typing import Any, Dict, List, Optional
+from typing import Any, Dict, Optional
 from datetime import datetime
-import os
 
 from fastapi import FastAPI, Request, Response
 from fastapi.responses import StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
 import uvicorn
 
+from mcp_worker_pool import MCPServerManager, bare_chat_id
+
 # Configure logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
@@ -39,79 +40,25 @@ app.add_middleware(
 mcp_connections: Dict[str, Any] = {}
 mcp_process = None
 
-class MCPServerManager:
-    """Manages the MCP server process"""
-    
-    def __init__(self):
-        self.process = None
-        self.stdin = None
-        self.stdout = None
-        self.stderr = None
-    
-    async def start_mcp_server(self):
-        """Start the existing MCP server"""
-        try:
-            # Command from your claude config
-            cmd = [
-                "uv", 
-                "--directory", 
-                "C:\\Users\\99893\\Downloads\\mycode\\telegram-mcp",
-                "run",
-                "main.py"
-            ]
-            
-            logger.info(f"Starting MCP server: {' '.join(cmd)}")
-            
-            self.process = await asyncio.create_subprocess_exec(
-                *cmd,
-                stdin=asyncio.subprocess.PIPE,
-                stdout=asyncio.subprocess.PIPE,
-                stderr=asyncio.subprocess.PIPE,
-                cwd="C:\\Users\\99893\\Downloads\\mycode\\telegram-mcp"
-            )
-            
-            self.stdin = self.process.stdin
-            self.stdout = self.process.stdout
-            self.stderr = self.process.stderr
-            
-            logger.info("MCP server started successfully")
-            return True
-            
-        except Exception as e:
-            logger.error(f"Failed to start MCP server: {e}")
-            return False
-    
-    async def send_message(self, message: Dict) -> Dict:
-        """Send message to MCP server and get response"""
-        if not self.process or not self.stdin:
-            raise Exception("MCP server not running")
-        
-        try:
-            # Send message
-            message_str = json.dumps(message) + "\n"
-            self.stdin.write(message_str.encode())
-            await self.stdin.drain()
-            
-            # Read response
-            response_line = await self.stdout.readline()
-            if response_line:
-                response = json.loads(response_line.decode().strip())
-                return response
-            else:
-                raise Exception("No response from MCP server")
-                
-        except Exception as e:
-            logger.error(f"Error communicating with MCP server: {e}")
-            raise
-    
-    async def stop(self):
-        """Stop the MCP server"""
-        if self.process:
-            self.process.terminate()
-            await self.process.wait()
+# Global MCP manager, running the server the way the Claude config does
+MCP_SERVER_DIR = "C:\\Users\\99893\\Downloads\\mycode\\telegram-mcp"
+mcp_manager = MCPServerManager(
+    command=["uv", "--directory", MCP_SERVER_DIR, "run", "main.py"], cwd=MCP_SERVER_DIR
+)
+
+def publish_update(message: Dict):
+    """Queue a live-update notification for every SSE connection whose filter matches"""
+    update = message["params"]["data"]
+    for connection in list(mcp_connections.values()):
+        chat_ids = connection["chat_ids"]
+        if chat_ids is not None and bare_chat_id(update.get("chat_id")) not in chat_ids:
+            continue
+        queue = connection["updates"]
+        if queue.full():
+            queue.get_nowait()  # A slow reader loses its oldest updates, not everyone's
+        queue.put_nowait(update)
 
-# Global MCP manager
-mcp_manager = MCPServerManager()
+mcp_manager.update_listeners.append(publish_update)
 
 @app.on_event("startup")
 async def startup_event():
@@ -133,9 +80,15 @@ async def health_check():
         "status": "ok",
         "server": "mcp-http-wrapper",
         "timestamp": datetime.now().isoformat(),
-        "mcp_server_running": mcp_manager.process is not None
+        "mcp_server_running": mcp_manager.is_running,
+        "workers": mcp_manager.status()
     }
 
+@app.get("/metrics")
+async def metrics():
+    """Prometheus metrics from every MCP worker"""
+    return Response(await mcp_manager.metrics(), media_type="text/plain; version=0.0.4")
+
 @app.get("/mcp-manifest.json")
 async def get_manifest():
     """MCP server manifest for Claude integration"""
@@ -153,17 +106,24 @@ async def get_manifest():
     }
 
 @app.get("/sse")
-async def sse_endpoint(request: Request):
-    """Server-Sent Events endpoint for Claude MCP communication"""
+async def sse_endpoint(request: Request, chat_ids: Optional[str] = None):
+    """Server-Sent Events endpoint for Claude MCP communication
+
+    Live Telegram updates are streamed as "update" events; pass
+    ?chat_ids=1,2 to only receive updates for those chats.
+    """
     
     async def event_stream():
         connection_id = f"conn_{datetime.now().timestamp()}"
+        updates: asyncio.Queue = asyncio.Queue(maxsize=1000)
         
         try:
             # Store connection
             mcp_connections[connection_id] = {
                 "request": request,
-                "connected_at": datetime.now()
+                "connected_at": datetime.now(),
+                "chat_ids": {bare_chat_id(c) for c in chat_ids.split(",") if c.strip()} if chat_ids else None,
+                "updates": updates
             }
             
             logger.info(f"New SSE connection: {connection_id}")
@@ -185,14 +145,17 @@ async def sse_endpoint(request: Request):
             except Exception as e:
                 logger.error(f"Error getting tools: {e}")
             
-            # Keep connection alive
+            # Stream updates as they arrive; keep the connection alive in between
             while True:
                 if await request.is_disconnected():
                     break
                 
-                # Send heartbeat every 30 seconds
-                yield f"data: {json.dumps({'type': 'heartbeat', 'timestamp': datetime.now().isoformat()})}\n\n"
-                await asyncio.sleep(30)
+                try:
+                    update = await asyncio.wait_for(updates.get(), timeout=30)
+                    yield f"data: {json.dumps({'type': 'update', 'update': update})}\n\n"
+                except asyncio.TimeoutError:
+                    # Send heartbeat after 30 quiet seconds
+                    yield f"data: {json.dumps({'type': 'heartbeat', 'timestamp': datetime.now().isoformat()})}\n\n"
                 
         except Exception as e:
             logger.error(f"SSE connection error: {e}")
@@ -241,8 +204,9 @@ async def get_status():
     """Get server status"""
     return {
         "active_connections": len(mcp_connections),
-        "mcp_server_running": mcp_manager.process is not None,
-        "mcp_server_pid": mcp_manager.process.pid if mcp_manager.process else None,
+        "mcp_server_running": mcp_manager.is_running,
+        "mcp_server_pid": mcp_manager.primary.process.pid if mcp_manager.primary and mcp_manager.primary.process else None,
+        "workers": mcp_manager.status(),
         "server_info": {
             "name": "mcp-http-wrapper",
             "version": "1.0.0",
@@ -9,17 +9,18 @@ import json
 import logging
 import os
 import subprocess
-import sys
-import uuid
+from collections import deque
 from datetime import datetime
 from typing import Any, Dict, List, Optional
 
 import uvicorn
 from fastapi import FastAPI, WebSocket, WebSocketDisconnect, HTTPException, Request
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, PlainTextResponse
 from pydantic import BaseModel
 
+from mcp_worker_pool import MCPServerManager, bare_chat_id
+
 # Configure logging
 logging.basicConfig(
     level=logging.INFO,
@@ -54,175 +55,153 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-class MCPServerManager:
-    """Enhanced MCP server process manager"""
+# Global MCP manager
+mcp_manager = MCPServerManager(request_timeout=30.0)
+
+# WebSocket connection manager
+# Messages a connection may have waiting before the slow-consumer policy applies
+WS_QUEUE_SIZE = int(os.environ.get("WS_QUEUE_SIZE", "256"))
+# What happens to a full queue: drop_oldest, coalesce (replace superseded updates,
+# then drop oldest) or disconnect
+WS_SLOW_CONSUMER_POLICY = os.environ.get("WS_SLOW_CONSUMER_POLICY", "drop_oldest")
+
+class ClientConnection:
+    """One WebSocket with its own outgoing queue and writer task
+
+    Nothing else ever writes to the socket, so a slow client only backs up
+    its own queue and never delays anyone else. Direct replies wait in a
+    separate unbounded queue and go out first; the size limit and the
+    slow-consumer policy only apply to broadcast updates.
+    """
     
-    def __init__(self):
-        self.process = None
-        self.stdin = None
-        self.stdout = None
-        self.stderr = None
-        self.is_running = False
-        self.tools_cache = []
-        
-    async def start_mcp_server(self):
-        """Start the Telegram MCP server"""
-        try:
-            # Get current directory
-            current_dir = os.path.dirname(os.path.abspath(__file__))
-            
-            # Command to start MCP server
-            cmd = [
-                sys.executable,  # Use current Python interpreter
-                os.path.join(current_dir, "main.py")
-            ]
-            
-            logger.info(f"Starting MCP server: {' '.join(cmd)}")
-            logger.info(f"Working directory: {current_dir}")
-            
-            self.process = await asyncio.create_subprocess_exec(
-                *cmd,
-                stdin=asyncio.subprocess.PIPE,
-                stdout=asyncio.subprocess.PIPE,
-                stderr=asyncio.subprocess.PIPE,
-                cwd=current_dir
-            )
-            
-            self.stdin = self.process.stdin
-            self.stdout = self.process.stdout
-            self.stderr = self.process.stderr
-            self.is_running = True
-            
-            # Initialize with handshake
-            await self._initialize_mcp()
-            
-            logger.info("MCP server started successfully")
-            return True
-            
-        except Exception as e:
-            logger.error(f"Failed to start MCP server: {e}")
-            self.is_running = False
-            return False
+    def __init__(self, websocket: WebSocket, queue_size: int, policy: str):
+        self.websocket = websocket
+        self.queue_size = queue_size
+        self.policy = policy
+        # Pending JSON-RPC replies, never dropped
+        self.replies: deque = deque()
+        # Pending (coalescing key, text) broadcast pairs
+        self.queue: deque = deque()
+        self.chat_ids: Optional[set] = None
+        self.subscribed = False
+        self.dropped = 0
+        self._ready = asyncio.Event()
+        self.writer: Optional[asyncio.Task] = None
     
-    async def _initialize_mcp(self):
-        """Initialize MCP connection and get tools"""
-        try:
-            # Send initialize request
-            init_request = {
-                "jsonrpc": "2.0",
-                "id": str(uuid.uuid4()),
-                "method": "initialize",
-                "params": {
-                    "protocolVersion": "2024-11-05",
-                    "capabilities": {
-                        "tools": {}
-                    },
-                    "clientInfo": {
-                        "name": "telegram-mcp-remote",
-                        "version": "1.0.0"
-                    }
-                }
-            }
-            
-            response = await self.send_message(init_request)
-            logger.info(f"Initialize response: {response}")
-            
-            # Get tools list
-            tools_request = {
-                "jsonrpc": "2.0",
-                "id": str(uuid.uuid4()),
-                "method": "tools/list"
-            }
-            
-            tools_response = await self.send_message(tools_request)
-            if "result" in tools_response and "tools" in tools_response["result"]:
-                self.tools_cache = tools_response["result"]["tools"]
-                logger.info(f"Loaded {len(self.tools_cache)} tools")
-            
-        except Exception as e:
-            logger.error(f"Error initializing MCP: {e}")
+    def wants(self, chat_id) -> bool:
+        return self.subscribed and (self.chat_ids is None or bare_chat_id(chat_id) in self.chat_ids)
     
-    async def send_message(self, message: Dict) -> Dict:
-        """Send message to MCP server and get response"""
-        if not self.is_running or not self.stdin or not self.stdout:
-            raise Exception("MCP server not running")
-        
-        try:
-            # Send message
-            message_str = json.dumps(message) + "\n"
-            self.stdin.write(message_str.encode())
-            await self.stdin.drain()
-            
-            # Read response
-            response_line = await asyncio.wait_for(
-                self.stdout.readline(), 
-                timeout=30.0  # 30 second timeout
-            )
-            
-            if response_line:
-                response = json.loads(response_line.decode().strip())
-                return response
-            else:
-                raise Exception("No response from MCP server")
-                
-        except asyncio.TimeoutError:
-            logger.error("Timeout waiting for MCP response")
-            raise Exception("MCP server timeout")
-        except Exception as e:
-            logger.error(f"Error communicating with MCP server: {e}")
-            raise
+    def send(self, text: str):
+        """Queue a direct reply; replies are never dropped"""
+        self.replies.append(text)
+        self._ready.set()
     
-    async def call_tool(self, tool_name: str, parameters: Dict[str, Any]) -> Dict:
-        """Call a specific tool"""
-        request = {
-            "jsonrpc": "2.0",
-            "id": str(uuid.uuid4()),
-            "method": "tools/call",
-            "params": {
-                "name": tool_name,
-                "arguments": parameters
-            }
-        }
-        
-        return await self.send_message(request)
+    def offer(self, text: str, key: Optional[tuple] = None) -> bool:
+        """Queue a broadcast message; False means the client is too slow to keep"""
+        if self.policy == "coalesce" and key is not None:
+            for i, (pending_key, _) in enumerate(self.queue):
+                if pending_key == key:
+                    # The client has not seen the old state yet; just send the new one
+                    self.queue[i] = (key, text)
+                    return True
+        if len(self.queue) >= self.queue_size:
+            if self.policy == "disconnect":
+                return False
+            self.queue.popleft()
+            self.dropped += 1
+        self.queue.append((key, text))
+        self._ready.set()
+        return True
     
-    async def stop(self):
-        """Stop the MCP server"""
-        self.is_running = False
-        if self.process:
-            self.process.terminate()
-            try:
-                await asyncio.wait_for(self.process.wait(), timeout=5.0)
-            except asyncio.TimeoutError:
-                self.process.kill()
-                await self.process.wait()
+    async def write_loop(self):
+        while True:
+            await self._ready.wait()
+            self._ready.clear()
+            while self.replies or self.queue:
+                text = self.replies.popleft() if self.replies else self.queue.popleft()[1]
+                await self.websocket.send_text(text)
 
-# Global MCP manager
-mcp_manager = MCPServerManager()
-
-# WebSocket connection manager
 class ConnectionManager:
-    def __init__(self):
-        self.active_connections: List[WebSocket] = []
+    def __init__(self, queue_size: int = WS_QUEUE_SIZE, policy: str = WS_SLOW_CONSUMER_POLICY):
+        if policy not in ("drop_oldest", "coalesce", "disconnect"):
+            logger.warning(f"Unknown WS_SLOW_CONSUMER_POLICY {policy!r}, using drop_oldest")
+            policy = "drop_oldest"
+        self.queue_size = queue_size
+        self.policy = policy
+        self.connections: Dict[WebSocket, ClientConnection] = {}
+    
+    @property
+    def active_connections(self) -> List[WebSocket]:
+        return list(self.connections)
 
-    async def connect(self, websocket: WebSocket):
+    async def connect(self, websocket: WebSocket) -> ClientConnection:
         await websocket.accept()
-        self.active_connections.append(websocket)
-        logger.info(f"WebSocket connected. Total: {len(self.active_connections)}")
+        connection = ClientConnection(websocket, self.queue_size, self.policy)
+        connection.writer = asyncio.create_task(self._run_writer(connection))
+        self.connections[websocket] = connection
+        logger.info(f"WebSocket connected. Total: {len(self.connections)}")
+        return connection
 
     def disconnect(self, websocket: WebSocket):
-        if websocket in self.active_connections:
-            self.active_connections.remove(websocket)
-        logger.info(f"WebSocket disconnected. Total: {len(self.active_connections)}")
+        connection = self.connections.pop(websocket, None)
+        if connection is not None and connection.writer is not None:
+            connection.writer.cancel()
+        logger.info(f"WebSocket disconnected. Total: {len(self.connections)}")
+
+    async def _run_writer(self, connection: ClientConnection):
+        try:
+            await connection.write_loop()
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            self.disconnect(connection.websocket)
+
+    async def _close_slow(self, connection: ClientConnection):
+        try:
+            await connection.websocket.close(code=1008, reason="slow consumer")
+        except Exception:
+            pass
 
-    async def broadcast(self, message: str):
-        for connection in self.active_connections:
-            try:
-                await connection.send_text(message)
-            except:
-                self.disconnect(connection)
+    def broadcast(self, message: str, connections: Optional[List[WebSocket]] = None,
+                  key: Optional[tuple] = None):
+        """Queue one already-encoded message for many sockets without waiting on any"""
+        targets = self.connections.values() if connections is None else [
+            self.connections[websocket] for websocket in connections if websocket in self.connections
+        ]
+        # Copy first: disconnecting below changes self.connections
+        for connection in list(targets):
+            if not connection.offer(message, key):
+                logger.warning("Disconnecting slow WebSocket consumer")
+                self.disconnect(connection.websocket)
+                asyncio.create_task(self._close_slow(connection))
+    
+    def subscribe_updates(self, websocket: WebSocket, chat_ids: Optional[List[int]] = None):
+        connection = self.connections[websocket]
+        connection.subscribed = True
+        connection.chat_ids = {bare_chat_id(c) for c in chat_ids} if chat_ids else None
+    
+    def unsubscribe_updates(self, websocket: WebSocket):
+        self.connections[websocket].subscribed = False
+    
+    def publish_update(self, message: Dict):
+        """Send one live-update notification to every socket whose filter matches"""
+        update = message["params"]["data"]
+        targets = [
+            connection.websocket for connection in list(self.connections.values())
+            if connection.wants(update.get("chat_id"))
+        ]
+        if targets:
+            # Status changes and edits supersede earlier ones still waiting to be sent
+            if update.get("type") == "user_update":
+                key = ("user_update", update.get("user_id"))
+            elif update.get("type") == "message_edited":
+                key = ("message_edited", update.get("chat_id"), update.get("id"))
+            else:
+                key = None
+            self.broadcast(json.dumps(message), targets, key)
 
 manager = ConnectionManager()
+mcp_manager.update_listeners.append(manager.publish_update)
 
 @app.on_event("startup")
 async def startup_event():
@@ -254,4 +233,108 @@ async def root():
             "health": "/health",
             "tools": "/tools",
             "call": "/call/{tool_name}",
-            "websocket": "/ws",
\ No newline at end of file
+            "websocket": "/ws",
+            "mcp": "/mcp",
+            "metrics": "/metrics"
+        }
+    }
+
+@app.get("/health")
+async def health_check():
+    """Health check endpoint"""
+    return {
+        "status": "ok" if mcp_manager.is_running else "degraded",
+        "timestamp": datetime.now().isoformat(),
+        "mcp_server_running": mcp_manager.is_running,
+        "tools_loaded": len(mcp_manager.tools_cache),
+        "websocket_connections": len(manager.active_connections),
+        "websocket_dropped_messages": sum(c.dropped for c in list(manager.connections.values())),
+        "workers": mcp_manager.status()
+    }
+
+@app.get("/metrics")
+async def metrics():
+    """Prometheus metrics from every MCP worker"""
+    return PlainTextResponse(await mcp_manager.metrics(), media_type="text/plain; version=0.0.4")
+
+@app.get("/tools")
+async def list_tools():
+    """List the tools exposed by the MCP server"""
+    return {"tools": mcp_manager.tools_cache}
+
+@app.post("/call/{tool_name}")
+async def call_tool(tool_name: str, parameters: Dict[str, Any] = None):
+    """Call a single tool with JSON parameters"""
+    try:
+        return await mcp_manager.call_tool(tool_name, parameters or {})
+    except Exception as e:
+        logger.error(f"Error calling tool {tool_name}: {e}")
+        raise HTTPException(status_code=502, detail=str(e))
+
+@app.post("/mcp")
+async def mcp_endpoint(request: MCPRequest):
+    """Forward a raw JSON-RPC request to the MCP server"""
+    try:
+        response = await mcp_manager.send_message(request.dict(exclude_none=True))
+        return response or {}
+    except Exception as e:
+        logger.error(f"Error processing MCP message: {e}")
+        return JSONResponse(
+            status_code=502,
+            content={
+                "jsonrpc": "2.0",
+                "id": request.id,
+                "error": {"code": -32603, "message": str(e)}
+            }
+        )
+
+@app.websocket("/ws")
+async def websocket_endpoint(websocket: WebSocket):
+    """JSON-RPC over WebSocket; requests are answered as their responses arrive
+
+    Besides MCP methods, "updates/subscribe" (params: optional "chat_ids") starts
+    a stream of live Telegram updates as "notifications/message" notifications
+    from the "telegram.updates" logger; "updates/unsubscribe" stops it.
+    """
+    connection = await manager.connect(websocket)
+    
+    async def handle(message: Dict):
+        try:
+            method = message.get("method")
+            params = message.get("params") or {}
+            # Live updates are handled here rather than by the MCP server
+            if method == "updates/subscribe":
+                manager.subscribe_updates(websocket, params.get("chat_ids"))
+                response = {"jsonrpc": "2.0", "id": message.get("id"), "result": {"subscribed": True}}
+            elif method == "updates/unsubscribe":
+                manager.unsubscribe_updates(websocket)
+                response = {"jsonrpc": "2.0", "id": message.get("id"), "result": {"subscribed": False}}
+            else:
+                response = await mcp_manager.send_message(message)
+        except Exception as e:
+            response = {
+                "jsonrpc": "2.0",
+                "id": message.get("id"),
+                "error": {"code": -32603, "message": str(e)}
+            }
+        if response is not None:
+            connection.send(json.dumps(response))
+    
+    tasks = set()
+    try:
+        while True:
+            message = json.loads(await websocket.receive_text())
+            task = asyncio.create_task(handle(message))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+    except (WebSocketDisconnect, json.JSONDecodeError):
+        pass
+    finally:
+        for task in tasks:
+            task.cancel()
+        manager.disconnect(websocket)
+
+if __name__ == "__main__":
+    port = int(os.environ.get("PORT", 8000))
+    logger.info(f"Starting Telegram MCP Remote Server on port {port}")
+    uvicorn.run(app, host="0.0.0.0", port=port, log_level="info")
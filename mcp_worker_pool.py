@@ -0,0 +1,551 @@
+#!/usr/bin/env python3
+"""
+Pool of Telegram MCP server processes shared by the HTTP wrappers
+
+mcp_http_wrapper.py (SSE) and mcp_http_wrapper_fixed.py (REST/WebSocket) both
+front the same stdio MCP server; the worker processes, request routing, health
+checks and metrics merging live here so the two cannot drift apart.
+"""
+
+import asyncio
+import json
+import logging
+import os
+import sys
+import uuid
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+# Tools that only read from Telegram; any worker may serve them. Everything
+# else is a mutation and always goes to the primary worker.
+READ_ONLY_TOOL_PREFIXES = ("get_", "list_", "search_", "resolve_", "export_")
+# Named like reads but create an invite link, write the primary's member snapshots
+# or read download progress that only the primary (where downloads run) holds
+MUTATING_TOOLS = {
+    "export_chat_invite",
+    "get_invite_link",
+    "get_participant_changes",
+    "get_download_progress",
+}
+# Served only by the worker that issued the continuation token
+CONTINUATION_TOOL = "get_continuation"
+# Live Telegram updates arrive as log notifications from this logger
+UPDATES_LOGGER = "telegram.updates"
+# The wrapper holds the one update subscription and fans it out itself
+WRAPPER_OWNED_TOOLS = {"subscribe_updates", "unsubscribe_updates"}
+
+# By default a worker runs main.py next to this file with the current interpreter
+SERVER_DIR = os.path.dirname(os.path.abspath(__file__))
+SERVER_COMMAND = [sys.executable, os.path.join(SERVER_DIR, "main.py")]
+
+
+def bare_chat_id(chat_id) -> Optional[int]:
+    """Telegram's unmarked id, as get_chats lists it, for a marked (-100.../-...) or bare id"""
+    if chat_id is None:
+        return None
+    chat_id = int(chat_id)
+    if chat_id >= 0:
+        return chat_id
+    chat_id = -chat_id
+    return chat_id - 1000000000000 if chat_id > 1000000000000 else chat_id
+
+
+class MCPWorker:
+    """One MCP server subprocess behind a multiplexed JSON-RPC pipe"""
+
+    def __init__(
+        self,
+        index: int = 0,
+        role: str = "primary",
+        env: Optional[Dict[str, str]] = None,
+        request_timeout: float = 60.0,
+        command: Optional[List[str]] = None,
+        cwd: Optional[str] = None,
+    ):
+        self.index = index
+        self.role = role
+        self.env = env or {}
+        self.command = command or SERVER_COMMAND
+        self.cwd = cwd or SERVER_DIR
+        self.restarts = 0
+        self.failed_pings = 0
+        self.init_result = None
+        self.on_notification: Optional[Callable[[Dict], None]] = None
+        self.process = None
+        self.stdin = None
+        self.stdout = None
+        self.stderr = None
+        self.is_running = False
+        self.tools_cache = []
+        self.request_timeout = request_timeout
+        # wrapper-local request id -> (future, id the client sent)
+        self._pending: Dict[int, Tuple[asyncio.Future, Any]] = {}
+        self._last_id = 0
+        self._write_lock = asyncio.Lock()
+        self._reader_tasks: List[asyncio.Task] = []
+
+    @property
+    def outstanding(self) -> int:
+        """Requests sent to this worker that are still waiting for a response"""
+        return len(self._pending)
+
+    @property
+    def healthy(self) -> bool:
+        return self.is_running and self.process is not None and self.process.returncode is None
+
+    async def start(self):
+        """Start the MCP server and complete its handshake"""
+        try:
+            logger.info(
+                f"Starting MCP worker {self.index} ({self.role}): {' '.join(self.command)}"
+            )
+            logger.info(f"Working directory: {self.cwd}")
+
+            self.process = await asyncio.create_subprocess_exec(
+                *self.command,
+                stdin=asyncio.subprocess.PIPE,
+                stdout=asyncio.subprocess.PIPE,
+                stderr=asyncio.subprocess.PIPE,
+                cwd=self.cwd,
+                env={
+                    **os.environ,
+                    **self.env,
+                    "MCP_WORKER_ROLE": self.role,
+                    "MCP_WORKER_INDEX": str(self.index),
+                },
+                limit=16 * 1024 * 1024,  # Tool results can be far larger than one 64 KiB line
+            )
+
+            self.stdin = self.process.stdin
+            self.stdout = self.process.stdout
+            self.stderr = self.process.stderr
+            self.is_running = True
+            self._reader_tasks = [
+                asyncio.create_task(self._read_stdout()),
+                asyncio.create_task(self._read_stderr()),
+            ]
+
+            # Each worker does its own handshake; the pool answers the
+            # client's initialize from the primary's result
+            await self._initialize_mcp()
+            if self.init_result is None:
+                await self.stop()
+                return False
+
+            logger.info(f"MCP worker {self.index} started successfully")
+            return True
+
+        except Exception as e:
+            logger.error(f"Failed to start MCP worker {self.index}: {e}")
+            await self.stop()
+            return False
+
+    async def _initialize_mcp(self):
+        """Initialize the MCP connection and load the tool list"""
+        try:
+            response = await self.send_message(
+                {
+                    "jsonrpc": "2.0",
+                    "id": str(uuid.uuid4()),
+                    "method": "initialize",
+                    "params": {
+                        "protocolVersion": "2024-11-05",
+                        "capabilities": {},
+                        "clientInfo": {"name": "mcp-http-wrapper", "version": "1.0.0"},
+                    },
+                }
+            )
+            self.init_result = response.get("result")
+            if self.init_result is None:
+                logger.error(f"MCP worker {self.index} initialize failed: {response.get('error')}")
+                return
+
+            # The server only accepts requests once the handshake is acknowledged
+            await self.send_message({"jsonrpc": "2.0", "method": "notifications/initialized"})
+
+            tools_response = await self.send_message(
+                {"jsonrpc": "2.0", "id": str(uuid.uuid4()), "method": "tools/list"}
+            )
+            if "result" in tools_response and "tools" in tools_response["result"]:
+                self.tools_cache = tools_response["result"]["tools"]
+                logger.info(f"Loaded {len(self.tools_cache)} tools")
+
+        except Exception as e:
+            logger.error(f"Error initializing MCP: {e}")
+
+    async def _read_stdout(self):
+        """Single reader: route every response line to the request waiting for its id"""
+        try:
+            while True:
+                line = await self.stdout.readline()
+                if not line:
+                    break
+                try:
+                    message = json.loads(line.decode().strip())
+                except json.JSONDecodeError:
+                    logger.warning(f"Ignoring non-JSON output from MCP server: {line[:200]!r}")
+                    continue
+                self._dispatch(message)
+        except Exception as e:
+            logger.error(f"MCP stdout reader stopped: {e}")
+        finally:
+            self.is_running = False
+            # The pipe is gone; nobody still waiting will ever get an answer
+            for future, _ in self._pending.values():
+                if not future.done():
+                    future.set_exception(Exception("MCP server closed its output"))
+            self._pending.clear()
+
+    async def _read_stderr(self):
+        """Drain the server's stderr so a full pipe can never block it"""
+        while True:
+            line = await self.stderr.readline()
+            if not line:
+                break
+            logger.info(f"[mcp-worker-{self.index}] {line.decode(errors='replace').rstrip()}")
+
+    def _dispatch(self, message: Dict):
+        """Hand a message from the MCP server to whoever is waiting for it"""
+        if "id" in message and ("result" in message or "error" in message):
+            pending = self._pending.pop(message["id"], None)
+            if pending is None:
+                logger.warning(f"Dropping MCP response for unknown request id {message['id']}")
+                return
+            future, client_id = pending
+            message["id"] = client_id
+            if not future.done():
+                future.set_result(message)
+        elif "method" in message:
+            # Notifications (and server->client requests) are never replies
+            if self.on_notification is not None:
+                self.on_notification(message)
+            else:
+                logger.debug(f"MCP server sent {message['method']}")
+
+    async def _write(self, message: Dict):
+        """Write one JSON-RPC line; the lock keeps concurrent writers from interleaving"""
+        data = (json.dumps(message) + "\n").encode()
+        async with self._write_lock:
+            self.stdin.write(data)
+            await self.stdin.drain()
+
+    async def send_message(self, message: Dict, timeout: Optional[float] = None) -> Optional[Dict]:
+        """Send message to MCP server and wait for the response with the matching id
+
+        Many requests can be in flight through the pipe at once. Each one is sent
+        under a wrapper-local id, so clients that reuse ids never receive each
+        other's responses. Notifications (no id) are written and return None.
+        """
+        if not self.is_running or not self.stdin or not self.stdout:
+            raise Exception("MCP server not running")
+
+        if "id" not in message:
+            await self._write(message)
+            return None
+
+        self._last_id += 1
+        request_id = self._last_id
+        future = asyncio.get_running_loop().create_future()
+        self._pending[request_id] = (future, message["id"])
+        try:
+            await self._write({**message, "id": request_id})
+            return await asyncio.wait_for(future, timeout or self.request_timeout)
+        except asyncio.TimeoutError:
+            logger.error(f"Timeout waiting for MCP response to {message.get('method')}")
+            # Let the server stop working on a request nobody is waiting for anymore
+            await self._write(
+                {
+                    "jsonrpc": "2.0",
+                    "method": "notifications/cancelled",
+                    "params": {"requestId": request_id, "reason": "timeout"},
+                }
+            )
+            raise Exception("MCP server timeout")
+        except Exception as e:
+            logger.error(f"Error communicating with MCP server: {e}")
+            raise
+        finally:
+            self._pending.pop(request_id, None)
+
+    async def ping(self, timeout: float = 10.0) -> bool:
+        """True if the server answers a JSON-RPC ping in time"""
+        try:
+            response = await self.send_message(
+                {"jsonrpc": "2.0", "id": str(uuid.uuid4()), "method": "ping"}, timeout=timeout
+            )
+            return response is not None and "result" in response
+        except Exception:
+            return False
+
+    async def stop(self):
+        """Stop the MCP server"""
+        self.is_running = False
+        if self.process and self.process.returncode is None:
+            self.process.terminate()
+            try:
+                await asyncio.wait_for(self.process.wait(), timeout=5.0)
+            except asyncio.TimeoutError:
+                self.process.kill()
+                await self.process.wait()
+        for task in self._reader_tasks:
+            task.cancel()
+
+
+class MCPServerManager:
+    """Pool of MCP server workers
+
+    Read-only tool calls go to the healthy worker with the fewest requests in
+    flight; mutations are pinned to the primary (worker 0) so writes keep their
+    order. A background task pings every worker and respawns the ones that die
+    or stop answering.
+
+    MCP_POOL_SIZE sets the number of workers (default 1). Each worker needs its
+    own Telegram session, since one auth key used from several connections at
+    once gets AUTH_KEY_DUPLICATED; MCP_WORKER_SESSIONS is a comma-separated list
+    of session strings, one per worker.
+    """
+
+    def __init__(
+        self,
+        pool_size: Optional[int] = None,
+        request_timeout: float = 60.0,
+        health_interval: Optional[float] = None,
+        command: Optional[List[str]] = None,
+        cwd: Optional[str] = None,
+    ):
+        self.pool_size = pool_size or int(os.environ.get("MCP_POOL_SIZE", "1"))
+        self.request_timeout = request_timeout
+        self.health_interval = health_interval or float(
+            os.environ.get("MCP_HEALTH_INTERVAL", "30")
+        )
+        self.command = command
+        self.cwd = cwd
+        self.workers: List[MCPWorker] = []
+        self._health_task: Optional[asyncio.Task] = None
+        # Called with every live-update notification from the primary
+        self.update_listeners: List[Callable[[Dict], None]] = []
+
+    @property
+    def primary(self) -> Optional[MCPWorker]:
+        return self.workers[0] if self.workers else None
+
+    @property
+    def is_running(self) -> bool:
+        return any(worker.healthy for worker in self.workers)
+
+    @property
+    def tools_cache(self) -> List[Dict]:
+        for worker in self.workers:
+            if worker.tools_cache:
+                return worker.tools_cache
+        return []
+
+    def _worker(self, index: int, role: str, env: Dict[str, str]) -> MCPWorker:
+        return MCPWorker(index, role, env, self.request_timeout, self.command, self.cwd)
+
+    def _worker_envs(self) -> List[Dict[str, str]]:
+        """Environment overrides for each worker, one session string apiece"""
+        sessions = [
+            s.strip() for s in os.environ.get("MCP_WORKER_SESSIONS", "").split(",") if s.strip()
+        ]
+        size = max(1, self.pool_size)
+        if size > 1 and len(sessions) < size:
+            logger.warning(
+                f"MCP_POOL_SIZE={size} but only {len(sessions)} worker session(s) configured; "
+                f"running {max(1, len(sessions))} worker(s)"
+            )
+            size = max(1, len(sessions))
+        return [
+            {"TELEGRAM_SESSION_STRING": sessions[i]} if i < len(sessions) else {}
+            for i in range(size)
+        ]
+
+    async def start_mcp_server(self):
+        """Start every worker; succeeds once the primary is up"""
+        self.workers = [
+            self._worker(i, "primary" if i == 0 else "replica", env)
+            for i, env in enumerate(self._worker_envs())
+        ]
+        await asyncio.gather(*(worker.start() for worker in self.workers))
+        if self.primary.healthy:
+            await self._subscribe_updates(self.primary)
+        self._health_task = asyncio.create_task(self._health_loop())
+        return self.primary.healthy
+
+    def _publish_update(self, message: Dict):
+        params = message.get("params") or {}
+        if (
+            message.get("method") != "notifications/message"
+            or params.get("logger") != UPDATES_LOGGER
+        ):
+            return
+        for listener in list(self.update_listeners):
+            try:
+                listener(message)
+            except Exception as e:
+                logger.error(f"Update listener failed: {e}")
+
+    async def _subscribe_updates(self, worker: MCPWorker):
+        """Have the primary push every Telegram update to the wrapper"""
+        worker.on_notification = self._publish_update
+        try:
+            await worker.send_message(
+                {
+                    "jsonrpc": "2.0",
+                    "id": "subscribe_updates",
+                    "method": "tools/call",
+                    "params": {"name": "subscribe_updates", "arguments": {}},
+                }
+            )
+        except Exception as e:
+            logger.error(f"Could not subscribe to live updates: {e}")
+
+    def _pick(self, message: Dict) -> MCPWorker:
+        """Choose the worker that should handle a request"""
+        params = message.get("params") or {}
+        name = str(params.get("name", ""))
+        if message.get("method") == "tools/call" and name == CONTINUATION_TOOL:
+            # The rest of a budgeted response lives in the worker that produced it;
+            # its token starts with that worker's index
+            token = str((params.get("arguments") or {}).get("token", ""))
+            for worker in self.workers:
+                if worker.healthy and token.split(".", 1)[0] == str(worker.index):
+                    return worker
+        if message.get("method") == "tools/call" and (
+            name in MUTATING_TOOLS or not name.startswith(READ_ONLY_TOOL_PREFIXES)
+        ):
+            if not self.primary or not self.primary.healthy:
+                raise Exception("MCP primary worker not running")
+            return self.primary
+        healthy = [worker for worker in self.workers if worker.healthy]
+        if not healthy:
+            raise Exception("MCP server not running")
+        return min(healthy, key=lambda worker: worker.outstanding)
+
+    async def send_message(self, message: Dict, timeout: Optional[float] = None) -> Optional[Dict]:
+        """Route a message to a worker and return its response"""
+        method = message.get("method")
+        # Every worker has already done its own handshake; answer the client's
+        # from the primary's result so it is not replayed against one worker
+        if (
+            method == "initialize"
+            and "id" in message
+            and self.primary
+            and self.primary.init_result
+        ):
+            return {"jsonrpc": "2.0", "id": message["id"], "result": self.primary.init_result}
+        if method == "notifications/initialized":
+            return None
+        if (
+            method == "tools/call"
+            and (message.get("params") or {}).get("name") in WRAPPER_OWNED_TOOLS
+        ):
+            return {
+                "jsonrpc": "2.0",
+                "id": message.get("id"),
+                "error": {
+                    "code": -32601,
+                    "message": "Live updates are streamed by the wrapper; use its update stream instead",
+                },
+            }
+        return await self._pick(message).send_message(message, timeout)
+
+    async def call_tool(self, tool_name: str, parameters: Dict[str, Any]) -> Dict:
+        """Call a specific tool"""
+        return await self.send_message(
+            {
+                "jsonrpc": "2.0",
+                "id": str(uuid.uuid4()),
+                "method": "tools/call",
+                "params": {"name": tool_name, "arguments": parameters},
+            }
+        )
+
+    async def _health_loop(self):
+        """Ping workers periodically and respawn the dead or unresponsive ones"""
+        while True:
+            await asyncio.sleep(self.health_interval)
+            for i, worker in enumerate(list(self.workers)):
+                if worker.healthy and await worker.ping(timeout=min(10.0, self.request_timeout)):
+                    worker.failed_pings = 0
+                    continue
+                worker.failed_pings += 1
+                # A single missed ping can just be a busy worker
+                if worker.healthy and worker.failed_pings < 2:
+                    continue
+                logger.warning(
+                    f"MCP worker {worker.index} ({worker.role}) is unhealthy, respawning"
+                )
+                await worker.stop()
+                replacement = self._worker(worker.index, worker.role, worker.env)
+                replacement.restarts = worker.restarts + 1
+                self.workers[i] = replacement
+                if not await replacement.start():
+                    logger.error(f"Failed to respawn MCP worker {worker.index}")
+                elif replacement.role == "primary":
+                    await self._subscribe_updates(replacement)
+
+    async def metrics(self) -> str:
+        """Every worker's get_server_stats in Prometheus format, labelled by worker"""
+        families: Dict[str, List[str]] = {}
+        for worker in list(self.workers):
+            if not worker.healthy:
+                continue
+            try:
+                response = await worker.send_message(
+                    {
+                        "jsonrpc": "2.0",
+                        "id": "metrics",
+                        "method": "tools/call",
+                        "params": {
+                            "name": "get_server_stats",
+                            "arguments": {"format": "prometheus"},
+                        },
+                    },
+                    timeout=10.0,
+                )
+                text = response["result"]["content"][0]["text"]
+            except Exception as e:
+                logger.warning(f"Could not collect metrics from worker {worker.index}: {e}")
+                continue
+            merge_metrics(families, text, worker.index)
+        return "".join(line + "\n" for lines in families.values() for line in lines)
+
+    def status(self) -> List[Dict[str, Any]]:
+        return [
+            {
+                "index": worker.index,
+                "role": worker.role,
+                "pid": worker.process.pid if worker.process else None,
+                "running": worker.healthy,
+                "outstanding": worker.outstanding,
+                "restarts": worker.restarts,
+            }
+            for worker in self.workers
+        ]
+
+    async def stop(self):
+        """Stop the health checks and every worker"""
+        if self._health_task:
+            self._health_task.cancel()
+        await asyncio.gather(*(worker.stop() for worker in self.workers))
+
+
+def merge_metrics(families: Dict[str, List[str]], text: str, worker_index: int):
+    """Add one worker's Prometheus text to families, labelling its samples by worker
+
+    Samples must stay grouped under their family's HELP/TYPE lines, so the
+    workers' outputs are merged per family rather than concatenated.
+    """
+    lines: List[str] = []
+    for line in text.splitlines():
+        if line.startswith("# "):
+            lines = families.setdefault(line.split()[2], [])
+            if line not in lines:
+                lines.append(line)
+        elif line:
+            series, value = line.rsplit(" ", 1)
+            name, _, labels = series.partition("{")
+            labels = f'worker="{worker_index}"' + ("," + labels[:-1] if labels else "")
+            lines.append(f"{name}{{{labels}}} {value}")
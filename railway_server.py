@@ -1,6 +1,156 @@
-import os import asyncio import logging from typing import Dict, Any from starlette.applications import Starlette from starlette.responses import JSONResponse from starlette.routing import Route, Mount from starlette.middleware.cors import CORSMiddleware from sse_starlette.sse import EventSourceResponse import uvicorn # Import your existing MCP server from main import app as mcp_app # Configure logging logging.basicConfig(level=logging.INFO) logger = logging.getLogger(__name__)
- class RailwayMCPServer: def __init__(self): self.mcp_app = mcp_app async def health_check(self, request): "Health check endpoint for Railway" return JSONResponse({ "status": "healthy", "service": "telegram-mcp", "timestamp": str(asyncio.get_event_loop().time()) })
- async def mcp_endpoint(self, request): "Main MCP endpoint with SSE support" try: # Handle MCP protocol requests if request.headers.get("accept") == "text/event-stream": return await self.handle_sse(request) else: return await self.handle_http(request) except Exception as e: logger.error(f"MCP endpoint error: {e}") return JSONResponse({"error": str(e)}, status_code=500)
- async def handle_sse(self, request): "Handle Server-Sent Events for real-time MCP" async def event_stream(): try: # Your MCP app logic here yield {"data": '{"jsonrpc": "2.0", "id": 1, "result": {"capabilities": {"tools": {}}}}'} except Exception as e: yield {"data": f'{"error": "{str(e)}"}'} return EventSourceResponse(event_stream())
- async def handle_http(self, request): "Handle regular HTTP requests" try: body = await request.json() if request.method == "POST" else {} # Process with your existing MCP logic result = {"status": "processed", "request": body} return JSONResponse(result) except Exception as e: return JSONResponse({"error": str(e)}, status_code=500)
- # Create Railway app def create_app(): # Initialize MCP server mcp_server = RailwayMCPServer() # Define routes routes = [ Route("/", mcp_server.health_check, methods=["GET"]), Route("/health", mcp_server.health_check, methods=["GET"]), Route("/mcp", mcp_server.mcp_endpoint, methods=["GET", "POST"]), Route("/api/mcp", mcp_server.mcp_endpoint, methods=["GET", "POST"]), ] # Create Starlette app app = Starlette(routes=routes) # Add CORS middleware for Claude web access app.add_middleware( CORSMiddleware, allow_origins=["https://claude.ai", "https://www.claude.ai", "*"], allow_credentials=True, allow_methods=["*"], allow_headers=["*"], ) return app # Create the app app = create_app() if __name__ == "__main__": port = int(os.environ.get("PORT", 8000)) uvicorn.run(app, host="0.0.0.0", port=port)
+#!/usr/bin/env python3
+"""
+Railway entry point for the Telegram MCP server
+
+Serves the FastMCP instance from main.py directly over HTTP, in this process
+and on uvicorn's event loop, so every tool call goes straight to the shared
+Telethon client instead of through a stdio subprocess.
+
+Endpoints:
+- /mcp: streamable HTTP transport (the URL to give Claude)
+- /sse and /messages/: SSE transport for older clients
+- /events: live Telegram updates as SSE (optionally ?chat_ids=1,2)
+- /ws/events: the same updates over a WebSocket
+- /health: liveness and Telegram connection state
+- /metrics: tool and Telegram request metrics in Prometheus format
+"""
+
+import asyncio
+import contextlib
+import json
+import logging
+import os
+
+import uvicorn
+from mcp.server.transport_security import TransportSecuritySettings
+from starlette.applications import Starlette
+from starlette.middleware.cors import CORSMiddleware
+from starlette.responses import JSONResponse, PlainTextResponse, StreamingResponse
+from starlette.routing import Route, WebSocketRoute
+from starlette.websockets import WebSocketDisconnect
+
+from main import client, mcp, metrics, startup, update_broker
+
+# Configure logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+async def health_check(request):
+    """Health check endpoint for Railway"""
+    connected = client.is_connected()
+    return JSONResponse(
+        {
+            "status": "healthy" if connected else "degraded",
+            "service": "telegram-mcp",
+            "telegram_connected": connected,
+        }
+    )
+
+
+async def metrics_endpoint(request):
+    """Prometheus metrics for this process"""
+    return PlainTextResponse(metrics.render_prometheus(), media_type="text/plain; version=0.0.4")
+
+
+def _chat_filter(params):
+    chat_ids = params.get("chat_ids")
+    return [int(c) for c in chat_ids.split(",") if c.strip()] if chat_ids else None
+
+
+async def events_stream(request):
+    """Live Telegram updates as Server-Sent Events"""
+    subscription = update_broker.subscribe(_chat_filter(request.query_params))
+
+    async def stream():
+        try:
+            while True:
+                try:
+                    update = await asyncio.wait_for(subscription.queue.get(), timeout=30)
+                    yield f"data: {json.dumps(update)}\n\n"
+                except asyncio.TimeoutError:
+                    yield ": heartbeat\n\n"
+        finally:
+            update_broker.unsubscribe(subscription.id)
+
+    return StreamingResponse(
+        stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+async def events_websocket(websocket):
+    """Live Telegram updates over a WebSocket, one JSON object per message"""
+    await websocket.accept()
+    subscription = update_broker.subscribe(_chat_filter(websocket.query_params))
+
+    async def pump():
+        while True:
+            await websocket.send_text(json.dumps(await subscription.queue.get()))
+
+    sender = asyncio.create_task(pump())
+    try:
+        # Nothing is expected from the client; reading just notices it leaving
+        while True:
+            await websocket.receive_text()
+    except WebSocketDisconnect:
+        pass
+    finally:
+        sender.cancel()
+        update_broker.unsubscribe(subscription.id)
+
+
+@contextlib.asynccontextmanager
+async def lifespan(app):
+    """Connect Telegram before serving and disconnect on shutdown"""
+    await startup()
+    logger.info("Telegram client started")
+    try:
+        async with mcp.session_manager.run():
+            yield
+    finally:
+        await client.disconnect()
+
+
+def create_app():
+    # FastMCP only accepts localhost Host headers unless told otherwise; behind
+    # Railway's proxy requests carry the public domain. MCP_ALLOWED_HOSTS
+    # (comma-separated) turns the check back on for just those hosts.
+    allowed_hosts = [
+        h.strip() for h in os.environ.get("MCP_ALLOWED_HOSTS", "").split(",") if h.strip()
+    ]
+    mcp.settings.transport_security = TransportSecuritySettings(
+        enable_dns_rebinding_protection=bool(allowed_hosts),
+        allowed_hosts=allowed_hosts,
+        allowed_origins=[f"https://{host}" for host in allowed_hosts],
+    )
+
+    routes = [
+        Route("/", health_check, methods=["GET"]),
+        Route("/health", health_check, methods=["GET"]),
+        Route("/metrics", metrics_endpoint, methods=["GET"]),
+        Route("/events", events_stream, methods=["GET"]),
+        WebSocketRoute("/ws/events", events_websocket),
+        *mcp.streamable_http_app().routes,
+        *mcp.sse_app().routes,
+    ]
+    app = Starlette(routes=routes, lifespan=lifespan)
+
+    # Add CORS middleware for Claude web access
+    app.add_middleware(
+        CORSMiddleware,
+        allow_origins=["*"],
+        allow_methods=["*"],
+        allow_headers=["*"],
+        expose_headers=["Mcp-Session-Id"],
+    )
+    return app
+
+
+# Create the app
+app = create_app()
+
+if __name__ == "__main__":
+    port = int(os.environ.get("PORT", 8000))
+    uvicorn.run(app, host="0.0.0.0", port=port)
@@ -0,0 +1,121 @@
+#!/usr/bin/env python3
+"""
+Tests for pure helpers: the contact list hash, pagination cursors and the
+response budget with its continuations
+
+Run with: python -m unittest test_helpers
+"""
+
+import json
+import unittest
+
+import main
+
+
+class ContactsHashTest(unittest.TestCase):
+    def test_known_values(self):
+        self.assertEqual(main.contacts_hash([]), 0)
+        self.assertEqual(main.contacts_hash([1]), 1)
+        # 1, then (1 ^ 1 << 35 ^ 1 << 31) + 2, worked through by hand
+        self.assertEqual(main.contacts_hash([1, 2]), (1 << 35) + (1 << 31) + 3)
+
+    def test_ids_are_sorted_and_saved_count_comes_first(self):
+        self.assertEqual(main.contacts_hash([2, 1]), main.contacts_hash([1, 2]))
+        self.assertNotEqual(main.contacts_hash([1, 2], 1), main.contacts_hash([1, 2]))
+
+    def test_result_is_a_signed_64_bit_long(self):
+        value = main.contacts_hash(range(7_000_000_000, 7_000_000_200))
+        self.assertLess(value, 1 << 63)
+        self.assertGreaterEqual(value, -(1 << 63))
+
+
+class CursorTest(unittest.TestCase):
+    def test_round_trip(self):
+        cursor = main.encode_cursor(-1001234567890, 4242)
+        self.assertNotIn("=", cursor)
+        self.assertEqual(main.decode_cursor(cursor, -1001234567890), 4242)
+
+    def test_other_chat_is_rejected(self):
+        cursor = main.encode_cursor(1, 10)
+        with self.assertRaisesRegex(ValueError, "issued for chat 1, not 2"):
+            main.decode_cursor(cursor, 2)
+
+    def test_garbage_is_rejected(self):
+        for cursor in ("", "not a cursor", "e30"):  # e30 is "{}"
+            with self.assertRaisesRegex(ValueError, "Invalid cursor"):
+                main.decode_cursor(cursor, 1)
+
+
+def record(item):
+    return item
+
+
+def items(count, text_length=20):
+    return [{"n": n, "text": "x" * text_length} for n in range(count)]
+
+
+class RenderBudgetTest(unittest.IsolatedAsyncioTestCase):
+    async def collect(self, output, max_chars=None):
+        """Follow continuation tokens from a json response; returns all items and the last part."""
+        collected = []
+        while True:
+            part = json.loads(output)
+            collected.extend(part["items"])
+            if "continuation" not in part:
+                return collected, part
+            output = await main.get_continuation(part["continuation"], max_chars=max_chars)
+            if max_chars:
+                self.assertLessEqual(len(output), max_chars)
+
+    def test_unbudgeted_keeps_everything_and_meta(self):
+        output = main.render(items(50), record, output_format="json", max_chars=0, next_cursor="c")
+        part = json.loads(output)
+        self.assertEqual(len(part["items"]), 50)
+        self.assertEqual(part["next_cursor"], "c")
+        self.assertNotIn("continuation", part)
+
+    async def test_max_chars_splits_into_continuations(self):
+        output = main.render(
+            items(50), record, output_format="json", max_chars=300, next_cursor="c"
+        )
+        self.assertLessEqual(len(output), 300)
+        first = json.loads(output)
+        self.assertNotIn("next_cursor", first)
+        collected, last = await self.collect(output, max_chars=300)
+        self.assertEqual([item["n"] for item in collected], list(range(50)))
+        # The meta values describe the whole result, so they close the last part
+        self.assertEqual(last["next_cursor"], "c")
+
+    async def test_max_items(self):
+        output = main.render(items(7), record, output_format="json", max_chars=0, max_items=3)
+        self.assertEqual([item["n"] for item in json.loads(output)["items"]], [0, 1, 2])
+        collected, _ = await self.collect(output)
+        self.assertEqual(len(collected), 7)
+
+    def test_long_text_is_shortened_to_leave_room_for_more_items(self):
+        output = main.render(
+            items(2, text_length=5000), record, output_format="json", max_chars=400
+        )
+        part = json.loads(output)
+        self.assertEqual(len(part["items"]), 2)
+        self.assertTrue(all(len(item["text"]) < 100 for item in part["items"]))
+
+    def test_every_part_sends_at_least_one_item(self):
+        part = json.loads(main.render(items(3), record, output_format="json", max_chars=10))
+        self.assertEqual(len(part["items"]), 1)
+        self.assertIn("continuation", part)
+
+    async def test_unknown_token(self):
+        self.assertIn("Unknown or expired", await main.get_continuation("0.nope"))
+
+    def test_fitting_count_is_the_largest_page_that_fits(self):
+        def page(count):
+            return "x" * (10 * count)
+
+        self.assertEqual(main._fitting_count(page, 100, 355), 35)
+        self.assertEqual(main._fitting_count(page, 20, 355), 20)
+        self.assertEqual(main._fitting_count(page, 100, 5), 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
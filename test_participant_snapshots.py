@@ -0,0 +1,118 @@
+#!/usr/bin/env python3
+"""
+Tests for the member snapshots behind get_participant_changes
+
+Run with: python -m unittest test_participant_snapshots
+"""
+
+import os
+import tempfile
+import unittest
+from array import array
+from unittest import mock
+
+import main
+
+PEER_ID = -1001234567890
+
+
+def snapshot_meta(**extra):
+    return {"chat_id": PEER_ID, "listed_at": 0, "synced_at": 0, "reported_at": 0, **extra}
+
+
+class DiffSortedTest(unittest.TestCase):
+    def test_joined_and_left(self):
+        self.assertEqual(main.diff_sorted([1, 2, 4, 7], [2, 3, 4, 8, 9]), ([3, 8, 9], [1, 7]))
+
+    def test_identical_and_empty(self):
+        self.assertEqual(main.diff_sorted([1, 2, 3], [1, 2, 3]), ([], []))
+        self.assertEqual(main.diff_sorted([], [5, 6]), ([5, 6], []))
+        self.assertEqual(main.diff_sorted([5, 6], []), ([], [5, 6]))
+
+    def test_arrays(self):
+        self.assertEqual(main.diff_sorted(array("q", [1, 3]), array("q", [2, 3])), ([2], [1]))
+
+
+class ParticipantSnapshotsTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+        self.snapshots = main.ParticipantSnapshots(self.directory.name)
+
+    def reopen(self):
+        """A fresh instance, as after a restart, reading only what is on disk."""
+        return main.ParticipantSnapshots(self.directory.name)
+
+    def test_untracked_chat_records_nothing(self):
+        self.assertEqual(self.snapshots.record(PEER_ID, [(1, "join")], "event"), [])
+        self.assertIsNone(self.snapshots.load(PEER_ID))
+
+    def test_first_listing_journals_nothing(self):
+        entries = self.snapshots.replace(PEER_ID, array("q", [1, 2, 3]), snapshot_meta())
+        self.assertEqual(entries, [])
+        self.assertEqual(list(self.snapshots.load(PEER_ID)["ids"]), [1, 2, 3])
+
+    def test_record_journals_only_changes(self):
+        self.snapshots.replace(PEER_ID, array("q", [1, 2, 3]), snapshot_meta())
+        entries = self.snapshots.record(
+            PEER_ID, [(4, "join"), (2, "join"), (1, "leave"), (9, "leave")], "event", 100.0
+        )
+        self.assertEqual(
+            [(e["user_id"], e["change"]) for e in entries], [(4, "join"), (1, "leave")]
+        )
+        self.assertEqual(list(self.snapshots.load(PEER_ID)["ids"]), [2, 3, 4])
+        self.assertEqual(len(self.snapshots.history(PEER_ID, 0)), 2)
+
+    def test_journal_is_replayed_after_restart(self):
+        self.snapshots.replace(PEER_ID, array("q", [1, 2, 3]), snapshot_meta())
+        self.snapshots.record(PEER_ID, [(5, "join"), (1, "leave")], "event")
+        chat = self.reopen().load(PEER_ID)
+        self.assertEqual(list(chat["ids"]), [2, 3, 5])
+        self.assertEqual(chat["pending"], 2)
+
+    def test_fold_rewrites_ids_and_keeps_history(self):
+        self.snapshots.replace(PEER_ID, array("q", [1]), snapshot_meta())
+        with mock.patch.object(main, "SNAPSHOT_FOLD_AFTER", 3):
+            self.snapshots.record(PEER_ID, [(2, "join"), (3, "join")], "event")
+            self.assertEqual(self.snapshots.load(PEER_ID)["pending"], 2)
+            self.snapshots.record(PEER_ID, [(1, "leave")], "event")
+        self.assertEqual(self.snapshots.load(PEER_ID)["pending"], 0)
+        with open(os.path.join(self.directory.name, f"{PEER_ID}.ids"), "rb") as f:
+            self.assertEqual(list(array("q", f.read())), [2, 3])
+        chat = self.reopen().load(PEER_ID)
+        self.assertEqual(list(chat["ids"]), [2, 3])
+        self.assertEqual(chat["pending"], 0)
+        self.assertEqual(len(self.reopen().history(PEER_ID, 0)), 3)
+
+    def test_fold_drops_old_history(self):
+        self.snapshots.replace(PEER_ID, array("q", [1]), snapshot_meta())
+        self.snapshots.record(PEER_ID, [(2, "join")], "event", 1.0)
+        self.snapshots.replace(PEER_ID, array("q", [1, 2]), snapshot_meta())
+        self.assertEqual(self.snapshots.history(PEER_ID, 0), [])
+
+    def test_complete_listings_are_diffed(self):
+        self.snapshots.replace(PEER_ID, array("q", [1, 2, 3]), snapshot_meta())
+        entries = self.snapshots.replace(PEER_ID, array("q", [2, 3, 4]), snapshot_meta())
+        self.assertEqual(
+            sorted((e["user_id"], e["change"], e["source"]) for e in entries),
+            [(1, "leave", "listing"), (4, "join", "listing")],
+        )
+
+    def test_partial_listings_are_not_diffed(self):
+        partial = snapshot_meta(partial=True, count=10)
+        self.snapshots.replace(PEER_ID, array("q", [1, 2, 3]), partial)
+        self.assertEqual(self.snapshots.replace(PEER_ID, array("q", [2, 3, 4]), partial), [])
+        # Nor is a complete listing against a partial snapshot
+        self.assertEqual(self.snapshots.replace(PEER_ID, array("q", [5]), snapshot_meta()), [])
+        self.assertEqual(self.snapshots.history(PEER_ID, 0), [])
+
+    def test_partial_snapshot_journals_every_update(self):
+        self.snapshots.replace(PEER_ID, array("q", [1, 2]), snapshot_meta(partial=True, count=5))
+        entries = self.snapshots.record(PEER_ID, [(7, "leave"), (1, "join")], "event")
+        self.assertEqual(
+            [(e["user_id"], e["change"]) for e in entries], [(7, "leave"), (1, "join")]
+        )
+
+
+if __name__ == "__main__":
+    unittest.main()
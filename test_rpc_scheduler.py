@@ -0,0 +1,109 @@
+#!/usr/bin/env python3
+"""
+Tests for the RPC scheduler that paces every request the client sends
+
+Buckets are small and fast here so the waits stay in the tens of
+milliseconds. Run with: python -m unittest test_rpc_scheduler
+"""
+
+import asyncio
+import time
+import unittest
+
+from telethon import errors, functions
+
+import main
+
+# One family is enough: messages.GetHistoryRequest is paced as "messages"
+REQUEST = functions.messages.GetHistoryRequest(
+    peer="me", offset_id=0, offset_date=None, add_offset=0, limit=1, max_id=0, min_id=0, hash=0
+)
+
+
+def scheduler(rate: float = 20.0, burst: int = 1, deadline: float = 5.0) -> main.RpcScheduler:
+    return main.RpcScheduler({"messages": (rate, burst), "default": (rate, burst)}, deadline)
+
+
+class RpcSchedulerTest(unittest.IsolatedAsyncioTestCase):
+    async def call(
+        self, rpc, log, name, priority=main.PRIORITY_INTERACTIVE, deadline=None, request=REQUEST
+    ):
+        async def send():
+            log.append(name)
+            return name
+
+        with main.rpc_context(deadline=deadline, priority=priority):
+            return await rpc.run(request, send)
+
+    def test_family(self):
+        self.assertEqual(main.RpcScheduler.family(REQUEST), "messages")
+        self.assertEqual(
+            main.RpcScheduler.family(functions.contacts.ResolveUsernameRequest("x")), "resolve"
+        )
+
+    async def test_waiters_are_served_in_arrival_order(self):
+        rpc, log = scheduler(), []
+        await asyncio.gather(*(self.call(rpc, log, n) for n in range(5)))
+        self.assertEqual(log, [0, 1, 2, 3, 4])
+        self.assertGreater(rpc.stats["messages"]["queued"], 0)
+
+    async def test_bucket_paces_calls(self):
+        rpc, log = scheduler(rate=20.0, burst=2), []
+        start = time.monotonic()
+        await asyncio.gather(*(self.call(rpc, log, n) for n in range(4)))
+        # Two go out from the burst, the other two wait 50 ms apiece
+        self.assertGreaterEqual(time.monotonic() - start, 0.09)
+        self.assertEqual(rpc.stats["messages"]["calls"], 4)
+
+    async def test_lower_priority_value_goes_first(self):
+        rpc, log = scheduler(rate=10.0), []
+        await self.call(rpc, log, "first")  # Takes the only token
+        await asyncio.gather(
+            self.call(rpc, log, "background", main.PRIORITY_BACKGROUND),
+            self.call(rpc, log, "bulk", main.PRIORITY_BULK),
+            self.call(rpc, log, "interactive", main.PRIORITY_INTERACTIVE),
+        )
+        self.assertEqual(log, ["first", "interactive", "bulk", "background"])
+
+    async def test_flood_wait_is_slept_off_and_slows_the_family(self):
+        rpc, attempts = scheduler(rate=20.0, burst=5), []
+
+        async def send():
+            attempts.append(time.monotonic())
+            if len(attempts) == 1:
+                raise errors.FloodWaitError(request=None, capture=1)
+            return "ok"
+
+        with self.assertLogs("telegram_mcp", "WARNING"):
+            self.assertEqual(await rpc.run(REQUEST, send), "ok")
+        self.assertGreaterEqual(attempts[1] - attempts[0], 0.95)
+        self.assertEqual(rpc.stats["messages"]["flood_waits"], 1)
+        self.assertEqual(rpc.stats["messages"]["flood_wait_seconds"], 1)
+        # Halved by the FloodWait, then one success of recovery (base_rate / 20)
+        self.assertAlmostEqual(rpc._buckets["messages"].rate, 11.0)
+
+    async def test_flood_wait_past_the_deadline_reaches_the_caller(self):
+        rpc = scheduler()
+
+        async def send():
+            raise errors.FloodWaitError(request=None, capture=30)
+
+        with main.rpc_context(deadline=1), self.assertLogs("telegram_mcp", "WARNING"):
+            with self.assertRaises(errors.FloodWaitError):
+                await rpc.run(REQUEST, send)
+
+    async def test_wait_past_the_deadline_raises_rate_limit_exceeded(self):
+        rpc, log = scheduler(), []
+        rpc._buckets["messages"].flood_wait(30)
+        with self.assertRaises(main.RateLimitExceeded) as caught:
+            await self.call(rpc, log, "late", deadline=1)
+        self.assertEqual(caught.exception.family, "messages")
+        self.assertGreater(caught.exception.seconds, 25)
+        self.assertEqual(log, [])
+        # Other families are not held up
+        await self.call(rpc, log, "config", deadline=1, request=functions.help.GetConfigRequest())
+        self.assertEqual(log, ["config"])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,67 @@
+#!/usr/bin/env python3
+"""
+Tests for the live-update chat filters
+
+get_chats and list_chats hand out bare ids while Telegram events carry marked
+peer ids (-100... for channels, -... for basic groups); a filter must match
+either form. Run with: python -m unittest test_update_filters
+"""
+
+import unittest
+
+import main
+import mcp_http_wrapper
+import mcp_http_wrapper_fixed
+
+CHANNEL_ID = 1234567890
+CHANNEL_PEER_ID = -1001234567890
+GROUP_ID = 4567
+GROUP_PEER_ID = -4567
+USER_ID = 777
+
+
+class UpdateSubscriptionTest(unittest.TestCase):
+    def test_bare_channel_id_matches_marked_event(self):
+        subscription = main.UpdateSubscription([CHANNEL_ID], 10)
+        self.assertTrue(subscription.wants(CHANNEL_PEER_ID))
+        self.assertFalse(subscription.wants(-1009999999))
+
+    def test_marked_channel_id_matches_marked_event(self):
+        subscription = main.UpdateSubscription([CHANNEL_PEER_ID], 10)
+        self.assertTrue(subscription.wants(CHANNEL_PEER_ID))
+
+    def test_group_and_user_ids(self):
+        subscription = main.UpdateSubscription([GROUP_ID, USER_ID], 10)
+        self.assertTrue(subscription.wants(GROUP_PEER_ID))
+        self.assertTrue(subscription.wants(USER_ID))
+        self.assertFalse(subscription.wants(None))
+
+    def test_unfiltered_wants_everything(self):
+        subscription = main.UpdateSubscription(None, 10)
+        self.assertTrue(subscription.wants(CHANNEL_PEER_ID))
+        self.assertTrue(subscription.wants(None))
+
+    def test_broker_delivers_channel_update(self):
+        broker = main.UpdateBroker()
+        subscription = broker.subscribe([CHANNEL_ID])
+        broker.publish({"type": "new_message", "chat_id": CHANNEL_PEER_ID})
+        self.assertEqual(subscription.queue.qsize(), 1)
+
+
+class WrapperFilterTest(unittest.TestCase):
+    def test_bare_chat_id_matches_telethon(self):
+        for wrapper in (mcp_http_wrapper, mcp_http_wrapper_fixed):
+            for peer_id in (CHANNEL_PEER_ID, GROUP_PEER_ID, USER_ID):
+                self.assertEqual(wrapper.bare_chat_id(peer_id), main.utils.resolve_id(peer_id)[0])
+            self.assertEqual(wrapper.bare_chat_id(str(CHANNEL_PEER_ID)), CHANNEL_ID)
+
+    def test_websocket_connection_matches_channel(self):
+        connection = mcp_http_wrapper_fixed.ClientConnection(None, 10, "drop_oldest")
+        connection.subscribed = True
+        connection.chat_ids = {mcp_http_wrapper_fixed.bare_chat_id(CHANNEL_ID)}
+        self.assertTrue(connection.wants(CHANNEL_PEER_ID))
+        self.assertFalse(connection.wants(GROUP_PEER_ID))
+
+
+if __name__ == "__main__":
+    unittest.main()